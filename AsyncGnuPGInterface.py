@@ -0,0 +1,250 @@
+"""asyncio interface to GNU Privacy Guard (GnuPG)
+
+AsyncGnuPG is the asyncio sibling of GnuPGInterface.GnuPG.  It is set up
+the same way, through its 'call', 'passphrase' and 'options' attributes,
+but run() is a coroutine which launches GnuPG with asyncio subprocess
+transports, so that a single event loop can drive many GnuPG processes
+without a thread per process.
+
+Created filehandles are exposed as asyncio streams: handles GnuPG reads
+from (stdin, passphrase, command) are StreamWriters and handles GnuPG
+writes to (stdout, stderr, status, logger, attribute) are StreamReaders.
+
+Example code:
+
+>>> import asyncio
+>>> import AsyncGnuPGInterface
+>>>
+>>> async def encrypt(plaintext):
+...     gnupg = AsyncGnuPGInterface.AsyncGnuPG()
+...     gnupg.passphrase = "This is the passphrase"
+...     gnupg.options.meta_interactive = 0
+...
+...     proc = await gnupg.run(['--symmetric'],
+...                            create_fhs=['stdin', 'stdout', 'status'])
+...     proc.handles['stdin'].write(plaintext)
+...     proc.handles['stdin'].close()
+...
+...     ciphertext = await proc.handles['stdout'].read()
+...     status = await proc.handles['status'].read()
+...     await proc.wait()
+...     return ciphertext
+...
+>>> ciphertext = asyncio.run(encrypt(b"Three blind mice"))
+
+This module requires Python 3.7 or later.
+
+LICENSE:
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+"""
+
+import asyncio
+import os
+
+from GnuPGInterface import _check_fhs, _fd_modes, _get_fd_args, \
+     _passphrase_provider, _stds, _to_bytes, Options, Pipe
+
+__revision__ = "$Id$"
+
+
+class AsyncGnuPG(object):
+    """Class instances represent GnuPG, run from an asyncio event loop.
+
+    Instance attributes are the same as those of GnuPGInterface.GnuPG:
+
+    * call -- string to call GnuPG with.  Defaults to "gpg"
+
+    * passphrase -- if set, and no passphrase filehandle is given to
+      run(), the passphrase is sent to GnuPG automatically.  As for
+      GnuPGInterface.GnuPG, it may be a string, a callable or a
+      GnuPGInterface.PassphraseProvider.
+
+    * options -- Object of type GnuPGInterface.Options.
+    """
+
+    __slots__ = ['call', 'passphrase', 'options']
+
+    def __init__(self):
+        self.call = 'gpg'
+        self.passphrase = None
+        self.options = Options()
+
+    async def run(self, gnupg_commands, args=None, create_fhs=None,
+                  attach_fhs=None):
+        """Coroutine calling GnuPG with the list of string commands
+        gnupg_commands, returning an AsyncProcess.
+
+        args, create_fhs and attach_fhs are as for
+        GnuPGInterface.GnuPG.run(), except that the entries of the
+        returned process' handles are asyncio StreamReaders and
+        StreamWriters instead of file objects.  Standard filehandles
+        which are neither created nor attached are inherited from
+        this process.
+        """
+        if args is None: args = []
+        if create_fhs is None: create_fhs = []
+        if attach_fhs is None: attach_fhs = {}
+
+        create_fhs = list(create_fhs)
+        _check_fhs(create_fhs, attach_fhs)
+
+        loop = asyncio.get_running_loop()
+        provider = _passphrase_provider(self.passphrase)
+        handle_passphrase = False
+        if provider is not None and 'passphrase' not in attach_fhs \
+           and 'passphrase' not in create_fhs:
+            # may run programs itself, such as gpg-connect-agent
+            await loop.run_in_executor(None, provider.prepare, self)
+            gnupg_commands = provider.get_args() + list(gnupg_commands)
+            if provider.uses_fd:
+                handle_passphrase = True
+                create_fhs.append('passphrase')
+
+        # non-standard handles are passed to GnuPG by fd number, and
+        # standard ones created through asyncio itself
+        pipes = {}
+        for fh_name in create_fhs:
+            if fh_name in _stds:
+                continue
+            pipe = os.pipe()
+            if _fd_modes[fh_name][0] == 'w': pipe = (pipe[1], pipe[0])
+            pipes[fh_name] = Pipe(pipe[0], pipe[1], 0)
+
+        for fh_name, fh in attach_fhs.items():
+            if fh_name not in _stds:
+                pipes[fh_name] = Pipe(fh.fileno(), fh.fileno(), 1)
+
+        std_args = {}
+        for std in _stds:
+            if std in create_fhs:
+                std_args[std] = asyncio.subprocess.PIPE
+            elif std in attach_fhs:
+                std_args[std] = attach_fhs[std].fileno()
+
+        command = [ self.call ] + _get_fd_args(pipes) \
+                  + self.options.get_args() + gnupg_commands + args
+
+        process = AsyncProcess()
+        try:
+            process._subproc = await asyncio.create_subprocess_exec(
+                    *command,
+                    pass_fds=[ p.child for p in pipes.values() ],
+                    **std_args)
+        except:
+            for p in pipes.values():
+                if not p.direct:
+                    os.close(p.parent)
+                    os.close(p.child)
+            raise
+        process.pid = process._subproc.pid
+
+        for std in _stds:
+            if std in create_fhs:
+                process.handles[std] = getattr(process._subproc, std)
+
+        # child ends still open, and parent ends not yet owned by a
+        # file or transport, to close if connecting a pipe fails
+        children = [ p.child for p in pipes.values() if not p.direct ]
+        unwrapped = [ p.parent for p in pipes.values() if not p.direct ]
+        opened = []
+
+        async def abort():
+            """Close the pipes opened, kill GnuPG and reap it"""
+            for obj in opened:
+                obj.close()
+            try:
+                process._subproc.kill()
+            except ProcessLookupError:
+                pass
+            # wait() also waits for the standard pipes to be closed
+            if process._subproc.stdin is not None:
+                process._subproc.stdin.close()
+            await process._subproc.wait()
+
+        try:
+            for k, p in pipes.items():
+                if p.direct:
+                    continue
+                children.remove(p.child)
+                os.close(p.child)
+                pipe = os.fdopen(p.parent, _fd_modes[k], 0)
+                unwrapped.remove(p.parent)
+                opened.append(pipe)
+                if _fd_modes[k][0] == 'w':
+                    # StreamReaderProtocol gives the writer flow control;
+                    # its reader is never fed by a write pipe
+                    reader = asyncio.StreamReader()
+                    transport, protocol = await loop.connect_write_pipe(
+                            lambda: asyncio.StreamReaderProtocol(reader),
+                            pipe)
+                    handle = asyncio.StreamWriter(transport, protocol,
+                                                  reader, loop)
+                else:
+                    handle = asyncio.StreamReader()
+                    transport, protocol = await loop.connect_read_pipe(
+                            lambda: asyncio.StreamReaderProtocol(handle),
+                            pipe)
+                # the transport closes the pipe from now on
+                opened[-1] = transport
+                process.handles[k] = handle
+        except:
+            for fd in children + unwrapped:
+                os.close(fd)
+            await abort()
+            raise
+
+        if handle_passphrase:
+            passphrase_fh = process.handles.pop('passphrase')
+            try:
+                passphrase = await loop.run_in_executor(
+                        None, provider.get_passphrase)
+                passphrase_fh.write(_to_bytes(passphrase))
+                await passphrase_fh.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass    # GnuPG didn't want it; wait() reports why
+            except:
+                await abort()
+                raise
+            passphrase_fh.close()
+
+        return process
+
+
+class AsyncProcess(object):
+    """Objects of this class encompass properties of a GnuPG
+    process spawned by AsyncGnuPG.run().
+
+    Data Attributes
+
+    handles -- This is a map of filehandle-names to the asyncio
+    StreamReaders and StreamWriters connected to the running
+    GnuPG process, for the handles requested in create_fhs.
+
+    pid -- The PID of the spawned GnuPG process.
+    """
+    __slots__ = ['handles', 'pid', '_subproc']
+
+    def __init__(self):
+        self.handles = {}
+        self.pid     = None
+        self._subproc = None
+
+    async def wait(self):
+        """Wait on the process to exit, allowing for child cleanup.
+        Will raise an IOError if the process exits non-zero."""
+
+        e = await self._subproc.wait()
+        if e != 0:
+            raise IOError("GnuPG exited non-zero, with code %d" % e)
+
+
+def _run_doctests():
+    import doctest, AsyncGnuPGInterface
+    return doctest.testmod(AsyncGnuPGInterface)
+
+if __name__ == '__main__':
+    _run_doctests()
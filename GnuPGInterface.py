@@ -140,15 +140,13 @@ ciphertext.
 ...         self.options.extra_args.append('--no-secmem-warning')
 ...
 ...     def encrypt_string(self, string, recipients):
-...        gnupg.options.recipients = recipients   # a list!
+...        self.options.recipients = recipients   # a list!
 ...
-...        proc = gnupg.run(['--encrypt'], create_fhs=['stdin', 'stdout'])
+...        proc = self.run(['--encrypt'], create_fhs=['stdin', 'stdout'])
 ...
-...        proc.handles['stdin'].write(string)
-...        proc.handles['stdin'].close()
-...
-...        output = proc.handles['stdout'].read()
-...        proc.handles['stdout'].close()
+...        # communicate() writes stdin while reading stdout, so large
+...        # strings can't deadlock on full pipe buffers
+...        output = proc.communicate(input=string)['stdout']
 ...
 ...        proc.wait()
 ...        return output
@@ -220,10 +218,26 @@ Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 or see http://www.gnu.org/copyleft/lesser.html
 """
 
+import binascii
+import collections
+import copy
 import errno
+import hashlib
+import io
+import itertools
+import json
+import mmap
 import os
+import re
+import select
+import shutil
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 if sys.platform == "win32":
     # Required windows-only imports
@@ -243,6 +257,36 @@ except ImportError:
     # import success/failure is checked before use
     pass
 
+try:
+    import resource
+except ImportError:
+    # Windows; rlimits are not available
+    resource = None
+
+try:
+    import selectors
+except ImportError:
+    # Python pre-3.4, fall back to select.select()
+    selectors = None
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+try:
+    _clock = time.monotonic
+except AttributeError:
+    # Python pre-3.3
+    _clock = time.time
+
+try:
+    _TimeoutBase = TimeoutError
+except NameError:
+    # Python 2
+    _TimeoutBase = IOError
+
 __author__   = "Frank J. Tobin, ftobin@neverending.org"
 __version__  = "0.3.2"
 __revision__ = "$Id$"
@@ -268,6 +312,615 @@ _fd_options = { 'passphrase': '--passphrase-fd',
                 'command':    '--command-fd',
                 'attribute':  '--attribute-fd' }
 
+
+def _get_maxfd():
+    """Return one more than the highest possible file descriptor"""
+    try:
+        maxfd = os.sysconf("SC_OPEN_MAX")
+        if maxfd == -1:
+            maxfd = 256
+    except:
+        maxfd = 256
+    return maxfd
+
+def _find_fd_dir():
+    """Return a directory listing the open file descriptors of this process,
+    or None if the system doesn't have a trustworthy one.
+
+    /dev/fd is only trusted when it is a separate filesystem from /dev,
+    since without fdescfs mounted (e.g. on FreeBSD) it always lists 0-2."""
+    if os.path.isdir('/proc/self/fd'):
+        return '/proc/self/fd'
+    try:
+        if os.stat('/dev/fd').st_dev != os.stat('/dev').st_dev:
+            return '/dev/fd'
+    except OSError:
+        pass
+    return None
+
+def _list_fds_dir():
+    """Return the open file descriptors by listing _fd_dir"""
+    fds = []
+    for name in os.listdir(_fd_dir):
+        try:
+            fds.append(int(name))
+        except ValueError:
+            pass
+    return fds
+
+def _list_fds_scan():
+    """Return the open file descriptors above 2 by probing every possible
+    descriptor, which costs SC_OPEN_MAX system calls."""
+    fds = []
+    for fd in range(3, _get_maxfd()):
+        try:
+            # Note:  Can't use lseek, can cause nul byte in pipes
+            #        where the position has not been set by read/write
+            #os.lseek(fd, os.SEEK_CUR, 0)
+            os.tcgetpgrp(fd)
+        except OSError:
+            # FIXME:  When support for Python 2.5 is dropped, use 'as'
+            oe = sys.exc_info()[1]
+            if oe.errno == errno.EBADF:
+                continue
+
+        fds.append(fd)
+    return fds
+
+# functions returning the list of open file descriptors, by strategy name
+_fd_listers = { 'listdir': _list_fds_dir,
+                'scan':    _list_fds_scan }
+
+def _select_fd_strategy():
+    """Choose how descriptors not meant for GnuPG are kept out of the child
+    when extra filehandles (passphrase, status, ...) are passed to it:
+
+    * pass_fds -- subprocess closes them in the child itself, using
+      close_range(2) or a directory listing, without a preexec_fn.
+      From Python 3.10 subprocess then starts the child with vfork(2).
+    * inheritable -- rely on descriptors being non-inheritable by
+      default (PEP 446), and only make those passed to GnuPG inheritable
+      while it is started.  Without close_fds or a preexec_fn, subprocess
+      can start the child with posix_spawn(3), so no Python code runs
+      in it and the parent's page tables aren't copied.  Descriptors the
+      program made inheritable itself are passed to GnuPG too, so this is
+      never chosen automatically; see GnuPG.fd_strategy.
+    * listdir  -- list _fd_dir in the parent, close in a preexec_fn.
+    * scan     -- probe every descriptor below SC_OPEN_MAX in the parent,
+      close in a preexec_fn.
+    """
+    if sys.platform == "win32":
+        return None
+    if sys.version_info >= (3, 2):
+        return 'pass_fds'
+    if _fd_dir is not None:
+        return 'listdir'
+    return 'scan'
+
+_fd_dir = _find_fd_dir()
+_fd_strategy = _select_fd_strategy()
+
+# serializes starting GnuPG with the 'inheritable', 'listdir' and 'scan'
+# strategies, so that concurrent starts don't inherit each others'
+# descriptors
+_spawn_lock = threading.Lock()
+
+# full paths of executables, by (name, PATH)
+_which_cache = {}
+
+def _which(call):
+    """Return the full path of the executable call, as found in PATH.
+    posix_spawn(3) is only used for executables given by path."""
+    if os.path.dirname(call) or not hasattr(shutil, 'which'):
+        return call
+    key = (call, os.environ.get('PATH'))
+    path = _which_cache.get(key)
+    if path == None:
+        path = shutil.which(call) or call
+        _which_cache[key] = path
+    return path
+
+# how much to read at a time when multiplexing handles
+_bufsize = 65536
+
+# fcntl command setting the capacity of a pipe (Linux), missing from
+# the fcntl module before Python 3.10
+if sys.platform.startswith('linux'):
+    _F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+else:
+    _F_SETPIPE_SZ = None
+
+def _to_bytes(data):
+    """Encode str data for writing to GnuPG, leave anything else alone"""
+    if sys.version_info >= (3, 0) and isinstance(data, str):
+        return data.encode()
+    return data
+
+def _pipe():
+    """Return a pipe whose ends are both close-on-exec, so that processes
+    started by other threads can't inherit them.  Ends passed to GnuPG
+    are only made inheritable in the child (see _launch_process()).
+    Uses pipe2(2) where available, so there is no window in which a
+    concurrent fork sees them inheritable."""
+    if hasattr(os, 'pipe2'):
+        return os.pipe2(os.O_CLOEXEC)
+    pipe = os.pipe()
+    if "fcntl" in globals():
+        for fd in pipe:
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    return pipe
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _Poller(object):
+    """Readiness notification for a changing set of file descriptors,
+    using selectors where available and select.select() otherwise."""
+
+    __slots__ = ['_selector', '_readers', '_writers']
+
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+        if selectors is not None:
+            self._selector = selectors.DefaultSelector()
+        else:
+            self._selector = None
+
+    def __len__(self):
+        return len(self._readers) + len(self._writers)
+
+    def register(self, fd, writing):
+        if writing:
+            self._writers.add(fd)
+            events = getattr(selectors, 'EVENT_WRITE', None)
+        else:
+            self._readers.add(fd)
+            events = getattr(selectors, 'EVENT_READ', None)
+        if self._selector is not None:
+            self._selector.register(fd, events)
+
+    def unregister(self, fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+        if self._selector is not None:
+            self._selector.unregister(fd)
+
+    def poll(self, timeout=None):
+        """Return a (readable, writable) pair of lists of descriptors"""
+        if self._selector is None:
+            return select.select(list(self._readers), list(self._writers),
+                                 [], timeout)[:2]
+        readable = []
+        writable = []
+        for key, events in self._selector.select(timeout):
+            if key.fd in self._readers:
+                readable.append(key.fd)
+            else:
+                writable.append(key.fd)
+        return readable, writable
+
+    def close(self):
+        if self._selector is not None:
+            self._selector.close()
+
+
+def _multiplex(writers, readers, bufsize=_bufsize, process=None,
+               idle_timeout=None):
+    """Drive several handles connected to GnuPG at once, without blocking
+    on any of them.
+
+    writers is a dictionary mapping handle names to (file, chunks) pairs,
+    where chunks is an iterable of bytes-like objects to write to the
+    file.  A file is closed once its chunks are exhausted or GnuPG closes
+    the other end.  readers is a dictionary mapping handle names to files
+    which are read until EOF, then closed.
+
+    If process is given, the bytes written and read and the closing of
+    handles are recorded in that Process (see Process.timings), and if
+    it has an idle timeout (see GnuPG.idle_timeout) and no handle is
+    ready for that long, GnuPG is stopped and ProcessTimeout raised.
+    Without a process, idle_timeout is used instead, and stopping GnuPG
+    is left to the caller.
+
+    Yields a (name, data) pair for each chunk read.  Any file still open
+    when the generator is closed early is closed too.
+    """
+    poller = _Poller()
+    files = {}
+    pending = {}
+
+    try:
+        for name, (fh, chunks) in writers.items():
+            fh.flush()
+            fd = fh.fileno()
+            _set_nonblocking(fd)
+            files[fd] = (name, fh, iter(chunks))
+            pending[fd] = None
+            poller.register(fd, 1)
+
+        for name, fh in readers.items():
+            fd = fh.fileno()
+            files[fd] = (name, fh, None)
+            poller.register(fd, 0)
+
+        if process is not None:
+            idle_timeout = process._idle_timeout
+
+        while len(poller) > 0:
+            readable, writable = poller.poll(idle_timeout)
+            if idle_timeout is not None and not readable and not writable:
+                if process is not None:
+                    process._expire('idle')
+                raise ProcessTimeout("no I/O with GnuPG for %g seconds"
+                                     % idle_timeout)
+
+            for fd in writable:
+                name, fh, chunks = files[fd]
+                data = pending[fd]
+                while not data:
+                    data = next(chunks, None)
+                    if data is None:
+                        break
+                    data = memoryview(_to_bytes(data))
+
+                written = 0
+                if data is not None:
+                    try:
+                        written = os.write(fd, data)
+                    except OSError:
+                        oe = sys.exc_info()[1]
+                        if oe.errno == errno.EAGAIN:
+                            pass
+                        elif oe.errno == errno.EPIPE:
+                            # GnuPG stopped reading; wait() reports why
+                            data = None
+                        else:
+                            raise
+
+                if process is not None:
+                    process.bytes_in += written
+
+                if data is None:
+                    poller.unregister(fd)
+                    del files[fd]
+                    fh.close()
+                    if process is not None:
+                        process._closed(name)
+                else:
+                    pending[fd] = data[written:]
+
+            for fd in readable:
+                name, fh, chunks = files[fd]
+                data = os.read(fd, bufsize)
+                if data:
+                    if process is not None:
+                        process._read(name, data)
+                    yield name, data
+                else:
+                    poller.unregister(fd)
+                    del files[fd]
+                    fh.close()
+    finally:
+        poller.close()
+        for name, fh, chunks in files.values():
+            fh.close()
+
+def _relay_method(src, dst):
+    """Return the fastest way to move bytes from descriptor src to
+    descriptor dst without them passing through Python:
+
+    * splice -- splice(2), when either end is a pipe (Linux)
+    * sendfile -- sendfile(2), from a regular file (Linux)
+    * copy -- read into a reused buffer and write it out
+    """
+    src_mode = os.fstat(src).st_mode
+    dst_mode = os.fstat(dst).st_mode
+    if hasattr(os, 'splice') \
+       and (stat.S_ISFIFO(src_mode) or stat.S_ISFIFO(dst_mode)):
+        return 'splice'
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux') \
+       and stat.S_ISREG(src_mode):
+        return 'sendfile'
+    return 'copy'
+
+def _relay(src, dst, count=None, bufsize=_bufsize, method=None,
+           progress=None):
+    """Move bytes from descriptor src to descriptor dst until src reaches
+    EOF or, if count is given, count bytes have been moved.  Returns the
+    number of bytes moved.
+
+    Both descriptors must be in blocking mode.  method is as returned by
+    _relay_method(), which is used by default; if the kernel refuses
+    splice or sendfile for these descriptors, copying is used instead.
+    progress, if given, is called with the size of every move.
+    Stops early without error if the reader of dst goes away (EPIPE).
+    """
+    if method == None:
+        method = _relay_method(src, dst)
+    view = None
+    total = 0
+    while count == None or total < count:
+        size = bufsize
+        if count != None:
+            size = min(size, count - total)
+
+        try:
+            if method == 'splice':
+                moved = os.splice(src, dst, size)
+            elif method == 'sendfile':
+                moved = os.sendfile(dst, src, None, size)
+            else:
+                if view == None:
+                    view = memoryview(bytearray(bufsize))
+                moved = os.readv(src, [view[:size]])
+                written = 0
+                while written < moved:
+                    written += os.write(dst, view[written:moved])
+        except OSError:
+            oe = sys.exc_info()[1]
+            if oe.errno == errno.EPIPE:
+                break
+            if method != 'copy' and total == 0 \
+               and oe.errno in (errno.EINVAL, errno.ENOSYS):
+                method = 'copy'
+                continue
+            raise
+
+        if moved == 0:
+            break
+        total += moved
+        if progress != None:
+            progress(moved)
+    return total
+
+def _is_path(obj):
+    """Return true if obj is a file system path rather than data"""
+    if isinstance(obj, str):
+        return 1
+    return hasattr(os, 'PathLike') and isinstance(obj, os.PathLike)
+
+def _fspath(path):
+    if hasattr(os, 'fspath'):
+        return os.fspath(path)
+    return path
+
+# plaintext bytes per segment of encrypt_segmented() containers
+_segment_size = 16 * 1024 * 1024
+
+# first and last bytes of a segmented container; the trailer also holds
+# the offset and length of the encrypted index
+_segment_magic = b'GPGSEGv1'
+_segment_trailer = '>QQ8s'
+
+def _segment_output(result):
+    """Return the standard output of the JobResult of a segment,
+    raising an error if its GnuPG process failed"""
+    if result.error != None:
+        raise result.error
+    if result.returncode != 0:
+        raise IOError("GnuPG exited non-zero, with code %d, on segment %d"
+                      % (result.returncode, result.index))
+    return result.outputs['stdout']
+
+# seconds Process.cancel() gives GnuPG to exit before killing it
+_cancel_grace = 1.0
+
+# how often attached files are dropped from the page cache behind GnuPG
+_drop_interval = 0.05
+
+# size of the memory mappings map_chunks() moves through a file, and how
+# far GnuPG gets through an attached file between page cache drops
+_map_window = 64 * 1024 * 1024
+
+def _fadvise(fd, advice, offset=0, length=0):
+    """Give the kernel the posix_fadvise(2) hint named advice (e.g.
+    'POSIX_FADV_SEQUENTIAL') about fd, where supported"""
+    if not hasattr(os, 'posix_fadvise') or not hasattr(os, advice):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError:
+        pass    # not a regular file
+
+def _rlimit_preexec_fn(preexec_fn, limits):
+    """Return a function calling preexec_fn (if any) then setting the
+    list of (resource, (soft, hard)) limits, to run in the child before
+    GnuPG is executed"""
+    def set_rlimits():
+        if preexec_fn != None:
+            preexec_fn()
+        for res, limit in limits:
+            resource.setrlimit(res, limit)
+    return set_rlimits
+
+def _wait_exit(subproc, timeout):
+    """Return true once subproc has exited, waiting up to timeout
+    seconds for it to"""
+    try:
+        subproc.wait(timeout=timeout)
+        return 1
+    except TypeError:
+        # Python 2, without timeouts
+        deadline = _clock() + timeout
+        while subproc.poll() == None:
+            if _clock() >= deadline:
+                return 0
+            time.sleep(0.01)
+        return 1
+    except subprocess.TimeoutExpired:
+        return 0
+
+def _advise_attached(process, attached):
+    """Advise the regular files of the (name, file) pairs attached as
+    read sequentially, and drop them from the page cache behind GnuPG
+    from a thread of process (see GnuPG.fadvise)"""
+    files = {}
+    for name, fh in attached:
+        fd = fh.fileno()
+        try:
+            if not stat.S_ISREG(os.fstat(fd).st_mode):
+                continue
+        except OSError:
+            continue
+        _fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+        # GnuPG writes the handles this process would read
+        files[fd] = _fd_modes[name][0] == 'r'
+    if not files or not hasattr(os, 'posix_fadvise'):
+        return
+
+    def drop_behind():
+        # GnuPG shares the file offsets of attached files, so they
+        # tell how far it got
+        dropped = dict.fromkeys(files, 0)
+        while 1:
+            exited = _wait_exit(process._subproc, _drop_interval)
+            for fd, written in list(files.items()):
+                try:
+                    offset = os.lseek(fd, 0, os.SEEK_CUR)
+                    if offset - dropped[fd] < _map_window and not exited:
+                        continue
+                    if written:
+                        # only clean pages can be dropped
+                        os.fdatasync(fd)
+                except OSError:
+                    del files[fd]   # closed by the caller
+                    continue
+                _fadvise(fd, 'POSIX_FADV_DONTNEED', 0, offset)
+                dropped[fd] = offset
+            if exited:
+                return
+    process._start_thread(drop_behind)
+
+def map_chunks(source, chunk_size=_bufsize, drop_cache=0):
+    """Generator yielding the contents of a file chunk_size bytes at a
+    time, as memoryviews of a memory mapping of it, so that it can be
+    given to GnuPG.stream() while also being checksummed, split or teed
+    in Python, without copying it into bytes objects.
+
+    source is a path or a binary file, which is read from its start.
+    The file is mapped _map_window (64 MiB) at a time and advised as
+    read sequentially.  If drop_cache is true, its pages are dropped
+    from the page cache once read, so that reading a huge file doesn't
+    evict everything else cached.
+
+    Each memoryview is released when the next one is asked for; use
+    bytes(chunk) to keep its data.  The file mustn't shrink while it is
+    being read, or the process gets SIGBUS.
+
+        digest = hashlib.sha256()
+        def chunks():
+            for chunk in GnuPGInterface.map_chunks('backup.tar'):
+                digest.update(chunk)
+                yield chunk
+        for data in gnupg.stream(['--encrypt'], chunks()):
+            ...
+    """
+    opened = None
+    if _is_path(source):
+        source = opened = open(_fspath(source), 'rb')
+    fd = source.fileno()
+    try:
+        size = os.fstat(fd).st_size
+        _fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+        offset = 0
+        while offset < size:
+            length = min(_map_window, size - offset)
+            mapping = mmap.mmap(fd, length, access=mmap.ACCESS_READ,
+                                offset=offset)
+            if hasattr(mapping, 'madvise'):
+                mapping.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapping)
+            try:
+                for start in range(0, length, chunk_size):
+                    chunk = view[start:start + chunk_size]
+                    yield chunk
+                    chunk.release()
+            finally:
+                view.release()
+                try:
+                    mapping.close()
+                except BufferError:
+                    pass    # unmapped once the last view of it is gone
+            # the pages of a mapping still in use can't be dropped, so
+            # only drop those of previous windows
+            if drop_cache and offset:
+                _fadvise(fd, 'POSIX_FADV_DONTNEED', 0, offset)
+            offset += length
+        if drop_cache:
+            _fadvise(fd, 'POSIX_FADV_DONTNEED', 0, size)
+    finally:
+        if opened != None:
+            opened.close()
+
+# GnuPG error codes of a key listing matching nothing
+_no_key_errors = (9, 17)    # GPG_ERR_NO_PUBKEY, GPG_ERR_NO_SECKEY
+
+def _no_key_matched(result):
+    """Return true if the errors in the StatusResult result all report
+    that no key matched a key listing's patterns"""
+    if not result.errors:
+        return 0
+    for event in result.errors:
+        if event.keyword != 'ERROR' or event.location != 'keylist.getkey':
+            return 0
+        try:
+            # the code may carry its error source in the high bits
+            code = int(event.code.split()[0]) & 0xffff
+        except (AttributeError, IndexError, ValueError):
+            return 0
+        if code not in _no_key_errors:
+            return 0
+    return 1
+
+def _discard(fh):
+    """Read fh to the end, throwing the data away, and close it"""
+    try:
+        while fh.read(_bufsize):
+            pass
+    finally:
+        fh.close()
+
+def _check_fhs(create_fhs, attach_fhs):
+    """Validate the filehandle names given to run()"""
+    for fh_name in list(create_fhs) + list(attach_fhs.keys()):
+        if fh_name not in _fd_modes:
+            raise KeyError("unrecognized filehandle name '%s'; must be one of %s" \
+                  % (fh_name, list(_fd_modes.keys())))
+
+    for fh_name in create_fhs:
+        # make sure the user doesn't specify a filehandle
+        # to be created *and* attached
+        if fh_name in attach_fhs:
+            raise ValueError("cannot have filehandle '%s' in both create_fhs and attach_fhs" \
+                  % fh_name)
+
+def _get_fd_args(pipes):
+    """Return the GnuPG options passing the child end of each non-standard
+    pipe in the pipes dictionary (mapping handle names to Pipes)"""
+    fd_args = []
+    for k, p in pipes.items():
+        # set command-line options for non-standard fds
+        if k in _stds:
+            continue
+
+        if sys.platform == "win32":
+            # Must pass inheritable os file handle
+            curproc = _subprocess.GetCurrentProcess()
+            pchandle = msvcrt.get_osfhandle(p.child)
+            pcihandle = _subprocess.DuplicateHandle(
+                    curproc, pchandle, curproc, 0, 1,
+                    _subprocess.DUPLICATE_SAME_ACCESS)
+            fdarg = pcihandle.Detach()
+        else:
+            # Must pass file descriptor
+            fdarg = p.child
+        fd_args.extend([ _fd_options[k], str(fdarg) ])
+    return fd_args
+
+
 class GnuPG(object):
     """Class instances represent GnuPG.
 
@@ -283,18 +936,88 @@ class GnuPG(object):
       and no passphrase file object is sent in to run(),
       then GnuPG instnace will take care of sending the passphrase to
       GnuPG, the executable instead of having the user sent it in manually.
+      It may be a string, a callable returning the passphrase (called
+      from a background thread for each run), or a PassphraseProvider
+      such as LoopbackPassphrase or PresetPassphrase.  run() doesn't
+      wait for the passphrase to be read.
 
     * options -- Object of type GnuPGInterface.Options.
       Attribute-setting in options determines
       the command-line options used when calling GnuPG.
+
+    * fd_strategy -- How GnuPG is started and kept from inheriting
+      file descriptors it wasn't given, one of 'pass_fds', 'inheritable',
+      'listdir' or 'scan' (see _select_fd_strategy()).  Defaults to None,
+      meaning the best strategy the platform supports.  'inheritable'
+      lets subprocess use posix_spawn(3), which is fastest on Pythons
+      before 3.10 in processes with large memory, but requires the
+      program not to leave unrelated descriptors inheritable.
+
+    * pipe_size -- Capacity in bytes to give the pipes of created
+      filehandles, on Linux, instead of the kernel default of 64 KiB.
+      Larger pipes let GnuPG and this process move more data per system
+      call and context switch.  Sizes above /proc/sys/fs/pipe-max-size
+      need privileges; if the size can't be set, the default is kept.
+      Defaults to None.
+
+    * buffering -- The buffering argument created filehandles are
+      opened with, as for open().  0 gives unbuffered raw files, whose
+      readinto() method reads straight into a preallocated buffer.
+      Defaults to -1, Python's default buffering.
+
+    * hooks -- List of callables, each called as
+      hook(process, event, timestamp) as every Process run() starts
+      goes through the events listed in Process.timings.  timestamp is
+      from a monotonic clock.  An exception raised by a hook while run()
+      starts GnuPG is raised by run(), after GnuPG is killed and its
+      filehandles closed.  Defaults to an empty list.
+
+    * fadvise -- If true, regular files given to run() in attach_fhs
+      are advised to the kernel as read sequentially, and a background
+      thread drops their pages from the page cache behind GnuPG as it
+      goes (writing out those of files GnuPG writes first), so that
+      encrypting a huge file doesn't evict everything else cached.
+      Process.wait() may then take up to 50ms longer.  Has no effect
+      without os.posix_fadvise() (Python 3.3 on POSIX).  Defaults to 0.
+
+    * timeout -- Seconds each GnuPG process run() starts may run for.
+      Past that deadline, it is stopped (see Process.cancel()), so its
+      handles see EOF, and Process.wait() raises ProcessTimeout.
+      Defaults to None, for no deadline.
+
+    * idle_timeout -- Seconds Process.communicate() and stream() wait
+      for GnuPG to read or write anything before stopping it and
+      raising ProcessTimeout, e.g. when it is stuck on a pinentry or a
+      dead keyserver.  Defaults to None, to wait indefinitely.
+
+    * rlimits -- Dictionary mapping resource.RLIMIT_* constants to the
+      limits to give GnuPG processes, as a (soft, hard) pair or a
+      single number for both, e.g. { resource.RLIMIT_CPU: 60 }.  They
+      are set in the child before GnuPG is executed, so they hold from
+      its start, which keeps subprocess from using posix_spawn(3).
+      Defaults to an empty dictionary.
+
+    Once configured, a GnuPG object can be shared between threads:
+    run() doesn't modify it or the arguments it is given, and the pipes
+    it creates can't be inherited by processes other threads start.
     """
 
-    __slots__ = ['call', 'passphrase', 'options']
+    __slots__ = ['call', 'passphrase', 'options', 'fd_strategy',
+                 'pipe_size', 'buffering', 'hooks', 'fadvise', 'timeout',
+                 'idle_timeout', 'rlimits']
 
     def __init__(self):
         self.call = 'gpg'
         self.passphrase = None
         self.options = Options()
+        self.fd_strategy = None
+        self.pipe_size = None
+        self.buffering = -1
+        self.hooks = []
+        self.fadvise = 0
+        self.timeout = None
+        self.idle_timeout = None
+        self.rlimits = {}
 
     def run(self, gnupg_commands, args=None, create_fhs=None, attach_fhs=None):
         """Calls GnuPG with the list of string commands gnupg_commands,
@@ -337,7 +1060,9 @@ class GnuPG(object):
 
         Using attach_fhs also helps avoid system buffering
         issues that can arise when using create_fhs, which
-        can cause the process to deadlock.
+        can cause the process to deadlock.  Alternatively, use
+        Process.communicate() to drive all created filehandles at once,
+        or stream() to pipe large inputs through GnuPG incrementally.
 
         If not mentioned in create_fhs or attach_fhs,
         GnuPG filehandles which are a std* (stdin, stdout, stderr)
@@ -359,9 +1084,14 @@ class GnuPG(object):
         and can be written to.
         """
 
+        # copies, so that the caller's arguments are left alone and a
+        # GnuPG object can be shared between threads
         if args == None: args = []
         if create_fhs == None: create_fhs = []
         if attach_fhs == None: attach_fhs = {}
+        create_fhs = list(create_fhs)
+        attach_fhs = dict(attach_fhs)
+        attached = list(attach_fhs.items())
 
         for std in _stds:
             if std not in attach_fhs \
@@ -369,63 +1099,722 @@ class GnuPG(object):
                 attach_fhs.setdefault(std, getattr(sys, std))
 
         handle_passphrase = 0
+        provider = _passphrase_provider(self.passphrase)
 
-        if self.passphrase != None \
+        if provider != None \
            and 'passphrase' not in attach_fhs \
            and 'passphrase' not in create_fhs:
-            handle_passphrase = 1
-            create_fhs.append('passphrase')
+            provider.prepare(self)
+            gnupg_commands = provider.get_args() + list(gnupg_commands)
+            if provider.uses_fd:
+                handle_passphrase = 1
+                create_fhs.append('passphrase')
 
         process = self._attach_fork_exec(gnupg_commands, args,
                                          create_fhs, attach_fhs)
 
-        if handle_passphrase:
-            passphrase_fh = process.handles['passphrase']
-            if sys.version_info >= (3, 0) and isinstance(self.passphrase, str):
-                passphrase_fh.write( self.passphrase.encode() )
-            else:
-                passphrase_fh.write( self.passphrase )
-            passphrase_fh.close()
-            del process.handles['passphrase']
+        try:
+            if self.fadvise:
+                _advise_attached(process, attached)
+
+            if handle_passphrase:
+                provider.deliver(process, process.handles.pop('passphrase'))
+        except:
+            # e.g. a hook raising on 'passphrase_sent'
+            process._abort()
+            raise
 
         return process
 
 
-    def _attach_fork_exec(self, gnupg_commands, args, create_fhs, attach_fhs):
-        """This is like run(), but without the passphrase-helping
-        (note that run() calls this)."""
+    def stream(self, gnupg_commands, chunks, args=None, chunk_size=_bufsize):
+        """Generator running GnuPG over an input of any size in constant
+        memory, yielding its standard output in chunks of at most
+        chunk_size bytes as they become available.
 
-        process = Process()
+        gnupg_commands and args are as for run().  chunks is an iterable
+        of bytes-like objects fed to GnuPG's standard input, or a file
+        opened for reading in binary mode, which is read chunk_size bytes
+        at a time.  Input is only pulled from chunks as GnuPG consumes it,
+        so at most one input and one output chunk are held at a time.
+        map_chunks() feeds a file through a memory mapping instead.
+
+        For example, to encrypt a large file to another file:
 
-        for fh_name in create_fhs + list(attach_fhs.keys()):
-            if fh_name not in _fd_modes:
-                raise KeyError("unrecognized filehandle name '%s'; must be one of %s" \
-                      % (fh_name, list(_fd_modes.keys())))
+            src = open('backup.tar', 'rb')
+            dst = open('backup.tar.gpg', 'wb')
+            for data in gnupg.stream(['--encrypt'], src):
+                dst.write(data)
 
-        for fh_name in create_fhs:
-            # make sure the user doesn't specify a filehandle
-            # to be created *and* attached
-            if fh_name in attach_fhs:
-                raise ValueError("cannot have filehandle '%s' in both create_fhs and attach_fhs" \
-                      % fh_name)
+        GnuPG's standard error is inherited.  Once all output has been
+        yielded, the process is waited on, so an IOError is raised if it
+        exits non-zero.  If the generator is closed early, GnuPG's
+        handles are closed and the process is reaped.
+        """
+        if hasattr(chunks, 'read'):
+            fh = chunks
+            chunks = iter(lambda: fh.read(chunk_size), b'')
+
+        process = self.run(gnupg_commands, args,
+                           create_fhs=['stdin', 'stdout'])
+        io = _multiplex({ 'stdin': (process.handles['stdin'], chunks) },
+                        { 'stdout': process.handles['stdout'] },
+                        chunk_size, process)
+        finished = 0
+        try:
+            for name, data in io:
+                yield data
+            finished = 1
+        finally:
+            if not finished:
+                io.close()
+                try:
+                    process.wait()
+                except IOError:
+                    pass
+
+        process.wait()
+
+    def relay(self, gnupg_commands, source, destination, args=None,
+              count=None):
+        """Run GnuPG over data moved from source to its standard input,
+        and from its standard output to destination, by background
+        threads, returning the Process.
+
+        source and destination are files, sockets or descriptors, in
+        blocking mode.  Data is moved with splice(2) where available,
+        so it never enters Python; otherwise sendfile(2) or a reused
+        buffer is used (see _relay_method()).  If count is given, only
+        that many bytes are read from source, leaving the rest of it
+        for the caller, e.g. one message of a socket stream.  Neither
+        source nor destination is closed.
+
+        Where GnuPG can simply be given the whole of a file or socket,
+        attach_fhs avoids the relay altogether.
+
+        Process.wait() waits for the relays to finish, then raises
+        IOError if GnuPG exited non-zero, or any error a relay had.
+        """
+        if not isinstance(source, int): source = source.fileno()
+        if not isinstance(destination, int): destination = destination.fileno()
+
+        process = self.run(gnupg_commands, args,
+                           create_fhs=['stdin', 'stdout'])
+        stdin = process.handles.pop('stdin')
+        stdout = process.handles.pop('stdout')
+
+        def feed(n):
+            process.bytes_in += n
+
+        def drain(n):
+            process.bytes_out += n
+            process._event('first_output')
+
+        def relay_in():
+            try:
+                _relay(source, stdin.fileno(), count, process._bufsize,
+                       progress=feed)
+            finally:
+                stdin.close()
+                process._event('stdin_closed')
+
+        def relay_out():
+            try:
+                _relay(stdout.fileno(), destination, None, process._bufsize,
+                       progress=drain)
+            finally:
+                stdout.close()
+
+        process._start_thread(relay_in)
+        process._start_thread(relay_out)
+        return process
+
+    def encrypt_many(self, items, tmpdir=None):
+        """Encrypt many payloads with as few GnuPG processes as possible,
+        returning the list of ciphertexts in the order of items.
+
+        items is an iterable of (payload, recipients) pairs, where payload
+        is a bytes-like object and recipients a list as would be set in
+        options.recipients.  Payloads are written to files in a temporary
+        directory (created in tmpdir, if given) and each distinct set of
+        recipients is encrypted by a single 'gpg --encrypt --multifile'
+        process, which reads the file names from its standard input.
+
+        Raises IOError if any GnuPG process fails.
+        """
+        armor = self.options.armor or '--armor' in self.options.extra_args \
+                or '-a' in self.options.extra_args
+        if armor:
+            suffix = '.asc'
+            commands = ['--yes', '--encrypt', '--multifile']
+        else:
+            suffix = '.gpg'
+            # so that armor set in gpg.conf can't change the file names
+            commands = ['--yes', '--no-armor', '--encrypt', '--multifile']
+
+        groups = collections.OrderedDict()
+        directory = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            count = 0
+            for payload, recipients in items:
+                path = os.path.join(directory, str(count))
+                f = open(path, 'wb')
+                try:
+                    f.write(payload)
+                finally:
+                    f.close()
+                groups.setdefault(tuple(recipients), []).append(path)
+                count += 1
+
+            for recipients, paths in groups.items():
+                gnupg = copy.copy(self)
+                gnupg.options = self.options.copy()
+                gnupg.options.recipients = list(recipients)
+                process = gnupg.run(commands, create_fhs=['stdin'])
+                process.communicate(input='\n'.join(paths) + '\n')
+                process.wait()
+
+            ciphertexts = []
+            for i in range(count):
+                try:
+                    f = open(os.path.join(directory, str(i)) + suffix, 'rb')
+                except EnvironmentError:
+                    raise IOError("GnuPG wrote no ciphertext for item %d"
+                                  % i)
+                try:
+                    ciphertexts.append(f.read())
+                finally:
+                    f.close()
+            return ciphertexts
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def verify_many(self, items, size=None, tmpdir=None, cache=None):
+        """Verify many detached signatures with up to size concurrent
+        GnuPG processes (by default the number of CPUs), returning a list
+        of Verifications in the order of items.
+
+        items is an iterable of (signature, data) pairs, each either a
+        path or a bytes-like object.  Data given as a path is read by
+        GnuPG itself; as bytes, it is written to GnuPG's standard input.
+        Signatures given as bytes are written to temporary files (in
+        tmpdir, if given), removed once verified.  Verdicts are taken
+        from the status filehandle, so no output is parsed by hand.
+
+        If cache is a VerificationCache, pairs it holds a verdict for
+        are not given to GnuPG at all, and new verdicts are added to it.
+        Files given by path are hashed where they are, and only copied
+        to tmpdir (hashed again as they are) when the cache holds no
+        verdict for them, so that GnuPG verifies exactly the bytes the
+        verdict is stored for.
+
+        Items which can't be verified at all, such as ones which are not
+        pairs, get a Verification with the exception as error, so that
+        the list returned always has one Verification per item.
+
+            verdicts = gnupg.verify_many([ ('a.tar.sig', 'a.tar'),
+                                           ('b.tar.sig', 'b.tar') ])
+            bad = [ v for v in verdicts if not v.valid ]
+        """
+        if cache != None:
+            # taken before verifying, so keyring changes made meanwhile
+            # can't be masked by the verdicts stored
+            state = _verification_state(self)
+
+        directory = tempfile.mkdtemp(dir=tmpdir)
+        verifications = []
+        # item index of each job, by job index
+        pending = []
+        # cache key of each item verified by GnuPG, by item index
+        keys = {}
+
+        def prepare(index, signature, data):
+            """Return the Job.prepare function of one item, which sets
+            its verdict and returns None if the cache has one for it.
+            Run by the pool's threads, so that items are hashed and
+            copied in parallel."""
+            def prepare_job(job):
+                sig, dat = signature, data
+                if cache != None:
+                    try:
+                        digests = [ _digest(sig), _digest(dat) ]
+                    except EnvironmentError:
+                        digests = None    # left for GnuPG to report
+                    if digests != None:
+                        verification = cache._get(_verification_key(
+                                digests[0], digests[1], state))
+                        if verification != None:
+                            verifications[index] = verification
+                            return None
+
+                        try:
+                            if _is_path(sig):
+                                sig, digests[0] = _snapshot(
+                                        sig, os.path.join(directory,
+                                                          '%d.sig' % index))
+                            if _is_path(dat):
+                                dat, digests[1] = _snapshot(
+                                        dat, os.path.join(directory,
+                                                          str(index)))
+                        except EnvironmentError:
+                            pass    # left for GnuPG to report
+                        else:
+                            # the copies may differ from the files hashed
+                            keys[index] = _verification_key(
+                                    digests[0], digests[1], state)
+
+                if _is_path(sig):
+                    sig = _fspath(sig)
+                else:
+                    path = os.path.join(directory, '%d.sig' % index)
+                    f = open(path, 'wb')
+                    try:
+                        f.write(sig)
+                    finally:
+                        f.close()
+                    sig = path
+
+                if _is_path(dat):
+                    job.args = [sig, _fspath(dat)]
+                else:
+                    job.args = [sig, '-']
+                    job.input = dat
+                return job
+            return prepare_job
+
+        def jobs():
+            for index, item in enumerate(items):
+                verifications.append(None)
+                try:
+                    signature, data = item
+                except Exception:
+                    # reported for this item alone, like GnuPG failures
+                    verifications[index] = Verification(
+                            error=sys.exc_info()[1])
+                    continue
+                pending.append(index)
+                yield Job(['--verify'], create_fhs=['status', 'stderr'],
+                          prepare=prepare(index, signature, data))
 
-            pipe = os.pipe()
-            # fix by drt@un.bewaff.net noting
-            # that since pipes are unidirectional on some systems,
-            # so we have to 'turn the pipe around'
-            # if we are writing
-            if _fd_modes[fh_name][0] == 'w': pipe = (pipe[1], pipe[0])
+        try:
+            pool = GnuPGPool(self, size)
+            for result in pool.imap_unordered(jobs()):
+                index = pending[result.index]
+                if verifications[index] != None:
+                    continue    # verdict found in the cache
+                verification = Verification(
+                    StatusReader(result.outputs.get('status', b'')).read(),
+                    result.returncode, result.error)
+                verifications[index] = verification
+                key = keys.get(index)
+                if key != None and result.error == None:
+                    cache._put(key, verification)
+
+                for arg in result.job.args:
+                    if os.path.dirname(arg) == directory:
+                        os.remove(arg)
+            return verifications
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def encrypt_segmented(self, source, destination,
+                          segment_size=_segment_size, size=None,
+                          commands=None):
+        """Encrypt source into destination as a segmented container,
+        with up to size concurrent GnuPG processes (by default the number
+        of CPUs), returning the number of plaintext bytes encrypted.
+
+        source is a path or a binary file, read segment_size bytes at a
+        time.  Each segment is encrypted by a GnuPG process of its own
+        with commands (by default ['--encrypt'], to options.recipients),
+        so that encryption isn't bound to the speed of one CPU.
+
+        destination is a path or a binary file, written sequentially:
+        segments are written as they are encrypted, then an index of
+        their offsets, lengths and SHA-256 digests, encrypted the same
+        way, and a trailer locating it.  The container as a whole is not
+        an OpenPGP message, but each segment is; decrypt_segmented()
+        decrypts it, or any range of it, in parallel too.
+
+        Raises IOError if any GnuPG process fails; errors reading source
+        are raised as they are.
+        """
+        if commands == None: commands = ['--encrypt']
+        opened = []
+        if _is_path(source):
+            source = open(_fspath(source), 'rb')
+            opened.append(source)
+        if _is_path(destination):
+            destination = open(_fspath(destination), 'wb')
+            opened.append(destination)
+
+        # (plaintext offset, length, digest) of each segment, by index
+        plaintexts = {}
+
+        def jobs():
+            offset = 0
+            while 1:
+                data = source.read(segment_size)
+                if not data:
+                    break
+                plaintexts[len(plaintexts)] = [ offset, len(data),
+                                                hashlib.sha256(data)
+                                                .hexdigest() ]
+                offset += len(data)
+                yield Job(commands, input=data)
 
-            # Close the parent end in child to prevent deadlock
-            if "fcntl" in globals():
-                fcntl.fcntl(pipe[0], fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            destination.write(_segment_magic)
+            offset = len(_segment_magic)
+            segments = {}
+            for result in GnuPGPool(self, size).imap_unordered(jobs()):
+                ciphertext = _segment_output(result)
+                destination.write(ciphertext)
+                segments[result.index] = [ offset, len(ciphertext) ] \
+                                         + plaintexts[result.index]
+                offset += len(ciphertext)
+            if len(segments) != len(plaintexts):
+                raise IOError("%d of %d segments were not encrypted"
+                              % (len(plaintexts) - len(segments),
+                                 len(plaintexts)))
+
+            index = { 'segment_size': segment_size,
+                      'segments': [ segments[i]
+                                    for i in range(len(segments)) ] }
+            process = self.run(commands,
+                               create_fhs=['stdin', 'stdout', 'stderr'])
+            encrypted = process.communicate(
+                    input=json.dumps(index).encode('utf-8'))['stdout']
+            process.wait()
+            destination.write(encrypted)
+            destination.write(struct.pack(_segment_trailer, offset,
+                                          len(encrypted), _segment_magic))
+            return sum([ segment[3] for segment in index['segments'] ])
+        finally:
+            for f in opened:
+                f.close()
+
+    def decrypt_segmented(self, source, destination, start=0, length=None,
+                          size=None):
+        """Decrypt bytes start to start + length of the plaintext of a
+        container written by encrypt_segmented() (by default all of it)
+        into destination, with up to size concurrent GnuPG processes
+        (by default the number of CPUs), returning the number of bytes
+        written.
+
+        source is a path or a seekable binary file, and destination a
+        path or a binary file, written sequentially.  Only the segments
+        holding the range asked for are decrypted.  Each is checked
+        against the length and digest in the index, so segments swapped,
+        dropped or corrupted within the container are detected.  The
+        index is only protected by its encryption, though: with
+        public-key encryption, anyone holding the recipient's key can
+        write a new one, so this doesn't prove who wrote the container.
+        Segments
+        decrypted ahead of the one being written are held in memory,
+        at most twice size of them.
+
+        Raises IOError if any GnuPG process fails or the container is
+        damaged.
+        """
+        if size == None: size = _cpu_count()
+        opened = []
+        if _is_path(source):
+            source = open(_fspath(source), 'rb')
+            opened.append(source)
+        if _is_path(destination):
+            destination = open(_fspath(destination), 'wb')
+            opened.append(destination)
 
-            process._pipes[fh_name] = Pipe(pipe[0], pipe[1], 0)
+        try:
+            segments = self._read_segment_index(source)
+            total = sum([ segment[3] for segment in segments ])
+            if length == None:
+                end = total
+            else:
+                end = start + length
+            wanted = [ segment for segment in segments
+                       if segment[2] < end and segment[2] + segment[3] > start ]
+
+            # bounds the segments decrypted ahead of the next one written
+            ahead = threading.Semaphore(2 * size)
+            aborted = []
+
+            def jobs():
+                for offset, ciphertext_length, plain_offset, plain_length, \
+                        digest in wanted:
+                    ahead.acquire()
+                    if aborted:
+                        return
+                    source.seek(offset)
+                    data = source.read(ciphertext_length)
+                    if len(data) != ciphertext_length:
+                        raise IOError("truncated segmented container")
+                    yield Job(['--decrypt'], input=data)
+
+            written = 0
+            next_index = 0
+            decrypted = {}
+            results = GnuPGPool(self, size).imap_unordered(jobs())
+            try:
+                for result in results:
+                    plaintext = _segment_output(result)
+                    segment = wanted[result.index]
+                    if len(plaintext) != segment[3] or \
+                       hashlib.sha256(plaintext).hexdigest() != segment[4]:
+                        raise IOError("segment at offset %d doesn't match "
+                                      "the index" % segment[0])
+                    decrypted[result.index] = plaintext
+
+                    # write out whatever is next in order
+                    while next_index in decrypted:
+                        plaintext = decrypted.pop(next_index)
+                        segment = wanted[next_index]
+                        low = max(start - segment[2], 0)
+                        high = min(end - segment[2], segment[3])
+                        destination.write(memoryview(plaintext)[low:high])
+                        written += high - low
+                        next_index += 1
+                        ahead.release()
+            finally:
+                # let a job generator waiting for room give up
+                aborted.append(1)
+                for i in range(len(wanted)):
+                    ahead.release()
+                results.close()
+            if next_index != len(wanted) or \
+               written != max(min(end, total) - start, 0):
+                raise IOError("only %d bytes of the segmented container "
+                              "were decrypted" % written)
+            return written
+        finally:
+            for f in opened:
+                f.close()
+
+    def _read_segment_index(self, source):
+        """Return the list of segments of the segmented container in the
+        seekable binary file source, decrypting its index"""
+        trailer_size = struct.calcsize(_segment_trailer)
+        source.seek(0)
+        header = source.read(len(_segment_magic))
+        source.seek(0, 2)
+        if header != _segment_magic or source.tell() < trailer_size:
+            raise IOError("not a segmented container")
+        source.seek(-trailer_size, 2)
+        offset, length, magic = struct.unpack(_segment_trailer,
+                                              source.read(trailer_size))
+        if magic != _segment_magic:
+            raise IOError("truncated segmented container")
+        source.seek(offset)
+        process = self.run(['--decrypt'],
+                           create_fhs=['stdin', 'stdout', 'stderr'])
+        index = process.communicate(input=source.read(length))['stdout']
+        process.wait()
+        return json.loads(index.decode('utf-8'))['segments']
+
+    def import_keys_bulk(self, source, batch_size=1000, progress=None):
+        """Import the public keys in source (bytes, a path or a binary
+        file, armored or not) batch_size keys per GnuPG process,
+        returning an ImportProgress with the totals.
+
+        Keys are split with split_keys() as they are imported, so only
+        a batch at a time is held in memory.  GnuPG is told not to check
+        the trustdb after every batch; it is checked once at the end.
+        progress, if given, is called with the ImportProgress whenever
+        GnuPG reports on a key with IMPORT_OK or IMPORT_PROBLEM.
+
+        Keys GnuPG rejects are counted as problems rather than failing
+        the import, as a dump usually holds a few.  Raises IOError if a
+        GnuPG process fails before reporting its totals (IMPORT_RES).
+
+        Importing into one large keyring slows down as it grows; a
+        ShardedKeyring imports into smaller ones, in parallel.
+        """
+        keys = split_keys(source)
+        batches = iter(lambda: list(itertools.islice(keys, batch_size)), [])
+        return self._import_batches(batches, progress)
+
+    def _import_batches(self, batches, progress, imported=None):
+        """Import each batch of (fingerprint, data) pairs from the
+        iterable batches, then check the trustdb, returning the
+        ImportProgress.  Fingerprints reported by IMPORT_OK are
+        appended to the list imported, if given."""
+        totals = ImportProgress()
+        for batch in batches:
+            self._import_batch(batch, totals, progress, imported)
+
+        if totals.imported or totals.changed:
+            process = self.run(['--check-trustdb'],
+                               create_fhs=['stdin', 'stdout', 'stderr'])
+            process.communicate()
+            process.wait()
+        return totals
+
+    def _import_batch(self, batch, totals, progress, imported=None):
+        process = self.run(['--no-auto-check-trustdb', '--import'],
+                           create_fhs=['stdin', 'status', 'stderr'])
+        stdin = process.handles.pop('stdin')
+        stderr = process.handles.pop('stderr')
+
+        def feed():
+            try:
+                for fingerprint, data in batch:
+                    stdin.write(data)
+                    totals.bytes += len(data)
+            finally:
+                stdin.close()
 
-        for fh_name, fh in attach_fhs.items():
-            process._pipes[fh_name] = Pipe(fh.fileno(), fh.fileno(), 1)
+        process._start_thread(feed)
+        process._start_thread(lambda: _discard(stderr))
 
-        self._launch_process(process, gnupg_commands, args)
+        finished = 0
+        try:
+            for event in StatusReader(process.handles['status']):
+                if isinstance(event, ImportOkEvent):
+                    totals._add(event)
+                    if imported != None and event.keyword == 'IMPORT_OK':
+                        imported.append(event.fingerprint)
+                    if progress != None:
+                        progress(totals)
+                elif event.keyword == 'IMPORT_RES':
+                    finished = 1
+        finally:
+            process.handles['status'].close()
+        try:
+            process.wait()
+        except IOError:
+            # GnuPG exits non-zero when some keys couldn't be imported
+            if not finished:
+                raise
+
+    def export_keys_bulk(self, destination, patterns=None, progress=None):
+        """Export the public keys matching the list of patterns (all
+        keys by default) to destination, a path or a binary file,
+        returning the number of keys exported.
+
+        The export is written as GnuPG produces it, in constant memory,
+        and always unarmored.  progress, if given, is called with the
+        number of keys and bytes written so far as each key begins.
+        """
+        opened = None
+        if _is_path(destination):
+            destination = opened = open(_fspath(destination), 'wb')
+
+        process = self.run(['--no-armor', '--export'], args=patterns,
+                           create_fhs=['stdin', 'stdout', 'stderr'])
+        process.handles.pop('stdin').close()
+        stderr = process.handles.pop('stderr')
+        process._start_thread(lambda: _discard(stderr))
+
+        keys = 0
+        written = 0
+        try:
+            for tag, packet, body in _iter_packets(process.handles['stdout']):
+                if tag == _tag_public_key:
+                    keys += 1
+                    if progress != None:
+                        progress(keys, written)
+                destination.write(packet)
+                written += len(packet)
+        finally:
+            process.handles['stdout'].close()
+            if opened != None:
+                opened.close()
+        process.wait()
+        return keys
+
+    def list_keys(self, patterns=None):
+        """List the public keys matching the list of patterns (all keys
+        by default), returning a KeyTable.
+
+        The --with-colons listing is parsed as GnuPG produces it, so
+        only the parsed Keys are held in memory.
+        """
+        return self._list_keys('--list-keys', patterns)
+
+    def list_secret_keys(self, patterns=None):
+        """Like list_keys(), but lists secret keys"""
+        return self._list_keys('--list-secret-keys', patterns)
+
+    def _list_keys(self, command, patterns):
+        # --with-fingerprint given twice, as GnuPG before 2.1 only lists
+        # the fingerprints of subkeys then
+        process = self.run(['--with-colons', '--with-fingerprint',
+                            '--with-fingerprint', '--with-keygrip', command],
+                           args=patterns,
+                           create_fhs=['stdin', 'stdout', 'status'])
+        process.handles['stdin'].close()
+        status = process.handles.pop('status')
+        results = []
+        def read_status():
+            try:
+                results.append(StatusReader(status).read())
+            finally:
+                status.close()
+        process._start_thread(read_status)
+
+        try:
+            table = KeyTable(parse_colons(process.handles['stdout']))
+        finally:
+            process.handles['stdout'].close()
+            try:
+                process.wait()
+            except ProcessTimeout:
+                raise
+            except IOError:
+                # GnuPG exits non-zero when no key matches the patterns
+                if not results or not _no_key_matched(results[0]):
+                    raise
+        return table
+
+    def _attach_fork_exec(self, gnupg_commands, args, create_fhs, attach_fhs):
+        """This is like run(), but without the passphrase-helping
+        (note that run() calls this)."""
+
+        process = Process()
+        process._hooks = list(self.hooks)
+        process._idle_timeout = self.idle_timeout
+        process._event('pre_spawn')
+
+        _check_fhs(create_fhs, attach_fhs)
+
+        try:
+            for fh_name in create_fhs:
+                # both ends are close-on-exec, so neither GnuPG (for the
+                # parent end) nor processes started concurrently can keep
+                # them open and deadlock us
+                pipe = _pipe()
+                # fix by drt@un.bewaff.net noting
+                # that since pipes are unidirectional on some systems,
+                # so we have to 'turn the pipe around'
+                # if we are writing
+                if _fd_modes[fh_name][0] == 'w': pipe = (pipe[1], pipe[0])
+
+                process._pipes[fh_name] = Pipe(pipe[0], pipe[1], 0)
+
+                if self.pipe_size != None and _F_SETPIPE_SZ != None:
+                    try:
+                        fcntl.fcntl(pipe[0], _F_SETPIPE_SZ, self.pipe_size)
+                    except (OSError, IOError):
+                        pass    # over pipe-max-size; keep the default
+
+            if self.pipe_size != None:
+                process._bufsize = max(_bufsize, self.pipe_size)
+
+            for fh_name, fh in attach_fhs.items():
+                process._pipes[fh_name] = Pipe(fh.fileno(), fh.fileno(), 1)
+
+            self._launch_process(process, gnupg_commands, args)
+        except:
+            # e.g. a hook raising on 'spawned': leave neither GnuPG
+            # running nor any pipe end open
+            for p in process._pipes.values():
+                if not p.direct:
+                    os.close(p.parent)
+                    os.close(p.child)
+            if process._subproc != None:
+                process._abort()
+            raise
         return self._handle_pipes(process)
 
 
@@ -434,13 +1823,19 @@ class GnuPG(object):
         for k, p in process._pipes.items():
             if not p.direct:
                 os.close(p.child)
-                process.handles[k] = os.fdopen(p.parent, _fd_modes[k])
+                process.handles[k] = os.fdopen(p.parent, _fd_modes[k],
+                                               self.buffering)
 
         # user doesn't need these
         del process._pipes
 
         return process
 
+    def _get_fd_strategy(self):
+        if self.fd_strategy != None:
+            return self.fd_strategy
+        return _fd_strategy
+
     def _create_preexec_fn(self, process):
         """Create and return a function to do cleanup before exec
 
@@ -451,53 +1846,26 @@ class GnuPG(object):
         delays in unrelated parts of the program or deadlocks in the case that
         one end of the pipe is passed to attach_fds.
 
-        FIXME:  There is a race condition where a pipe can be created in
-        another thread after this function runs before exec is called and it
-        will not be closed.  This race condition will remain until a better
-        way to avoid closing the error pipe created by submodule is identified.
+        This is only used when subprocess can't do the job itself (see
+        _fd_strategy).  The open descriptors are enumerated in the parent,
+        using the fastest lister available, since listing them in the
+        child of a threaded program could deadlock on locks held by other
+        threads; the child only calls fcntl on the descriptors listed.
+        Rather than closed, they are marked close-on-exec, which leaves
+        the error pipe created by subprocess for reporting exec errors
+        working.  The caller holds _spawn_lock from listing to fork, so
+        that no pipe of a concurrent run() is made inheritable meanwhile
+        (see _pipe()).  Descriptors which other threads make inheritable
+        themselves between listing and fork are still passed to GnuPG;
+        use 'pass_fds' where that matters.
         """
         if sys.platform == "win32":
             return None     # No cleanup necessary
 
-        try:
-            MAXFD = os.sysconf("SC_OPEN_MAX")
-            if MAXFD == -1:
-                MAXFD = 256
-        except:
-            MAXFD = 256
-
-        # Get list of fds to close now, so we don't close the error pipe
-        # created by submodule for reporting exec errors
         child_fds = [p.child for p in process._pipes.values()]
-        child_fds.sort()
-        child_fds.append(MAXFD) # Sentinel value, simplifies code greatly
-
-        child_fds_iter = iter(child_fds)
-        child_fd = next(child_fds_iter)
-        while child_fd < 3:
-            child_fd = next(child_fds_iter)
-
-        extra_fds = []
-        # FIXME:  Is there a better (portable) way to list all open FDs?
-        for fd in range(3, MAXFD):
-            if fd > child_fd:
-                child_fd = next(child_fds_iter)
-
-            if fd == child_fd:
-                continue
-
-            try:
-                # Note:  Can't use lseek, can cause nul byte in pipes
-                #        where the position has not been set by read/write
-                #os.lseek(fd, os.SEEK_CUR, 0)
-                os.tcgetpgrp(fd)
-            except OSError:
-                # FIXME:  When support for Python 2.5 is dropped, use 'as'
-                oe = sys.exc_info()[1]
-                if oe.errno == errno.EBADF:
-                    continue
-
-            extra_fds.append(fd)
+        extra_fds = tuple([ fd for fd in _fd_listers[self._get_fd_strategy()]()
+                            if fd > 2 and fd not in child_fds ])
+        keep_fds = tuple([0, 1, 2] + child_fds)
 
         def preexec_fn():
             # Note:  This function runs after standard FDs have been renumbered
@@ -505,14 +1873,14 @@ class GnuPG(object):
 
             for fd in extra_fds:
                 try:
-                    os.close(fd)
+                    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
                 except OSError:
                     pass
 
             # Ensure that all descriptors passed to the child will remain open
             # Arguably FD_CLOEXEC descriptors should be an argument error
             # But for backwards compatibility, we just fix it here (after fork)
-            for fd in [0, 1, 2] + child_fds[:-1]:
+            for fd in keep_fds:
                 try:
                     fcntl.fcntl(fd, fcntl.F_SETFD, 0)
                 except OSError:
@@ -524,41 +1892,86 @@ class GnuPG(object):
 
     def _launch_process(self, process, gnupg_commands, args):
         """Run the child process"""
-        fd_args = []
-        for k, p in process._pipes.items():
-            # set command-line options for non-standard fds
-            if k in _stds:
-                continue
+        fd_args = _get_fd_args(process._pipes)
+
+        command = [ self.call ] + fd_args
+        # get_args(), so that subclasses overriding it are honoured
+        command.extend(self.options.get_args())
+        command.extend(gnupg_commands)
+        command.extend(args)
 
-            if sys.platform == "win32":
-                # Must pass inheritable os file handle
-                curproc = _subprocess.GetCurrentProcess()
-                pchandle = msvcrt.get_osfhandle(p.child)
-                pcihandle = _subprocess.DuplicateHandle(
-                        curproc, pchandle, curproc, 0, 1,
-                        _subprocess.DUPLICATE_SAME_ACCESS)
-                fdarg = pcihandle.Detach()
+        popen_args = { 'close_fds': True, 'shell': False }
+        for std in _stds:
+            p = process._pipes[std]
+            if p.direct and p.child == _stds.index(std):
+                # inherited as is; also keeps posix_spawn(3) usable
+                popen_args[std] = None
             else:
-                # Must pass file descriptor
-                fdarg = p.child
-            fd_args.extend([ _fd_options[k], str(fdarg) ])
-
-        command = [ self.call ] + fd_args + self.options.get_args() \
-                  + gnupg_commands + args
-
-        if len(fd_args) > 0:
-            # Can't close all file descriptors
-            # Create preexec function to close what we can
-            preexec_fn = self._create_preexec_fn(process)
-
-        process._subproc = subprocess.Popen(command,
-                stdin=process._pipes['stdin'].child,
-                stdout=process._pipes['stdout'].child,
-                stderr=process._pipes['stderr'].child,
-                close_fds=not len(fd_args) > 0,
-                preexec_fn=preexec_fn,
-                shell=False)
+                popen_args[std] = p.child
+
+        child_fds = [ p.child
+                      for k, p in process._pipes.items() if k not in _stds ]
+
+        limits = []
+        for res, limit in self.rlimits.items():
+            if not isinstance(limit, tuple):
+                limit = (limit, limit)
+            limits.append((res, limit))
+
+        strategy = self._get_fd_strategy()
+        if strategy == 'inheritable':
+            popen_args['close_fds'] = False
+            popen_args['executable'] = _which(self.call)
+            _spawn_lock.acquire()
+            try:
+                inheritable = []
+                try:
+                    for fd in child_fds:
+                        if not os.get_inheritable(fd):
+                            os.set_inheritable(fd, True)
+                            inheritable.append(fd)
+                    if limits:
+                        popen_args['preexec_fn'] = _rlimit_preexec_fn(
+                                None, limits)
+                    process._subproc = subprocess.Popen(command, **popen_args)
+                finally:
+                    for fd in inheritable:
+                        os.set_inheritable(fd, False)
+            finally:
+                _spawn_lock.release()
+        else:
+            preexec = 0
+            if len(fd_args) > 0:
+                if strategy == 'pass_fds':
+                    # subprocess closes everything else in the child for us
+                    popen_args['pass_fds'] = child_fds
+                else:
+                    # Can't close all file descriptors
+                    # Create preexec function to close what we can
+                    popen_args['close_fds'] = False
+                    preexec = 1
+            if preexec:
+                # list descriptors and fork while no concurrent run()
+                # has the child ends of its pipes inheritable
+                _spawn_lock.acquire()
+            try:
+                if preexec:
+                    popen_args['preexec_fn'] = self._create_preexec_fn(process)
+                if limits:
+                    popen_args['preexec_fn'] = _rlimit_preexec_fn(
+                            popen_args.get('preexec_fn'), limits)
+                process._subproc = subprocess.Popen(command, **popen_args)
+            finally:
+                if preexec:
+                    _spawn_lock.release()
+
         process.pid = process._subproc.pid
+        if self.timeout != None:
+            process._timer = threading.Timer(self.timeout, process._expire,
+                                             ('deadline',))
+            process._timer.daemon = True
+            process._timer.start()
+        process._event('spawned')
 
 
 class Pipe(object):
@@ -571,6 +1984,36 @@ class Pipe(object):
         self.direct = direct
 
 
+class _OptionList(list):
+    """List attribute of an Options object, telling it when it changes
+    so that its cached arguments are regenerated"""
+    __slots__ = ['_owner']
+
+    def __init__(self, owner, items):
+        list.__init__(self, items)
+        self._owner = owner
+
+    def _mutator(name):
+        method = getattr(list, name)
+        def mutate(self, *args):
+            result = method(self, *args)
+            self._owner._changed()
+            return result
+        mutate.__name__ = name
+        mutate.__doc__ = method.__doc__
+        return mutate
+
+    for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'clear',
+                  'sort', 'reverse', '__setitem__', '__delitem__',
+                  '__iadd__', '__imul__', '__setslice__', '__delslice__'):
+        if hasattr(list, _name):
+            locals()[_name] = _mutator(_name)
+    del _name, _mutator
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
 class Options(object):
     """Objects of this class encompass options passed to GnuPG.
     This class is responsible for determining command-line arguments
@@ -633,6 +2076,15 @@ class Options(object):
     extra_args -- Extra option arguments may be passed in
     via the attribute extra_args, a list.
 
+    The generated arguments are cached, and only generated again once an
+    attribute is set or one of the lists is modified.  Lists assigned to
+    recipients, encrypt_to and extra_args are copied into lists that
+    track their own modification, so changes to the original list after
+    assigning it have no effect.
+
+    freeze() returns a FrozenOptions, which cannot be modified and
+    so can be shared between threads without copying.
+
     >>> import GnuPGInterface
     >>>
     >>> gnupg = GnuPGInterface.GnuPG()
@@ -657,9 +2109,13 @@ class Options(object):
 
     lists = ('encrypt_to', 'recipients')
 
-    __slots__ = booleans + metas + strings + lists + ('extra_args',)
+    __slots__ = booleans + metas + strings + lists + ('extra_args',
+                                                      '_version', '_cache')
 
     def __init__(self):
+        object.__setattr__(self, '_version', 0)
+        object.__setattr__(self, '_cache', None)
+
         for b in self.booleans:
             setattr(self, b, 0)
 
@@ -675,10 +2131,55 @@ class Options(object):
 
         self.extra_args = []
 
+    def __setattr__( self, name, value ):
+        if name in self.lists or name == 'extra_args':
+            value = _OptionList(self, value)
+        object.__setattr__(self, name, value)
+        self._changed()
+
+    def _changed( self ):
+        """Invalidate the cached arguments"""
+        object.__setattr__(self, '_version',
+                           getattr(self, '_version', 0) + 1)
+
+    def _option_names( self ):
+        return self.booleans + self.metas + self.strings + self.lists \
+               + ('extra_args',)
+
+    def copy( self ):
+        """Return a modifiable copy of these options, with lists of its own"""
+        other = Options.__new__(self.__class__)
+        object.__setattr__(other, '_version', 0)
+        object.__setattr__(other, '_cache', None)
+        for name in self._option_names():
+            setattr(other, name, getattr(self, name))
+        return other
+
+    __copy__ = copy
+
+    def freeze( self ):
+        """Return a FrozenOptions with the same settings"""
+        return FrozenOptions(self)
+
     def get_args( self ):
         """Generate a list of GnuPG arguments based upon attributes."""
 
-        return self.get_meta_args() + self.get_standard_args() + self.extra_args
+        return list(self.get_args_tuple())
+
+    def get_args_tuple( self ):
+        """Return the GnuPG arguments as a tuple, generated again only
+        if the options were modified since they were last generated."""
+        version = self._version
+        cache = self._cache
+        if cache != None and cache[0] == version:
+            return cache[1]
+
+        # tagged with the version read before generating, so a change
+        # made meanwhile by another thread invalidates them
+        args = tuple(self.get_meta_args() + self.get_standard_args()
+                     + list(self.extra_args))
+        object.__setattr__(self, '_cache', (version, args))
+        return args
 
     def get_standard_args( self ):
         """Generate a list of standard, non-meta or extra arguments"""
@@ -722,6 +2223,63 @@ class Options(object):
         return args
 
 
+class FrozenOptions(Options):
+    """Options which cannot be modified once created, so that one object
+    can be shared by many GnuPG objects and threads.  Lists are stored
+    as tuples, and the arguments are generated once, when created.
+
+    Setting an attribute raises AttributeError.  copy() returns a
+    modifiable Options.
+
+    >>> import GnuPGInterface
+    >>>
+    >>> options = GnuPGInterface.Options()
+    >>> options.armor = 1
+    >>> frozen = options.freeze()
+    >>> frozen.get_args()
+    ['--armor']
+    >>> frozen.armor = 0
+    Traceback (most recent call last):
+    ...
+    AttributeError: FrozenOptions objects cannot be modified
+    """
+
+    __slots__ = []
+
+    def __init__(self, options=None):
+        if options == None:
+            options = Options()
+        object.__setattr__(self, '_version', 0)
+        object.__setattr__(self, '_cache', None)
+        for name in self._option_names():
+            value = getattr(options, name)
+            if name in self.lists or name == 'extra_args':
+                value = tuple(value)
+            object.__setattr__(self, name, value)
+        self.get_args_tuple()
+
+    def __setattr__( self, name, value ):
+        raise AttributeError("FrozenOptions objects cannot be modified")
+
+    def copy( self ):
+        other = Options()
+        for name in self._option_names():
+            setattr(other, name, getattr(self, name))
+        return other
+
+    def __copy__( self ):
+        return self
+
+    def __deepcopy__( self, memo ):
+        return self
+
+    def __reduce__( self ):
+        return (FrozenOptions, (self.copy(),))
+
+    def freeze( self ):
+        return self
+
+
 class Process(object):
     """Objects of this class encompass properties of a GnuPG
     process spawned by GnuPG.run().
@@ -743,23 +2301,2551 @@ class Process(object):
     Useful to know, since once should call
     os.waitpid() to clean up the process, especially
     if multiple calls are made to run().
+
+    returncode -- The exit code of the GnuPG process once wait()
+    has returned (or raised), None before.
+
+    timings -- A dictionary mapping the name of each event the process
+    has gone through to the monotonic time it happened at, so that
+    the differences between them break down where the time went:
+
+      * pre_spawn -- run() starts creating pipes
+      * spawned -- GnuPG has been started (pipes created, descriptors
+        listed or closed, fork and exec done)
+      * passphrase_sent -- the passphrase has been written and its
+        handle closed
+      * stdin_closed -- all input has been written and stdin closed
+      * first_output -- the first data has been read from stdout
+      * exit -- wait() has reaped GnuPG
+
+    Events happening in handles used directly rather than through
+    communicate(), GnuPG.stream() or GnuPG.relay() are not seen, except
+    for the passphrase sent by run() itself.
+
+    bytes_in, bytes_out -- The number of bytes written to and read
+    from GnuPG by communicate(), GnuPG.stream() or GnuPG.relay().
+
+    timed_out -- None, or why GnuPG was stopped: 'deadline' (see
+    GnuPG.timeout), 'idle' (see GnuPG.idle_timeout) or 'wait' (see
+    wait()).
     """
-    __slots__ = ['_pipes', 'handles', 'pid', '_subproc']
+    __slots__ = ['_pipes', 'handles', 'pid', 'returncode', '_subproc',
+                 'timings', 'bytes_in', 'bytes_out', '_hooks', '_threads',
+                 '_thread_errors', '_bufsize', 'timed_out', '_timer',
+                 '_idle_timeout']
 
     def __init__(self):
         self._pipes  = {}
         self.handles = {}
         self.pid     = None
+        self.returncode = None
         self._subproc = None
-
-    def wait(self):
+        self.timings = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._hooks = []
+        self._threads = []
+        self._thread_errors = []
+        self._bufsize = _bufsize
+        self.timed_out = None
+        self._timer = None
+        self._idle_timeout = None
+
+    def _event(self, event):
+        """Record the first occurrence of event, and call the hooks"""
+        if event in self.timings:
+            return
+        now = _clock()
+        self.timings[event] = now
+        for hook in self._hooks:
+            hook(self, event, now)
+
+    def _closed(self, name):
+        if name == 'stdin':
+            self._event('stdin_closed')
+        elif name == 'passphrase':
+            self._event('passphrase_sent')
+
+    def _start_thread(self, target):
+        """Run target in a background thread joined by wait(), which
+        raises any exception it raises"""
+        def run():
+            try:
+                target()
+            except Exception:
+                self._thread_errors.append(sys.exc_info()[1])
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def _read(self, name, data):
+        self.bytes_out += len(data)
+        if name == 'stdout':
+            self._event('first_output')
+
+    def wait(self, timeout=None):
         """Wait on the process to exit, allowing for child cleanup.
-        Will raise an IOError if the process exits non-zero."""
+        Will raise an IOError if the process exits non-zero, or the
+        error of a background thread feeding it (see GnuPG.relay() and
+        CallablePassphrase).
 
-        e = self._subproc.wait()
+        If timeout is given and GnuPG is still running that many seconds
+        later, it is stopped as by cancel().  ProcessTimeout, an IOError,
+        is raised whenever GnuPG was stopped for a timeout.
+        """
+        if timeout != None and not _wait_exit(self._subproc, timeout):
+            self._expire('wait')
+
+        e = self._reap()
+        if self.timed_out != None:
+            raise ProcessTimeout("GnuPG stopped after its %s timeout"
+                                 % self.timed_out)
+        # an error feeding GnuPG is likely why it failed
+        if self._thread_errors:
+            raise self._thread_errors[0]
         if e != 0:
             raise IOError("GnuPG exited non-zero, with code %d" % e)
 
+    def cancel(self, grace=_cancel_grace):
+        """Stop GnuPG and clean up after it: terminate it, kill it if it
+        hasn't exited grace seconds later, close all its handles and
+        reap it.  Returns its exit code, negative for the signal which
+        stopped it, without raising for it.  Does nothing more than
+        reaping if GnuPG had exited already.
+
+        May be called from another thread than the one using the
+        handles, which then see EOF or errors.
+        """
+        self._stop(grace)
+        for t in self._threads:
+            t.join(grace)
+        for fh in self.handles.values():
+            try:
+                fh.close()
+            except (IOError, OSError, ValueError):
+                pass
+        return self._reap(grace)
+
+    def _stop(self, grace=_cancel_grace):
+        """Terminate GnuPG, killing it if it is still running after
+        grace seconds"""
+        if self._subproc.poll() != None:
+            return
+        try:
+            self._subproc.terminate()
+            if not _wait_exit(self._subproc, grace):
+                self._subproc.kill()
+        except OSError:
+            pass    # exited meanwhile
+
+    def _expire(self, reason):
+        """Stop GnuPG for the timeout named reason, if still running"""
+        if self._subproc.poll() == None:
+            self.timed_out = reason
+            self._stop()
+
+    def _abort(self):
+        """Kill GnuPG, close its handles and reap it, once run() failed
+        after starting it.  No hooks are called."""
+        try:
+            self._subproc.kill()
+        except OSError:
+            pass    # exited meanwhile
+        for fh in self.handles.values():
+            try:
+                fh.close()
+            except (IOError, OSError, ValueError):
+                pass
+        self._subproc.wait()
+        if self._timer != None:
+            self._timer.cancel()
+
+    def _reap(self, grace=None):
+        """Wait for the threads and exit of GnuPG, giving up on threads
+        after grace seconds if given, or if GnuPG was stopped for a
+        timeout (e.g. a CallablePassphrase still waiting on a user)"""
+        if grace == None and self.timed_out != None:
+            grace = _cancel_grace
+        for t in self._threads:
+            t.join(grace)
+        e = self._subproc.wait()
+        if self._timer != None:
+            self._timer.cancel()
+        self.returncode = e
+        self._event('exit')
+        return e
+
+    def communicate(self, input=None, passphrase=None, command=None):
+        """Write data to GnuPG while reading everything it outputs,
+        multiplexing all the created filehandles so that neither side
+        can deadlock on a full pipe.
+
+        input, passphrase and command are written to the 'stdin',
+        'passphrase' and 'command' handles respectively.  Each may be
+        None or a bytes-like object (a str is encoded), and its handle
+        must have been created by run().  Writable handles given no data
+        are closed right away so that GnuPG sees EOF.
+
+        Returns a dictionary mapping the name of each readable handle
+        (stdout, stderr, status, logger, attribute) to the bytes read
+        from it.  All handles are closed afterwards; call wait() to
+        reap the process.  Relies on non-blocking pipes, so is not
+        available on Windows.
+        """
+        data = { 'stdin': input, 'passphrase': passphrase,
+                 'command': command }
+        writers = {}
+        readers = {}
+
+        for name, fh in self.handles.items():
+            if _fd_modes[name][0] == 'w':
+                value = data.pop(name, None)
+                if value is None:
+                    writers[name] = (fh, [])
+                else:
+                    writers[name] = (fh, [value])
+            else:
+                readers[name] = fh
+
+        for name, value in data.items():
+            if value is not None:
+                raise ValueError("cannot write to filehandle '%s'; it must be in create_fhs" \
+                      % name)
+
+        outputs = {}
+        for name in readers:
+            outputs[name] = []
+        for name, chunk in _multiplex(writers, readers, self._bufsize,
+                                      process=self):
+            outputs[name].append(chunk)
+
+        for name, chunks in outputs.items():
+            outputs[name] = b''.join(chunks)
+        return outputs
+
+
+def _passphrase_provider(passphrase):
+    """Return the PassphraseProvider for a GnuPG.passphrase value"""
+    if passphrase == None or isinstance(passphrase, PassphraseProvider):
+        return passphrase
+    if callable(passphrase):
+        return CallablePassphrase(passphrase)
+    return StaticPassphrase(passphrase)
+
+def _write_passphrase(process, fh, passphrase):
+    """Write passphrase to fh, the passphrase filehandle of process, and
+    close it.  What doesn't fit in the pipe right away is written by a
+    background thread, which Process.wait() joins."""
+    data = memoryview(_to_bytes(passphrase))
+    fd = fh.fileno()
+    _set_nonblocking(fd)
+
+    def write(data):
+        # unlike select.select(), works for descriptors past FD_SETSIZE
+        poller = _Poller()
+        try:
+            poller.register(fd, 1)
+            while len(data) > 0:
+                try:
+                    written = os.write(fd, data)
+                except OSError:
+                    oe = sys.exc_info()[1]
+                    if oe.errno == errno.EAGAIN:
+                        poller.poll()
+                        continue
+                    if oe.errno == errno.EPIPE:
+                        break   # GnuPG didn't want it; wait() reports why
+                    raise
+                data = data[written:]
+        finally:
+            poller.close()
+        fh.close()
+        process._event('passphrase_sent')
+
+    # an empty pipe takes any passphrase of reasonable length at once
+    try:
+        written = os.write(fd, data)
+    except OSError:
+        oe = sys.exc_info()[1]
+        if oe.errno == errno.EPIPE:
+            written = len(data)
+        elif oe.errno == errno.EAGAIN:
+            written = 0
+        else:
+            fh.close()
+            raise
+    data = data[written:]
+    if len(data) == 0:
+        fh.close()
+        process._event('passphrase_sent')
+    else:
+        process._start_thread(lambda: write(data))
+
+
+class ProcessTimeout(_TimeoutBase):
+    """GnuPG was stopped for running past a deadline or idle timeout
+    (see GnuPG.timeout, GnuPG.idle_timeout and Process.wait()).  An
+    IOError, and on Python 3 a TimeoutError."""
+
+
+class PassphraseProvider(object):
+    """Base class of the objects GnuPG.passphrase can be set to, which
+    decide how run() gets the passphrase to GnuPG.
+
+    Subclasses set or override:
+
+    uses_fd -- true if the passphrase is written to GnuPG's passphrase
+    filehandle, false if GnuPG gets it some other way
+
+    get_args() -- return a list of extra GnuPG options
+
+    prepare(gnupg) -- called by run() before GnuPG is started
+
+    get_passphrase() -- return the passphrase, as str or bytes.
+    Required when uses_fd is true: creating such a provider without it
+    (or a PassphraseProvider itself) raises TypeError.
+
+    deliver(process, fh) -- write the passphrase to fh, the passphrase
+    filehandle of process, and close it, without blocking
+    """
+    __slots__ = []
+
+    uses_fd = 1
+
+    def __new__(cls, *args, **kwargs):
+        if cls.uses_fd and not hasattr(cls, 'get_passphrase'):
+            raise TypeError("%s writes to the passphrase filehandle, so "
+                            "must define get_passphrase()" % cls.__name__)
+        return object.__new__(cls)
+
+    def get_args(self):
+        return []
+
+    def prepare(self, gnupg):
+        pass
+
+    def deliver(self, process, fh):
+        _write_passphrase(process, fh, self.get_passphrase())
+
+
+class StaticPassphrase(PassphraseProvider):
+    """A fixed passphrase, written to the passphrase filehandle.  This
+    is what a string GnuPG.passphrase stands for."""
+    __slots__ = ['passphrase']
+
+    def __init__(self, passphrase):
+        self.passphrase = passphrase
+
+    def get_passphrase(self):
+        return self.passphrase
+
+
+class LoopbackPassphrase(StaticPassphrase):
+    """A fixed passphrase, written to the passphrase filehandle with
+    GnuPG's pinentry in loopback mode, so that GnuPG 2.1 and later
+    use it for secret keys even when not run with --batch."""
+    __slots__ = []
+
+    def get_args(self):
+        return ['--pinentry-mode', 'loopback']
+
+
+class CallablePassphrase(PassphraseProvider):
+    """A passphrase obtained by calling func() for each run, e.g. from
+    a secrets store.  func is called from a background thread, so run()
+    returns without waiting for it; an exception it raises is raised
+    by Process.wait().  This is what a callable GnuPG.passphrase
+    stands for."""
+    __slots__ = ['func']
+
+    def __init__(self, func):
+        self.func = func
+
+    def get_passphrase(self):
+        return self.func()
+
+    def deliver(self, process, fh):
+        def deliver():
+            try:
+                passphrase = self.func()
+            except:
+                fh.close()
+                raise
+            _write_passphrase(process, fh, passphrase)
+        process._start_thread(deliver)
+
+
+class PresetPassphrase(PassphraseProvider):
+    """A passphrase preloaded into gpg-agent for the secret keys with
+    the given keygrips (see Subkey.keygrip), so that GnuPG is started
+    without a passphrase filehandle at all.
+
+    The passphrase is preset with 'gpg-connect-agent' (the call
+    attribute) the first time it is needed for a home directory, and
+    stays until the agent is restarted or preset() is called again.
+    gpg-agent must be configured with allow-preset-passphrase; IOError
+    is raised otherwise.  Symmetric encryption still needs another
+    provider, as there is no key to preset.
+    """
+    __slots__ = ['passphrase', 'keygrips', 'call', '_homedirs', '_lock']
+
+    uses_fd = 0
+
+    def __init__(self, passphrase, keygrips):
+        self.passphrase = passphrase
+        self.keygrips = list(keygrips)
+        self.call = 'gpg-connect-agent'
+        self._homedirs = set()
+        self._lock = threading.Lock()
+
+    def get_passphrase(self):
+        return self.passphrase
+
+    def prepare(self, gnupg):
+        homedir = _get_homedir(gnupg.options)
+        if homedir in self._homedirs:
+            return
+        self._lock.acquire()
+        try:
+            if homedir not in self._homedirs:
+                self.preset(gnupg)
+        finally:
+            self._lock.release()
+
+    def preset(self, gnupg):
+        """Load the passphrase into the gpg-agent used by gnupg"""
+        homedir = _get_homedir(gnupg.options)
+        hexpass = ''.join([ '%02X' % c for c in
+                            bytearray(_to_bytes(self.passphrase)) ])
+        commands = [ 'PRESET_PASSPHRASE %s -1 %s' % (keygrip, hexpass)
+                     for keygrip in self.keygrips ]
+        proc = subprocess.Popen([ self.call, '--homedir', homedir ],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        output = proc.communicate(('\n'.join(commands + ['/bye\n']))
+                                  .encode('ascii'))[0]
+        for line in output.splitlines():
+            if line.startswith(b'ERR'):
+                raise IOError("gpg-agent refused the passphrase: %s"
+                              % line.decode('utf-8', 'replace'))
+        if proc.returncode != 0:
+            raise IOError("%s exited non-zero, with code %d"
+                          % (self.call, proc.returncode))
+        self._homedirs.add(homedir)
+
+
+def _cpu_count():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+class Job(object):
+    """Description of one GnuPG operation to be run by a GnuPGPool.
+
+    Data Attributes
+
+    commands -- list of GnuPG commands, as for GnuPG.run()
+
+    args -- list of GnuPG command arguments, as for GnuPG.run()
+
+    input -- bytes written to GnuPG's standard input, or None
+
+    input_file -- path of a file GnuPG reads its standard input from,
+    instead of input.  The file is attached, so its contents never pass
+    through Python.
+
+    options -- dictionary of Options attributes to override for this job
+    only, e.g. { 'recipients': ['bob@foo.bar'] }
+
+    create_fhs -- readable filehandles to collect output from.
+    Defaults to ['stdout', 'stderr'].
+
+    timeout -- seconds the job's GnuPG process may run for, overriding
+    GnuPG.timeout, so that a wedged job can't hold its process slot
+    indefinitely.  Its JobResult then has a ProcessTimeout as error.
+
+    prepare -- function called with the job by the pool thread about to
+    run it, before GnuPG is started, returning the Job to run (usually
+    the one given, updated) or None to not run GnuPG at all, leaving
+    its JobResult without returncode or outputs.  Per-job work such as
+    reading, hashing or writing files belongs here: it runs in parallel,
+    whereas the pool takes jobs from their iterable one at a time.  An
+    exception it raises becomes the JobResult's error.
+    """
+    __slots__ = ['commands', 'args', 'input', 'input_file', 'options',
+                 'create_fhs', 'timeout', 'prepare']
+
+    def __init__(self, commands, args=None, input=None, input_file=None,
+                 options=None, create_fhs=None, timeout=None,
+                 prepare=None):
+        if args == None: args = []
+        if options == None: options = {}
+        if create_fhs == None: create_fhs = ['stdout', 'stderr']
+        if input != None and input_file != None:
+            raise ValueError("cannot have both input and input_file")
+
+        self.commands = commands
+        self.args = args
+        self.input = input
+        self.input_file = input_file
+        self.options = options
+        self.create_fhs = create_fhs
+        self.timeout = timeout
+        self.prepare = prepare
+
+
+class JobResult(object):
+    """Outcome of a Job run by a GnuPGPool.
+
+    Data Attributes
+
+    job -- the Job this is the result of
+
+    index -- position of the job in the sequence given to the pool
+
+    returncode -- GnuPG's exit code, or None if it couldn't be run
+
+    outputs -- dictionary mapping the names of the job's create_fhs
+    to the bytes read from them
+
+    error -- the exception raised while running the job, if any
+    """
+    __slots__ = ['job', 'index', 'returncode', 'outputs', 'error']
+
+    def __init__(self, job, index):
+        self.job = job
+        self.index = index
+        self.returncode = None
+        self.outputs = {}
+        self.error = None
+
+    def ok(self):
+        """Return true if GnuPG ran and exited successfully"""
+        return self.error == None and self.returncode == 0
+
+
+class GnuPGPool(object):
+    """Runs many independent GnuPG operations with a bounded number of
+    concurrent GnuPG processes.
+
+    Every job is run through GnuPG.run() on the pool's gnupg attribute
+    (with Options overrides applied to a copy), so filehandle and Options
+    behaviour is the same as when calling run() directly.
+
+    Data Attributes
+
+    gnupg -- the GnuPG object to run jobs with
+
+    size -- maximum number of concurrent GnuPG processes.  Defaults to
+    the number of CPUs.
+
+    # gnupg is a GnuPG object
+    pool = GnuPGPool(gnupg, size=4)
+    jobs = [ Job(['--verify'], [sig, data]) for sig, data in files ]
+    for result in pool.imap_unordered(jobs):
+        if not result.ok():
+            ...
+    """
+    __slots__ = ['gnupg', 'size']
+
+    def __init__(self, gnupg=None, size=None):
+        if gnupg == None: gnupg = GnuPG()
+        if size == None: size = _cpu_count()
+        self.gnupg = gnupg
+        self.size = size
+
+    def imap_unordered(self, jobs):
+        """Run the Jobs from the iterable jobs, yielding a JobResult for
+        each as it completes.
+
+        jobs is consumed lazily: a new job is only taken once a process
+        slot frees up, and workers stop taking jobs while size results
+        are waiting to be consumed, so arbitrarily long (or generated)
+        job sequences run in bounded memory.
+
+        An exception raised by jobs itself stops the pool taking new
+        jobs, and is re-raised here once the running jobs are done.
+        """
+        jobs = enumerate(jobs)
+        jobs_lock = threading.Lock()
+        results = queue.Queue(self.size)
+        stop = threading.Event()
+        done = object()
+        errors = []
+
+        def worker():
+            try:
+                while not stop.is_set():
+                    jobs_lock.acquire()
+                    try:
+                        index, job = next(jobs, (None, None))
+                    except Exception:
+                        errors.append(sys.exc_info()[1])
+                        stop.set()
+                        break
+                    finally:
+                        jobs_lock.release()
+                    if job == None:
+                        break
+                    results.put(self._run_job(job, index))
+            finally:
+                results.put(done)
+
+        workers = [ threading.Thread(target=worker)
+                    for i in range(self.size) ]
+        for t in workers:
+            t.daemon = True
+            t.start()
+
+        running = len(workers)
+        try:
+            while running > 0:
+                result = results.get()
+                if result is done:
+                    running -= 1
+                else:
+                    yield result
+            if errors:
+                raise errors[0]
+        finally:
+            # let the workers finish their current job and exit, even if
+            # the caller stopped consuming results
+            stop.set()
+            while running > 0:
+                if results.get() is done:
+                    running -= 1
+
+    def map(self, jobs):
+        """Run the Jobs from the iterable jobs, returning the list of
+        their JobResults in the same order."""
+        results = list(self.imap_unordered(jobs))
+        results.sort(key=lambda result: result.index)
+        return results
+
+    def _run_job(self, job, index):
+        result = JobResult(job, index)
+        if job.prepare != None:
+            try:
+                job = job.prepare(job)
+            except Exception:
+                result.error = sys.exc_info()[1]
+                return result
+            if job == None:
+                return result
+            result.job = job
+
+        gnupg = self.gnupg
+        if job.options or job.timeout != None:
+            gnupg = copy.copy(gnupg)
+        if job.options:
+            gnupg.options = gnupg.options.copy()
+            for name, value in job.options.items():
+                setattr(gnupg.options, name, value)
+        if job.timeout != None:
+            gnupg.timeout = job.timeout
+
+        attach_fhs = {}
+        create_fhs = list(job.create_fhs)
+        input_file = None
+        try:
+            if job.input_file != None:
+                input_file = open(job.input_file, 'rb')
+                attach_fhs['stdin'] = input_file
+            else:
+                create_fhs.append('stdin')
+
+            process = gnupg.run(job.commands, args=list(job.args),
+                                create_fhs=create_fhs,
+                                attach_fhs=attach_fhs)
+            try:
+                result.outputs = process.communicate(input=job.input)
+            finally:
+                try:
+                    process.wait()
+                except ProcessTimeout:
+                    raise
+                except IOError:
+                    pass    # non-zero exit, reported through returncode
+            result.returncode = process.returncode
+        except Exception:
+            result.error = sys.exc_info()[1]
+
+        if input_file != None:
+            input_file.close()
+        return result
+
+# prefix of every line GnuPG writes to the status filehandle
+_status_prefix = b'[GNUPG:] '
+
+# StatusEvent subclasses, by the keyword they are created for
+_status_classes = {}
+
+def _status_field(index):
+    """Return a property giving access to one argument of a StatusEvent"""
+    def get(self):
+        if index < len(self.args):
+            return self.args[index]
+        return None
+    return property(get)
+
+def _register_status(cls):
+    """Add properties for cls.fields and register cls for cls.keywords"""
+    for i, name in enumerate(cls.fields):
+        setattr(cls, name, _status_field(i))
+    for keyword in cls.keywords:
+        _status_classes[keyword] = cls
+
+
+class StatusEvent(object):
+    """One line of GnuPG's status output, '[GNUPG:] KEYWORD args...'.
+
+    Data Attributes
+
+    keyword -- the status keyword, such as 'GOODSIG' or 'DECRYPTION_OKAY'
+
+    args -- list of the (str) arguments following the keyword
+
+    Lines with a keyword which has a known set of arguments are parsed
+    into a subclass which gives access to each argument by name, as
+    listed in its fields; missing optional arguments read as None.  The
+    last field of a class with 'rest' set takes the remainder of the
+    line, spaces included (e.g. user IDs).  See the GnuPG documentation
+    (doc/DETAILS) for the meaning of each argument.
+    """
+    __slots__ = ['keyword', 'args']
+
+    keywords = ()
+    fields = ()
+    rest = 0
+
+    def __init__(self, keyword, args):
+        self.keyword = keyword
+        self.args = args
+
+    def __repr__(self):
+        return '<%s %s %r>' % (self.__class__.__name__, self.keyword, self.args)
+
+
+class SigEvent(StatusEvent):
+    """Verdict on a signature: GOODSIG, EXPSIG, EXPKEYSIG, REVKEYSIG
+    or BADSIG."""
+    __slots__ = ()
+    keywords = ('GOODSIG', 'EXPSIG', 'EXPKEYSIG', 'REVKEYSIG', 'BADSIG')
+    fields = ('keyid', 'username')
+    rest = 1
+
+class ErrSigEvent(StatusEvent):
+    """ERRSIG, a signature which could not be checked"""
+    __slots__ = ()
+    keywords = ('ERRSIG',)
+    fields = ('keyid', 'pkalgo', 'hashalgo', 'sig_class', 'timestamp',
+              'rc', 'fingerprint')
+
+class ValidSigEvent(StatusEvent):
+    """VALIDSIG, details of a good signature"""
+    __slots__ = ()
+    keywords = ('VALIDSIG',)
+    fields = ('fingerprint', 'sig_creation_date', 'sig_timestamp',
+              'expire_timestamp', 'sig_version', 'reserved', 'pubkey_algo',
+              'hash_algo', 'sig_class', 'primary_fingerprint')
+
+class TrustEvent(StatusEvent):
+    """Validity of the key of the last signature: TRUST_UNDEFINED,
+    TRUST_NEVER, TRUST_MARGINAL, TRUST_FULLY or TRUST_ULTIMATE"""
+    __slots__ = ()
+    keywords = ('TRUST_UNDEFINED', 'TRUST_NEVER', 'TRUST_MARGINAL',
+                'TRUST_FULLY', 'TRUST_ULTIMATE')
+    fields = ('zero', 'validation_model')
+
+    def level(self):
+        """Return the trust level, e.g. 'FULLY'"""
+        return self.keyword[6:]
+
+class KeyIdEvent(StatusEvent):
+    """A key which is needed but missing: NO_PUBKEY or NO_SECKEY"""
+    __slots__ = ()
+    keywords = ('NO_PUBKEY', 'NO_SECKEY')
+    fields = ('keyid',)
+
+class NeedPassphraseEvent(StatusEvent):
+    """NEED_PASSPHRASE, a secret key's passphrase is needed"""
+    __slots__ = ()
+    keywords = ('NEED_PASSPHRASE',)
+    fields = ('keyid', 'main_keyid', 'keytype', 'keylength')
+
+class EncToEvent(StatusEvent):
+    """ENC_TO, the message is encrypted to this key"""
+    __slots__ = ()
+    keywords = ('ENC_TO',)
+    fields = ('keyid', 'keytype', 'keylength')
+
+class ProgressEvent(StatusEvent):
+    """PROGRESS of a long running operation"""
+    __slots__ = ()
+    keywords = ('PROGRESS',)
+    fields = ('what', 'char', 'cur', 'total', 'units')
+
+class KeyConsideredEvent(StatusEvent):
+    """KEY_CONSIDERED, a key was looked at for the operation"""
+    __slots__ = ()
+    keywords = ('KEY_CONSIDERED',)
+    fields = ('fingerprint', 'flags')
+
+class InvalidKeyEvent(StatusEvent):
+    """An unusable recipient or signer: INV_RECP or INV_SGNR"""
+    __slots__ = ()
+    keywords = ('INV_RECP', 'INV_SGNR')
+    fields = ('reason', 'requested')
+    rest = 1
+
+class ImportOkEvent(StatusEvent):
+    """The outcome of importing one key: IMPORT_OK or IMPORT_PROBLEM"""
+    __slots__ = ()
+    keywords = ('IMPORT_OK', 'IMPORT_PROBLEM')
+    fields = ('reason', 'fingerprint')
+
+class ImportResEvent(StatusEvent):
+    """IMPORT_RES, the totals of an import"""
+    __slots__ = ()
+    keywords = ('IMPORT_RES',)
+    fields = ('count', 'no_user_id', 'imported', 'imported_rsa',
+              'unchanged', 'n_uids', 'n_subk', 'n_sigs', 'n_revoc',
+              'sec_read', 'sec_imported', 'sec_dups', 'skipped_new_keys',
+              'not_imported', 'skipped_v3_keys')
+
+class SigCreatedEvent(StatusEvent):
+    """SIG_CREATED, a signature was made"""
+    __slots__ = ()
+    keywords = ('SIG_CREATED',)
+    fields = ('type', 'pk_algo', 'hash_algo', 'sig_class', 'timestamp',
+              'fingerprint')
+
+class KeyCreatedEvent(StatusEvent):
+    """KEY_CREATED, a key was generated"""
+    __slots__ = ()
+    keywords = ('KEY_CREATED',)
+    fields = ('type', 'fingerprint', 'handle')
+
+class FailureEvent(StatusEvent):
+    """An error GnuPG reports with its location: ERROR or FAILURE"""
+    __slots__ = ()
+    keywords = ('ERROR', 'FAILURE')
+    fields = ('location', 'code')
+    rest = 1
+
+for _cls in (SigEvent, ErrSigEvent, ValidSigEvent, TrustEvent, KeyIdEvent,
+             NeedPassphraseEvent, EncToEvent, ProgressEvent,
+             KeyConsideredEvent, InvalidKeyEvent, ImportOkEvent,
+             ImportResEvent, SigCreatedEvent, KeyCreatedEvent, FailureEvent):
+    _register_status(_cls)
+del _cls
+
+
+def parse_status_line(line):
+    """Parse one line of status output (bytes) into a StatusEvent,
+    or return None if it isn't a status line."""
+    if not line.startswith(_status_prefix):
+        return None
+
+    line = line[len(_status_prefix):].rstrip(b'\r\n').decode('utf-8', 'replace')
+    parts = line.split(' ', 1)
+    keyword = parts[0]
+    cls = _status_classes.get(keyword, StatusEvent)
+
+    if len(parts) == 1 or not parts[1]:
+        args = []
+    elif cls.rest:
+        args = parts[1].split(' ', len(cls.fields) - 1)
+    else:
+        args = parts[1].split(' ')
+    return cls(keyword, args)
+
+
+class StatusResult(object):
+    """Summary of the status events of one GnuPG operation, built up
+    by a StatusReader.
+
+    Data Attributes
+
+    signatures -- number of signature verdicts seen (GOODSIG, BADSIG,
+    ERRSIG, ...)
+
+    good_signatures -- how many of them were GOODSIG
+
+    status -- keyword of the last signature verdict, or None
+
+    keyid, username -- from the last signature verdict
+
+    fingerprint, primary_fingerprint, sig_timestamp -- from the last
+    VALIDSIG
+
+    trust -- trust level of the last signature's key, e.g. 'FULLY'
+
+    decrypted -- true once DECRYPTION_OKAY was seen; false if
+    DECRYPTION_FAILED was, None if neither
+
+    missing_keys -- key IDs reported by NO_PUBKEY and NO_SECKEY
+
+    imported -- fingerprints reported by IMPORT_OK
+
+    import_result -- the ImportResEvent, if any
+
+    errors -- list of ERROR and FAILURE events, and invalid recipients
+    and signers (INV_RECP, INV_SGNR)
+    """
+    __slots__ = ['signatures', 'good_signatures', 'status', 'keyid',
+                 'username', 'fingerprint', 'primary_fingerprint',
+                 'sig_timestamp', 'trust', 'decrypted', 'missing_keys',
+                 'imported', 'import_result', 'errors']
+
+    def __init__(self):
+        self.signatures = 0
+        self.good_signatures = 0
+        self.status = None
+        self.keyid = None
+        self.username = None
+        self.fingerprint = None
+        self.primary_fingerprint = None
+        self.sig_timestamp = None
+        self.trust = None
+        self.decrypted = None
+        self.missing_keys = []
+        self.imported = []
+        self.import_result = None
+        self.errors = []
+
+    def valid(self):
+        """Return true if there were signatures and all were good"""
+        return self.signatures > 0 \
+               and self.good_signatures == self.signatures
+
+    def add(self, event):
+        """Update the summary with a StatusEvent"""
+        keyword = event.keyword
+        if isinstance(event, (SigEvent, ErrSigEvent)):
+            self.signatures += 1
+            if keyword == 'GOODSIG': self.good_signatures += 1
+            self.status = keyword
+            self.keyid = event.keyid
+            if keyword != 'ERRSIG': self.username = event.username
+        elif keyword == 'VALIDSIG':
+            self.fingerprint = event.fingerprint
+            self.primary_fingerprint = event.primary_fingerprint
+            self.sig_timestamp = event.sig_timestamp
+        elif isinstance(event, TrustEvent):
+            self.trust = event.level()
+        elif keyword == 'DECRYPTION_OKAY':
+            self.decrypted = 1
+        elif keyword == 'DECRYPTION_FAILED':
+            self.decrypted = 0
+        elif isinstance(event, KeyIdEvent):
+            self.missing_keys.append(event.keyid)
+        elif keyword == 'IMPORT_OK':
+            self.imported.append(event.fingerprint)
+        elif keyword == 'IMPORT_RES':
+            self.import_result = event
+        elif isinstance(event, (FailureEvent, InvalidKeyEvent)):
+            self.errors.append(event)
+
+
+class StatusReader(object):
+    """Lazily parses GnuPG's status output into StatusEvents.
+
+    lines is the 'status' handle of a Process, or any other iterable of
+    lines as bytes; a bytes object holding the whole output (as returned
+    by Process.communicate()) is split into lines.  Iterating over the
+    reader yields a StatusEvent for each status line as soon as GnuPG
+    writes it, while updating the StatusResult in the result attribute.
+
+        proc = gnupg.run(['--verify', 'file.sig'], create_fhs=['status'])
+        for event in GnuPGInterface.StatusReader(proc.handles['status']):
+            if event.keyword == 'PROGRESS':
+                ...
+        proc.wait()
+
+    read() consumes the rest of the output and returns the result.
+    """
+    __slots__ = ['_lines', 'result']
+
+    def __init__(self, lines):
+        if isinstance(lines, bytes):
+            lines = lines.splitlines()
+        self._lines = lines
+        self.result = StatusResult()
+
+    def __iter__(self):
+        for line in self._lines:
+            event = parse_status_line(line)
+            if event != None:
+                self.result.add(event)
+                yield event
+
+    def read(self):
+        """Parse all remaining status output, returning the StatusResult"""
+        for event in self:
+            pass
+        return self.result
+
+
+class ImportProgress(object):
+    """Running totals of GnuPG.import_keys_bulk(), from the IMPORT_OK
+    and IMPORT_PROBLEM status lines of its GnuPG processes.
+
+    Data Attributes
+
+    keys -- number of keys GnuPG has reported on
+
+    imported -- how many were new to the keyring
+
+    changed -- how many were already there, and gained user IDs,
+    signatures or subkeys
+
+    unchanged -- how many were already there as they are
+
+    problems -- how many GnuPG couldn't import
+
+    bytes -- number of bytes of key data given to GnuPG
+
+    fingerprint -- fingerprint of the last key reported on, if given
+    """
+    __slots__ = ['keys', 'imported', 'changed', 'unchanged', 'problems',
+                 'bytes', 'fingerprint']
+
+    def __init__(self):
+        self.keys = 0
+        self.imported = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.problems = 0
+        self.bytes = 0
+        self.fingerprint = None
+
+    def __repr__(self):
+        return '<ImportProgress %d keys, %d imported, %d problems>' \
+               % (self.keys, self.imported, self.problems)
+
+    def _add(self, event):
+        self.keys += 1
+        self.fingerprint = event.fingerprint
+        if event.keyword == 'IMPORT_PROBLEM':
+            self.problems += 1
+            return
+        reason = int(event.reason)
+        if reason & 1:
+            self.imported += 1
+        elif reason:
+            self.changed += 1
+        else:
+            self.unchanged += 1
+
+
+class Verification(object):
+    """Verdict on one detached signature, as returned by
+    GnuPG.verify_many().
+
+    Data Attributes
+
+    valid -- true if GnuPG exited successfully and all the signatures
+    it found were good
+
+    status -- keyword of the last signature verdict (GOODSIG, BADSIG,
+    EXPKEYSIG, ERRSIG, ...), or None if none was given
+
+    keyid, fingerprint, primary_fingerprint, sig_timestamp, trust --
+    as for StatusResult
+
+    returncode -- GnuPG's exit code, or None if it couldn't be run
+
+    error -- the exception raised while running GnuPG, if any
+    """
+    __slots__ = ['valid', 'status', 'keyid', 'fingerprint',
+                 'primary_fingerprint', 'sig_timestamp', 'trust',
+                 'returncode', 'error']
+
+    def __init__(self, result=None, returncode=None, error=None):
+        if result == None: result = StatusResult()
+        self.valid = bool(result.valid() and returncode == 0)
+        self.status = result.status
+        self.keyid = result.keyid
+        self.fingerprint = result.fingerprint
+        self.primary_fingerprint = result.primary_fingerprint
+        self.sig_timestamp = result.sig_timestamp
+        self.trust = result.trust
+        self.returncode = returncode
+        self.error = error
+
+    def __repr__(self):
+        return '<Verification %s %s>' % (self.status,
+                                         self.fingerprint or self.keyid)
+
+
+# matches the C-style escapes GnuPG uses in --with-colons output
+_colons_escape = re.compile(br'\\x([0-9a-fA-F]{2})')
+
+def _unescape_colons(field):
+    """Decode an escaped --with-colons field (bytes) into a str"""
+    if b'\\' in field:
+        field = _colons_escape.sub(
+                lambda m: bytes(bytearray([int(m.group(1), 16)])), field)
+    return field.decode('utf-8', 'replace')
+
+
+class Subkey(object):
+    """A subkey from a --with-colons key listing.
+
+    Data Attributes
+
+    Each is a str taken from the respective field of the listing, or
+    None if the field is empty:
+
+    validity, length, algo, keyid (the long key ID), created, expires,
+    capabilities, fingerprint, keygrip (GnuPG 2.1 and later, which
+    identifies the key to gpg-agent)
+    """
+    __slots__ = ['validity', 'length', 'algo', 'keyid', 'created',
+                 'expires', 'capabilities', 'fingerprint', 'keygrip']
+
+    def __init__(self, fields):
+        self.validity = fields[1] or None
+        self.length = fields[2] or None
+        self.algo = fields[3] or None
+        self.keyid = fields[4] or None
+        self.created = fields[5] or None
+        self.expires = fields[6] or None
+        self.capabilities = fields[11] or None
+        self.fingerprint = None
+        self.keygrip = None
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            self.fingerprint or self.keyid)
+
+
+class Key(Subkey):
+    """A primary key from a --with-colons key listing, with the
+    attributes of a Subkey plus:
+
+    secret -- true if this came from a secret key listing
+
+    ownertrust -- the owner trust field
+
+    uids -- list of UserIds
+
+    subkeys -- list of Subkeys
+    """
+    __slots__ = ['secret', 'ownertrust', 'uids', 'subkeys']
+
+    def __init__(self, fields):
+        Subkey.__init__(self, fields)
+        self.secret = fields[0] == 'sec'
+        self.ownertrust = fields[8] or None
+        self.uids = []
+        self.subkeys = []
+
+
+class UserId(object):
+    """A user ID of a Key.
+
+    Data Attributes
+
+    validity -- the validity field
+
+    uid -- the user ID, e.g. 'Joe Tester <joe@foo.bar>'
+    """
+    __slots__ = ['validity', 'uid']
+
+    def __init__(self, validity, uid):
+        self.validity = validity
+        self.uid = uid
+
+    def email(self):
+        """Return the lowercased email address of the user ID, or None"""
+        start = self.uid.rfind('<')
+        end = self.uid.rfind('>')
+        if start != -1 and end > start:
+            return self.uid[start + 1:end].lower()
+        if '@' in self.uid and ' ' not in self.uid:
+            return self.uid.lower()
+        return None
+
+    def __repr__(self):
+        return '<UserId %r>' % self.uid
+
+
+def parse_colons(lines):
+    """Generator parsing GnuPG --with-colons key listing output, given
+    as an iterable of lines (bytes), into Keys.
+
+    Each Key is yielded as soon as the next one starts, so listings
+    can be processed while GnuPG is still producing them.
+    """
+    key = None
+    current = None
+    for line in lines:
+        fields = line.rstrip(b'\r\n').split(b':')
+        record = fields[0]
+        if record in (b'pub', b'sec'):
+            if key != None:
+                yield key
+            fields = [ f.decode('ascii', 'replace') for f in fields[:12] ]
+            fields.extend([''] * (12 - len(fields)))
+            key = current = Key(fields)
+        elif key == None:
+            continue
+        elif record in (b'sub', b'ssb'):
+            fields = [ f.decode('ascii', 'replace') for f in fields[:12] ]
+            fields.extend([''] * (12 - len(fields)))
+            current = Subkey(fields)
+            key.subkeys.append(current)
+        elif record == b'uid':
+            if len(fields) > 9:
+                key.uids.append(UserId(fields[1].decode('ascii', 'replace'),
+                                       _unescape_colons(fields[9])))
+            current = None  # a following fpr isn't the key's
+        elif len(fields) <= 9:
+            continue        # truncated record
+        elif record == b'fpr':
+            if current != None and current.fingerprint == None:
+                current.fingerprint = fields[9].decode('ascii', 'replace')
+        elif record == b'grp':
+            if current != None and current.keygrip == None:
+                current.keygrip = fields[9].decode('ascii', 'replace')
+    if key != None:
+        yield key
+
+
+class KeyTable(object):
+    """An in-memory table of Keys, indexed for constant time lookups
+    by fingerprint, long key ID (of primary keys and subkeys),
+    email address and user ID.
+
+    >>> import GnuPGInterface
+    >>> table = GnuPGInterface.GnuPG().list_keys()   # doctest: +SKIP
+    >>> key = table.get('joe@foo.bar')               # doctest: +SKIP
+    """
+    __slots__ = ['keys', '_by_fingerprint', '_by_keyid', '_by_email',
+                 '_by_uid']
+
+    def __init__(self, keys=()):
+        self.keys = []
+        self._by_fingerprint = {}
+        self._by_keyid = {}
+        self._by_email = {}
+        self._by_uid = {}
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __contains__(self, query):
+        return self.get(query) != None
+
+    def add(self, key):
+        """Add a Key to the table"""
+        self.keys.append(key)
+        for k in [key] + key.subkeys:
+            if k.fingerprint != None:
+                self._by_fingerprint.setdefault(k.fingerprint, key)
+            if k.keyid != None:
+                self._by_keyid.setdefault(k.keyid, key)
+        for uid in key.uids:
+            self._by_uid.setdefault(uid.uid, []).append(key)
+            email = uid.email()
+            if email != None:
+                self._by_email.setdefault(email, []).append(key)
+
+    def find(self, query):
+        """Return the list of Keys matching query, which may be a
+        fingerprint or long key ID (optionally prefixed with '0x'), an
+        email address (optionally in angle brackets) or an exact user ID.
+        """
+        hexid = query.upper()
+        if hexid.startswith('0X'):
+            hexid = hexid[2:]
+        if hexid in self._by_fingerprint:
+            return [ self._by_fingerprint[hexid] ]
+        if hexid in self._by_keyid:
+            return [ self._by_keyid[hexid] ]
+
+        if query in self._by_uid:
+            return list(self._by_uid[query])
+        email = query.strip('<>').lower()
+        return list(self._by_email.get(email, []))
+
+    def get(self, query):
+        """Return the first Key matching query (see find()), or None"""
+        keys = self.find(query)
+        if keys:
+            return keys[0]
+        return None
+
+
+# files in a GnuPG home directory whose changes affect key listings
+_keyring_files = ( 'pubring.kbx', 'pubring.gpg', 'secring.gpg',
+                   'trustdb.gpg', 'private-keys-v1.d',
+                   os.path.join('public-keys.d', 'pubring.db') )
+
+def _get_homedir(options):
+    """Return the GnuPG home directory used with options"""
+    if options.homedir != None:
+        return options.homedir
+    return os.environ.get('GNUPGHOME') or os.path.expanduser('~/.gnupg')
+
+def _extra_keyrings(args):
+    """Return the keyrings named by --keyring and --secret-keyring
+    options in the list of arguments args"""
+    names = []
+    for i, arg in enumerate(args):
+        for option in ('--keyring', '--secret-keyring'):
+            if arg == option and i + 1 < len(args):
+                names.append(args[i + 1])
+            elif arg.startswith(option + '='):
+                names.append(arg[len(option) + 1:])
+    return names
+
+def _keyring_state(options):
+    """Return a tuple which changes whenever the keyrings used with
+    options do, made of the path, modification time, size and inode
+    of each existing keyring file."""
+    homedir = _get_homedir(options)
+    paths = [ os.path.join(homedir, name) for name in _keyring_files ]
+    for name in [ options.keyring, options.secret_keyring ] \
+            + _extra_keyrings(options.extra_args):
+        if name == None:
+            continue
+        # like GnuPG, names without a slash are in the home directory
+        if os.sep in name:
+            paths.append(os.path.expanduser(name))
+        else:
+            paths.append(os.path.join(homedir, name))
+
+    state = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        state.append((path, getattr(st, 'st_mtime_ns', st.st_mtime),
+                      st.st_size, st.st_ino))
+    return tuple(state)
+
+
+class KeyringCache(object):
+    """Least recently used cache of the KeyTables listed by GnuPG objects,
+    which only runs GnuPG again once the keyring changes.
+
+    Listings are cached per GnuPG executable and arguments generated
+    from its Options (so per homedir and keyrings, but also per
+    --trust-model and other extra_args which change listings), and are
+    considered stale as soon as the modification time, size or inode of the
+    keyring files (pubring.kbx, pubring.gpg, secring.gpg, trustdb.gpg,
+    private-keys-v1.d, keyboxd's public-keys.d/pubring.db, and the
+    configured keyrings, including any --keyring in
+    Options.extra_args) change.  Up to
+    maxsize listings are kept.
+
+    Instances may be shared between threads.
+
+        cache = GnuPGInterface.KeyringCache()
+        # gnupg is a GnuPG object
+        if cache.list_keys(gnupg).get(recipient) == None:
+            ...
+    """
+    __slots__ = ['maxsize', '_entries', '_lock']
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def list_keys(self, gnupg):
+        """Return the KeyTable of gnupg.list_keys(), from the cache
+        if the keyring hasn't changed since it was listed."""
+        return self._get(gnupg, 0)
+
+    def list_secret_keys(self, gnupg):
+        """Like list_keys(), for gnupg.list_secret_keys()"""
+        return self._get(gnupg, 1)
+
+    def clear(self):
+        """Forget all cached listings"""
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def _get(self, gnupg, secret):
+        options = gnupg.options
+        key = (gnupg.call, tuple(options.get_args()), secret)
+        # taken before listing, so changes made while GnuPG runs
+        # cause another listing next time
+        state = _keyring_state(options)
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry != None:
+                # reinsert as most recently used
+                self._entries[key] = entry
+                if entry[0] == state:
+                    return entry[1]
+        finally:
+            self._lock.release()
+
+        if secret:
+            table = gnupg.list_secret_keys()
+        else:
+            table = gnupg.list_keys()
+
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = (state, table)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+        return table
+
+
+def _digest(obj):
+    """Return the SHA-256 digest of obj, bytes or a path"""
+    if not _is_path(obj):
+        return hashlib.sha256(obj).digest()
+    digest = hashlib.sha256()
+    f = open(_fspath(obj), 'rb')
+    try:
+        while 1:
+            data = f.read(_bufsize)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        f.close()
+    return digest.digest()
+
+def _snapshot(obj, path):
+    """Copy the file at the path obj to path while hashing it, and
+    return path and the SHA-256 digest, so that GnuPG reads exactly the
+    bytes hashed even if the file is replaced meanwhile."""
+    digest = hashlib.sha256()
+    f = open(_fspath(obj), 'rb')
+    try:
+        copy = open(path, 'wb')
+        try:
+            while 1:
+                data = f.read(_bufsize)
+                if not data:
+                    break
+                digest.update(data)
+                copy.write(data)
+        finally:
+            copy.close()
+    finally:
+        f.close()
+    return path, digest.digest()
+
+def _verification_state(gnupg):
+    """Return a digest of everything besides the signature and data a
+    verdict depends on: the GnuPG executable, its options and the state
+    of its keyrings."""
+    state = (gnupg.call, tuple(gnupg.options.get_args()),
+             _keyring_state(gnupg.options))
+    return hashlib.sha256(repr(state).encode('utf-8')).digest()
+
+def _verification_key(signature_digest, data_digest, state):
+    return hashlib.sha256(signature_digest + data_digest
+                          + state).hexdigest()
+
+
+class VerificationCache(object):
+    """Cache of the Verifications made by GnuPG.verify_many(), so that
+    signatures verified before are not given to GnuPG again.
+
+    Verdicts are keyed by a SHA-256 digest of the signature, of the
+    data, and of the GnuPG executable, its options and the modification
+    time, size and inode of its keyring files (see KeyringCache).  Any
+    key import, deletion, revocation or trust change thus makes the
+    verdicts reached before it unreachable, rather than masking it.
+    Verdicts on expiring keys can't be told apart this way, so entries
+    are also dropped once older than ttl seconds (None keeps them).
+
+    The maxsize most recently used verdicts are held in memory.  If path
+    is given, verdicts are also stored in a dbm database there, so that
+    they survive the process; call close() when done with it.  Verdicts
+    which GnuPG couldn't be run for (those with an error) are not stored.
+
+    hits, misses -- the number of lookups answered and not answered
+    from the cache
+
+    Instances may be shared between threads.
+
+        cache = GnuPGInterface.VerificationCache(path='verdicts.db')
+        # gnupg is a GnuPG object
+        verdicts = gnupg.verify_many(pairs, cache=cache)
+    """
+    __slots__ = ['maxsize', 'ttl', 'hits', 'misses', '_entries', '_db',
+                 '_lock']
+
+    # Verification attributes kept by the database
+    _fields = ('valid', 'status', 'keyid', 'fingerprint',
+               'primary_fingerprint', 'sig_timestamp', 'trust', 'returncode')
+
+    def __init__(self, maxsize=4096, path=None, ttl=86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._db = None
+        self._lock = threading.Lock()
+        if path != None:
+            try:
+                import dbm
+            except ImportError:
+                # Python 2
+                import anydbm as dbm
+            self._db = dbm.open(_fspath(path), 'c')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Forget all cached verdicts, including those in the database"""
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            if self._db != None:
+                for key in list(self._db.keys()):
+                    del self._db[key]
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Close the database, if any.  The memory cache stays usable."""
+        self._lock.acquire()
+        try:
+            if self._db != None:
+                self._db.close()
+                self._db = None
+        finally:
+            self._lock.release()
+
+    def _expired(self, stored):
+        return self.ttl != None and time.time() - stored > self.ttl
+
+    def _get(self, key):
+        """Return a copy of the Verification cached under key, or None"""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry == None and self._db != None:
+                try:
+                    record = self._db[key.encode('ascii')]
+                except KeyError:
+                    record = None
+                if record != None:
+                    record = json.loads(record.decode('utf-8'))
+                    verification = Verification()
+                    for name in self._fields:
+                        setattr(verification, name, record[name])
+                    entry = (record['stored'], verification)
+            if entry == None or self._expired(entry[0]):
+                if entry != None and self._db != None:
+                    try:
+                        del self._db[key.encode('ascii')]
+                    except KeyError:
+                        pass
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._insert(key, entry)
+            return copy.copy(entry[1])
+        finally:
+            self._lock.release()
+
+    def _put(self, key, verification):
+        entry = (time.time(), copy.copy(verification))
+        self._lock.acquire()
+        try:
+            self._insert(key, entry)
+            if self._db != None:
+                record = dict([ (name, getattr(verification, name))
+                                for name in self._fields ])
+                record['stored'] = entry[0]
+                self._db[key.encode('ascii')] = json.dumps(record)
+        finally:
+            self._lock.release()
+
+    def _insert(self, key, entry):
+        # (re)insert as most recently used
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+# matches the %XX escapes of Assuan data lines
+_assuan_escape = re.compile(br'%([0-9a-fA-F]{2})')
+
+# characters that Assuan command lines can't carry verbatim
+_assuan_special = re.compile(r'[%\r\n]')
+
+def _unescape_assuan(data):
+    return _assuan_escape.sub(
+            lambda m: bytes(bytearray([int(m.group(1), 16)])), data)
+
+
+class GnuPGWorker(object):
+    """A long-lived 'gpg --server' process serving a sequence of
+    encryption and decryption requests, so that they don't each pay
+    for starting GnuPG and opening its keyring.
+
+    GnuPG's server can't be handed file descriptors over its command
+    pipe, so data is exchanged through pipes passed to the server when
+    it is started.  Each operation uses up one pair of them, and a new
+    server is started once the slots pairs are used up, or when the
+    server has died; an operation interrupted by the server dying is
+    retried once on a new server.  GnuPG's server also can't decrypt
+    more than one message, so it is replaced after each decryption; the
+    replacement is started right away, so that it gets ready while the
+    caller deals with the plaintext.
+
+    GnuPG's server does not implement signing and its verification is
+    unreliable, so sign() and verify() run a separate GnuPG process.
+    The server can't ask for passphrases either: secret keys used for
+    decryption must not need one, or have it cached by gpg-agent.
+
+    gnupg.timeout bounds each operation, and gnupg.idle_timeout each
+    wait on the server.  Past either, the server is killed, to be
+    replaced by the next operation, and ProcessTimeout is raised.
+
+    Data Attributes
+
+    gnupg -- the GnuPG object whose call and options the server is
+    started with.  Options.recipients is ignored; recipients are given
+    to encrypt() instead.
+
+    slots -- number of operations served by each server process
+
+    spawns -- number of server processes started so far
+
+    Instances may be shared between threads; operations are serialized.
+    Requires Python 3.2 or later.
+
+        worker = GnuPGInterface.GnuPGWorker(gnupg)
+        ciphertext = worker.encrypt(b"The secret", ['bob@foo.bar'])
+        ...
+        worker.close()
+    """
+    __slots__ = ['gnupg', 'slots', 'spawns', '_subproc', '_pipes',
+                 '_greeted', '_lock', '_buffer', '_timed_out']
+
+    def __init__(self, gnupg=None, slots=16):
+        if gnupg == None: gnupg = GnuPG()
+        self.gnupg = gnupg
+        self.slots = slots
+        self.spawns = 0
+        self._subproc = None
+        self._pipes = []
+        self._greeted = 0
+        self._lock = threading.Lock()
+        self._buffer = b''
+        self._timed_out = None
+
+    def encrypt(self, data, recipients=None):
+        """Return data encrypted to the list of recipients, which
+        defaults to gnupg.options.recipients.  Raises ValueError for a
+        recipient containing '%', CR or LF, which can't be sent to the
+        server verbatim."""
+        if recipients == None:
+            recipients = self.gnupg.options.recipients
+        for r in recipients:
+            if _assuan_special.search(r):
+                raise ValueError("cannot send recipient %r to GnuPG server"
+                                 % r)
+        commands = [ 'RECIPIENT %s' % r for r in recipients ]
+        return self._operation(commands + ['ENCRYPT'], data)
+
+    def decrypt(self, data):
+        """Return data decrypted"""
+        return self._operation(['DECRYPT'], data)
+
+    def sign(self, data, commands=None):
+        """Return data signed, by a separate GnuPG process.  commands
+        defaults to ['--sign']."""
+        if commands == None: commands = ['--sign']
+        process = self.gnupg.run(commands, create_fhs=['stdin', 'stdout'])
+        output = process.communicate(input=data)['stdout']
+        process.wait()
+        return output
+
+    def verify(self, data, signature=None):
+        """Verify signed data, or data against its detached signature,
+        by a separate GnuPG process, returning the StatusResult"""
+        args = []
+        signature_file = None
+        try:
+            if signature != None:
+                signature_file = tempfile.NamedTemporaryFile()
+                signature_file.write(signature)
+                signature_file.flush()
+                args = [signature_file.name, '-']
+            process = self.gnupg.run(['--verify'], args=args,
+                                     create_fhs=['stdin', 'status'])
+            status = process.communicate(input=data)['status']
+            try:
+                process.wait()
+            except IOError:
+                pass    # bad signatures are reported by the result
+        finally:
+            if signature_file != None:
+                signature_file.close()
+        return StatusReader(status).read()
+
+    def check(self):
+        """Health check: return true if the server answers, starting it
+        if it isn't running"""
+        self._lock.acquire()
+        try:
+            try:
+                self._ensure(0)
+                self._transact('NOP')
+                return 1
+            except (IOError, OSError):
+                self._stop()
+                return 0
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Stop the server process, if running"""
+        self._lock.acquire()
+        try:
+            if self._subproc != None and self._subproc.poll() == None:
+                try:
+                    self._transact('BYE')
+                except (IOError, OSError):
+                    pass
+            self._stop()
+        finally:
+            self._lock.release()
+
+    def _operation(self, commands, data):
+        self._lock.acquire()
+        try:
+            self._timed_out = None
+            timer = None
+            if self.gnupg.timeout != None:
+                timer = threading.Timer(self.gnupg.timeout, self._expire,
+                                        ('deadline',))
+                timer.daemon = True
+                timer.start()
+            try:
+                try:
+                    return self._run_operation(commands, data)
+                except _ServerDied:
+                    if self._timed_out != None:
+                        raise
+                    self._stop()
+                    return self._run_operation(commands, data)
+            except (IOError, OSError):
+                if self._timed_out == None:
+                    raise
+                # killed by the timer, or for an idle timeout
+                self._stop()
+                if isinstance(sys.exc_info()[1], ProcessTimeout):
+                    raise
+                raise ProcessTimeout("GnuPG server stopped after its %s "
+                                     "timeout" % self._timed_out)
+            finally:
+                if timer != None:
+                    timer.cancel()
+        finally:
+            self._lock.release()
+
+    def _expire(self, reason):
+        """Kill the server for the timeout named reason"""
+        subproc = self._subproc
+        self._timed_out = reason
+        if subproc != None and subproc.poll() == None:
+            try:
+                subproc.kill()
+            except OSError:
+                pass    # exited meanwhile
+
+    def _run_operation(self, commands, data):
+        self._ensure(1)
+        input_fh, output_fh = self._pipes.pop()
+        try:
+            self._transact('RESET')
+            self._transact('INPUT FD=%d' % input_fh[1])
+            self._transact('OUTPUT FD=%d' % output_fh[1])
+            for command in commands[:-1]:
+                self._transact(command)
+
+            self._send(commands[-1])
+            output = []
+            try:
+                for name, chunk in _multiplex(
+                        { 'input': (input_fh[0], [data]) },
+                        { 'output': output_fh[0] },
+                        idle_timeout=self.gnupg.idle_timeout):
+                    output.append(chunk)
+            except ProcessTimeout:
+                self._expire('idle')
+                raise
+            self._response()
+        finally:
+            input_fh[0].close()
+            output_fh[0].close()
+
+        if commands[-1] == 'DECRYPT':
+            self._stop()
+            self._start()
+        return b''.join(output)
+
+    def _ensure(self, needed):
+        """Make sure a server with needed unused pipe pairs is running
+        and ready for commands"""
+        if self._subproc != None \
+           and (self._subproc.poll() != None or len(self._pipes) < needed):
+            self._stop()
+        if self._subproc == None:
+            self._start()
+        if not self._greeted:
+            self._response()
+            self._greeted = 1
+
+    def _start(self):
+        """Start a server process, without waiting for it to be ready"""
+        options = self.gnupg.options.copy()
+        options.recipients = []
+        command = [ self.gnupg.call ] + options.get_args() + ['--server']
+
+        # (parent file, child fd) pairs for GnuPG's input and output
+        pipes = []
+        child_fds = []
+        try:
+            for i in range(self.slots):
+                r, w = os.pipe()
+                child_fds.append(r)
+                input_fh = (os.fdopen(w, 'wb'), r)
+                r, w = os.pipe()
+                child_fds.append(w)
+                pipes.append((input_fh, (os.fdopen(r, 'rb'), w)))
+
+            self._subproc = subprocess.Popen(command,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    close_fds=True, pass_fds=child_fds)
+        except:
+            for input_fh, output_fh in pipes:
+                input_fh[0].close()
+                output_fh[0].close()
+            raise
+        finally:
+            for fd in child_fds:
+                os.close(fd)
+
+        self._pipes = pipes
+        self._greeted = 0
+        self._buffer = b''
+        self.spawns += 1
+
+    def _stop(self):
+        subproc = self._subproc
+        self._subproc = None
+        self._greeted = 0
+        for input_fh, output_fh in self._pipes:
+            input_fh[0].close()
+            output_fh[0].close()
+        self._pipes = []
+        if subproc != None:
+            subproc.stdin.close()
+            subproc.stdout.close()
+            subproc.wait()
+
+    def _send(self, line):
+        try:
+            self._subproc.stdin.write(line.encode('utf-8') + b'\n')
+            self._subproc.stdin.flush()
+        except (IOError, OSError):
+            raise _ServerDied("GnuPG server died")
+
+    def _response(self):
+        """Read the server's response up to OK, returning the data lines.
+        Raises IOError if the server answered ERR."""
+        data = []
+        while 1:
+            line = self._readline()
+            if not line:
+                raise _ServerDied("GnuPG server died")
+            line = line.rstrip(b'\r\n')
+            if line == b'OK' or line.startswith(b'OK '):
+                return data
+            if line.startswith(b'ERR '):
+                raise IOError("GnuPG server error: %s" \
+                      % line[4:].decode('utf-8', 'replace'))
+            if line.startswith(b'D '):
+                data.append(_unescape_assuan(line[2:]))
+            elif line.startswith(b'INQUIRE '):
+                # nothing to answer inquiries (passphrases) with
+                self._send('CAN')
+
+    def _readline(self):
+        """Read a line from the server, or b'' at EOF.  Raises
+        ProcessTimeout, having killed the server, if it is silent for
+        longer than gnupg.idle_timeout."""
+        fd = self._subproc.stdout.fileno()
+        idle_timeout = self.gnupg.idle_timeout
+        while 1:
+            end = self._buffer.find(b'\n') + 1
+            if end:
+                line = self._buffer[:end]
+                self._buffer = self._buffer[end:]
+                return line
+            if idle_timeout != None:
+                poller = _Poller()
+                try:
+                    poller.register(fd, 0)
+                    readable = poller.poll(idle_timeout)[0]
+                finally:
+                    poller.close()
+                if not readable:
+                    self._expire('idle')
+                    raise ProcessTimeout("no answer from GnuPG server for "
+                                         "%g seconds" % idle_timeout)
+            data = os.read(fd, _bufsize)
+            if not data:
+                line = self._buffer
+                self._buffer = b''
+                return line
+            self._buffer += data
+
+    def _transact(self, line):
+        self._send(line)
+        return self._response()
+
+
+class _ServerDied(IOError):
+    """The GnuPG server process exited unexpectedly"""
+
+
+# OpenPGP packet tags
+_tag_signature = 2
+_tag_secret_key = 5
+_tag_public_key = 6
+_tag_public_subkey = 14
+
+class _ChunkReader(io.RawIOBase):
+    """Raw binary file-like object reading from an iterator of bytes,
+    closing the file f (if given) when closed.  Wrap it in an
+    io.BufferedReader for small reads."""
+
+    def __init__(self, chunks, f=None):
+        io.RawIOBase.__init__(self)
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+        self._file = f
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self._pending):
+            chunk = next(self._chunks, None)
+            if chunk == None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        if self._file != None:
+            self._file.close()
+        io.RawIOBase.close(self)
+
+def _dearmor(lines):
+    """Yield the binary data of the ASCII armored blocks in lines"""
+    outside, headers, body = 0, 1, 2
+    state = outside
+    pending = b''
+    for line in lines:
+        line = line.strip()
+        if state == outside:
+            if line.startswith(b'-----BEGIN PGP '):
+                state = headers
+        elif state == headers:
+            if not line:
+                state = body
+        elif line.startswith(b'-----END PGP '):
+            state = outside
+            pending = b''
+        elif not line.startswith(b'='):    # not the checksum
+            # decode whole groups of 4 characters, whatever the lines
+            pending += line
+            whole = len(pending) // 4 * 4
+            if whole:
+                yield binascii.a2b_base64(pending[:whole])
+                pending = pending[whole:]
+
+def _open_packets(source):
+    """Return a binary file-like object reading the OpenPGP packets of
+    source (bytes, a path, or a binary file), ASCII armored or not.
+    Closing it closes the file opened for a path."""
+    opened = None
+    if _is_path(source):
+        source = opened = open(_fspath(source), 'rb')
+    elif not hasattr(source, 'read'):
+        source = io.BytesIO(source)
+
+    # binary packets start with a byte with the top bit set, armor with
+    # text; read a line at most to tell them apart
+    first = source.readline(_bufsize)
+    while first and not first.strip():
+        first = source.readline(_bufsize)
+    if first.lstrip().startswith(b'-----BEGIN PGP '):
+        chunks = _dearmor(itertools.chain([first], source))
+    else:
+        chunks = itertools.chain([first],
+                                 iter(lambda: source.read(_bufsize), b''))
+    return io.BufferedReader(_ChunkReader(chunks, opened), _bufsize)
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("truncated OpenPGP packet")
+    return data
+
+def _iter_packets(f):
+    """Yield (tag, packet, body) for each OpenPGP packet read from the
+    binary file f, packet being all of its bytes, header included."""
+    while 1:
+        header = f.read(1)
+        if not header:
+            return
+        c = bytearray(header)[0]
+        if not c & 0x80:
+            raise ValueError("not OpenPGP data")
+
+        parts = [header]
+        body = []
+        if c & 0x40:
+            # new format, where bodies may come in partial lengths
+            tag = c & 0x3f
+            while 1:
+                length = _read_exactly(f, 1)
+                parts.append(length)
+                o = bytearray(length)[0]
+                partial = 0
+                if o < 192:
+                    size = o
+                elif o < 224:
+                    o2 = _read_exactly(f, 1)
+                    parts.append(o2)
+                    size = ((o - 192) << 8) + bytearray(o2)[0] + 192
+                elif o == 255:
+                    length = _read_exactly(f, 4)
+                    parts.append(length)
+                    size = struct.unpack('>I', length)[0]
+                else:
+                    size = 1 << (o & 0x1f)
+                    partial = 1
+                chunk = _read_exactly(f, size)
+                parts.append(chunk)
+                body.append(chunk)
+                if not partial:
+                    break
+        else:
+            tag = (c >> 2) & 0x0f
+            length_type = c & 0x03
+            if length_type == 3:
+                # indeterminate length: the rest of the data
+                chunk = f.read()
+            else:
+                length = _read_exactly(f, (1, 2, 4)[length_type])
+                parts.append(length)
+                size = struct.unpack(('>B', '>H', '>I')[length_type],
+                                     length)[0]
+                chunk = _read_exactly(f, size)
+            parts.append(chunk)
+            body.append(chunk)
+        yield tag, b''.join(parts), b''.join(body)
+
+def _hexlify(data):
+    return binascii.hexlify(bytes(data)).decode('ascii').upper()
+
+def _key_fingerprint(body):
+    """Return the fingerprint of a v4, v5 or v6 public key packet body,
+    None for older keys"""
+    version = bytearray(body[:1])[0]
+    if version == 4:
+        return _hexlify(hashlib.sha1(b'\x99' + struct.pack('>H', len(body))
+                                     + body).digest())
+    if version in (5, 6):
+        prefix = (b'\x9a', b'\x9b')[version - 5]
+        return _hexlify(hashlib.sha256(prefix + struct.pack('>I', len(body))
+                                       + body).digest())
+    return None
+
+def _fingerprint_keyid(fingerprint):
+    """Return the long key ID of a fingerprint: its low 64 bits for v4
+    keys, and its high 64 bits for v5 and v6 keys"""
+    if len(fingerprint) == 40:
+        return fingerprint[-16:]
+    return fingerprint[:16]
+
+def _signature_issuer(body):
+    """Return the long key ID of the key which made a signature, from
+    the body of its packet, or None if it doesn't say"""
+    body = bytearray(body)
+    version = body[0]
+    if version in (2, 3):
+        return _hexlify(body[7:15])
+
+    if version == 6:
+        size_format = '>I'
+    else:
+        size_format = '>H'
+    size_length = struct.calcsize(size_format)
+    pos = 4
+    keyid = None
+    # hashed, then unhashed subpackets
+    for area in range(2):
+        size = struct.unpack(size_format,
+                             bytes(body[pos:pos + size_length]))[0]
+        pos += size_length
+        end = pos + size
+        while pos < end:
+            o = body[pos]
+            if o < 192:
+                length = o
+                pos += 1
+            elif o < 255:
+                length = ((o - 192) << 8) + body[pos + 1] + 192
+                pos += 2
+            else:
+                length = struct.unpack('>I', bytes(body[pos + 1:pos + 5]))[0]
+                pos += 5
+            subpacket_type = body[pos] & 0x7f
+            data = body[pos + 1:pos + length]
+            pos += length
+            if subpacket_type == 33:    # issuer fingerprint
+                return _fingerprint_keyid(_hexlify(data[1:]))
+            if subpacket_type == 16:    # issuer key ID
+                keyid = _hexlify(data)
+    return keyid
+
+def split_keys(source):
+    """Split OpenPGP public keys into the data of each key, as would be
+    given to 'gpg --import', yielding (fingerprint, data) pairs.
+
+    source is bytes, a path or a binary file, holding any number of
+    keys, ASCII armored or not.  The fingerprint is computed from the
+    key itself (for v4 keys and later; it is None for older ones), so
+    no GnuPG process is needed.  Keys are read one at a time.
+
+    Raises ValueError on data which isn't OpenPGP, or holds secret keys.
+    """
+    for fingerprint, subkeys, data in _split_keys(source):
+        yield fingerprint, data
+
+def _split_keys(source):
+    """Like split_keys(), yielding (fingerprint, subkeys, data) triples,
+    subkeys being the list of the long key IDs of the key's subkeys"""
+    f = _open_packets(source)
+    try:
+        fingerprint = None
+        subkeys = []
+        packets = []
+        for tag, packet, body in _iter_packets(f):
+            if tag == _tag_secret_key:
+                raise ValueError("cannot split secret keys")
+            if tag == _tag_public_key:
+                if packets:
+                    yield fingerprint, subkeys, b''.join(packets)
+                fingerprint = _key_fingerprint(body)
+                subkeys = []
+                packets = []
+            elif not packets and fingerprint == None:
+                continue    # marker and other packets before the first key
+            elif tag == _tag_public_subkey:
+                subkey = _key_fingerprint(body)
+                if subkey != None:
+                    subkeys.append(_fingerprint_keyid(subkey))
+            packets.append(packet)
+        if packets:
+            yield fingerprint, subkeys, b''.join(packets)
+    finally:
+        f.close()
+
+def _read_signature_issuer(signature):
+    """Return the key ID of the issuer of the first signature in
+    signature (bytes or a path), or None if it can't be told"""
+    try:
+        f = _open_packets(signature)
+        try:
+            for tag, packet, body in _iter_packets(f):
+                if tag == _tag_signature:
+                    return _signature_issuer(body)
+        finally:
+            f.close()
+    except (EnvironmentError, ValueError, IndexError, struct.error):
+        pass
+    return None
+
+def _keyring_path(homedir):
+    """Return the path of the public keyring in homedir, or None"""
+    for name in ('pubring.kbx', 'pubring.gpg'):
+        path = os.path.join(homedir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+# a fingerprint or long key ID, as keys can be routed by
+_keyid_pattern = re.compile(r'^(0[xX])?([0-9A-Fa-f]{16}|[0-9A-Fa-f]{40}'
+                            r'|[0-9A-Fa-f]{64})$')
+
+def _map_threads(func, items, threads=None):
+    """Return [ func(item) for item in items ], calling func from up to
+    threads threads at once (by default a thread per item), and raising
+    the first exception any raised"""
+    items = list(items)
+    if threads == None: threads = len(items)
+    results = [ None ] * len(items)
+    errors = []
+    pending = enumerate(items)
+    pending_lock = threading.Lock()
+    def run():
+        while 1:
+            pending_lock.acquire()
+            try:
+                index, item = next(pending, (None, None))
+            finally:
+                pending_lock.release()
+            if index == None:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+    workers = [ threading.Thread(target=run)
+                for i in range(min(threads, len(items))) ]
+    for t in workers:
+        t.daemon = True
+        t.start()
+    for t in workers:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+# file in each shard's home directory listing the long key IDs of the
+# subkeys of the keys imported into it, one per line
+_subkeys_name = 'shard-subkeys'
+
+
+class ShardedKeyring(object):
+    """Spreads one large public keyring across several GnuPG home
+    directories (shards), so that each GnuPG process only opens a
+    keyring a fraction of the size.
+
+    Each key is kept in the shard given by its long key ID (so by its
+    fingerprint) modulo the number of shards.  Operations naming keys
+    by fingerprint or key ID are routed to the shards holding them:
+    encryption runs on the shards of its recipients only, with the
+    keyrings of all but the first passed as extra --keyring options,
+    and verification on the shard of the key ID the signature names.
+    Other work, such as listing keys, runs on every shard in parallel.
+
+    The key IDs of subkeys are recorded in each shard (in its
+    shard-subkeys file) as import_keys() imports them, so signatures
+    made by subkeys, and recipients named by them, are routed to the
+    shard of their primary key.  Signatures naming no key, or a key
+    missing from the shard it routes to, are verified again against
+    all the keyrings at once.  Recipients may also be named by a user
+    ID, which is looked up on every shard.  Keyrings kept by keyboxd
+    (GnuPG 2.4's use-keyboxd) are not supported, as GnuPG ignores
+    --keyring with them.
+
+    Data Attributes
+
+    gnupg -- the GnuPG object to run GnuPG with; its options.homedir is
+    overridden with each shard's
+
+    homedirs -- list of the home directories of the shards, created if
+    missing
+
+        keyring = GnuPGInterface.ShardedKeyring(
+                [ '/srv/keys/%d' % i for i in range(16) ])
+        keyring.import_keys('dump.pgp')
+        ciphertext = keyring.encrypt(b'data', [fingerprint])
+        verdict = keyring.verify('file.sig', 'file')
+    """
+    __slots__ = ['gnupg', 'homedirs', '_subkeys']
+
+    def __init__(self, homedirs, gnupg=None):
+        if gnupg == None: gnupg = GnuPG()
+        self.gnupg = gnupg
+        self.homedirs = list(homedirs)
+        # shard index of each subkey's long key ID
+        self._subkeys = {}
+        for index, homedir in enumerate(self.homedirs):
+            if not os.path.isdir(homedir):
+                os.makedirs(homedir, 0o700)
+            try:
+                f = open(os.path.join(homedir, _subkeys_name))
+            except EnvironmentError:
+                continue
+            try:
+                for line in f:
+                    if line.strip():
+                        self._subkeys[line.strip()] = index
+            finally:
+                f.close()
+
+    def __len__(self):
+        return len(self.homedirs)
+
+    def shard(self, key):
+        """Return the index of the shard for key, a fingerprint or long
+        key ID, with or without a 0x prefix"""
+        keyid = self._keyid(key)
+        index = self._subkeys.get(keyid)
+        if index == None:
+            index = int(keyid, 16) % len(self.homedirs)
+        return index
+
+    def _keyid(self, key):
+        match = _keyid_pattern.match(key)
+        if match == None:
+            raise ValueError("not a fingerprint or long key ID: %r" % key)
+        keyid = match.group(2).upper()
+        if len(keyid) > 16:
+            keyid = _fingerprint_keyid(keyid)
+        return keyid
+
+    def get_gnupg(self, shards):
+        """Return a copy of gnupg using the keyrings of the list of
+        shard indices shards, and the home directory of the first.
+        Raises ValueError if shards is empty."""
+        shards = sorted(set(shards))
+        if not shards:
+            raise ValueError("no shards to use")
+        gnupg = copy.copy(self.gnupg)
+        gnupg.options = self.gnupg.options.copy()
+        gnupg.options.homedir = self.homedirs[shards[0]]
+        for index in shards[1:]:
+            path = _keyring_path(self.homedirs[index])
+            if path != None:
+                gnupg.options.extra_args.extend(['--keyring', path])
+        return gnupg
+
+    def import_keys(self, source, size=None, batch_size=1000):
+        """Import the public keys in source (bytes, a path or a binary
+        file, armored or not) into their shards, returning the list of
+        fingerprints GnuPG reported as imported.
+
+        Keys are split as they are read, and given to each shard's
+        GnuPG processes batch_size keys at a time, so only a few
+        batches per shard are held in memory.  Shards import in
+        parallel, up to size GnuPG processes at a time (by default one
+        per shard).  As with GnuPG.import_keys_bulk(), keys GnuPG
+        rejects are left out; raises IOError if a GnuPG process fails
+        before reporting its totals.
+        """
+        if size == None: size = len(self.homedirs)
+        slots = threading.Semaphore(size)
+        # batches of keys and their subkeys, then None, for each shard
+        queues = [ queue.Queue(1) for homedir in self.homedirs ]
+        imported = [ [] for homedir in self.homedirs ]
+        finished = [ 0 ] * len(self.homedirs)
+        errors = []
+
+        def batches(index):
+            for batch, subkeys in iter(queues[index].get, None):
+                slots.acquire()
+                try:
+                    yield batch
+                finally:
+                    slots.release()
+                # GnuPG reported its totals, so the keys are in
+                self._add_subkeys(index, subkeys)
+            finished[index] = 1
+
+        def importer(index):
+            shard_batches = batches(index)
+            try:
+                self.get_gnupg([index])._import_batches(
+                        shard_batches, None, imported[index])
+            except Exception:
+                errors.append(sys.exc_info()[1])
+                shard_batches.close()
+                # so that the keys still being split never block
+                if not finished[index]:
+                    while queues[index].get() != None:
+                        pass
+
+        threads = [ threading.Thread(target=importer, args=(i,))
+                    for i in range(len(self.homedirs)) ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        pending = [ ([], []) for homedir in self.homedirs ]
+        try:
+            for fingerprint, subkeys, data in _split_keys(source):
+                if errors:
+                    break
+                index = 0
+                if fingerprint != None:
+                    index = self.shard(fingerprint)
+                batch, batch_subkeys = pending[index]
+                batch.append((fingerprint, data))
+                batch_subkeys.extend(subkeys)
+                if len(batch) >= batch_size:
+                    queues[index].put(pending[index])
+                    pending[index] = ([], [])
+            else:
+                for index, item in enumerate(pending):
+                    if item[0]:
+                        queues[index].put(item)
+        finally:
+            for q in queues:
+                q.put(None)
+            for t in threads:
+                t.join()
+        if errors:
+            raise errors[0]
+        return list(itertools.chain(*imported))
+
+    def _add_subkeys(self, index, subkeys):
+        """Record the list of subkey IDs subkeys as being in shard index"""
+        if not subkeys:
+            return
+        f = open(os.path.join(self.homedirs[index], _subkeys_name), 'a')
+        try:
+            for keyid in subkeys:
+                f.write(keyid + '\n')
+        finally:
+            f.close()
+        for keyid in subkeys:
+            self._subkeys[keyid] = index
+
+    def list_keys(self, patterns=None):
+        """List the keys matching the list of patterns (all keys by
+        default) on every shard in parallel, returning one KeyTable."""
+        def list_shard(index):
+            return self.get_gnupg([index]).list_keys(patterns)
+        tables = _map_threads(list_shard, range(len(self.homedirs)))
+        return KeyTable(itertools.chain(*tables))
+
+    def encrypt(self, data, recipients, args=None):
+        """Encrypt the bytes data to the list of recipients, returning
+        the ciphertext.  args are extra GnuPG arguments, e.g. ['--armor'].
+
+        Recipients given by fingerprint or long key ID, of primary keys
+        or of imported subkeys, are routed to their shard; others are
+        looked up on every shard first.  Raises ValueError if there are
+        no recipients, and IOError if a recipient can't be found or
+        GnuPG fails.
+        """
+        if args == None: args = []
+        if not recipients:
+            raise ValueError("no recipients to encrypt to")
+        fingerprints = [ r for r in recipients if _keyid_pattern.match(r) ]
+        names = [ r for r in recipients if not _keyid_pattern.match(r) ]
+        if names:
+            table = self.list_keys(names)
+            for name in names:
+                key = table.get(name)
+                if key == None:
+                    raise IOError("no public key for %s" % name)
+                fingerprints.append(key.fingerprint)
+
+        gnupg = self.get_gnupg([ self.shard(f) for f in fingerprints ])
+        gnupg.options.recipients = fingerprints
+        process = gnupg.run(['--encrypt'] + args,
+                            create_fhs=['stdin', 'stdout'])
+        ciphertext = process.communicate(input=data)['stdout']
+        process.wait()
+        return ciphertext
+
+    def verify(self, signature, data):
+        """Verify one detached signature, as for verify_many(),
+        returning its Verification."""
+        return self.verify_many([ (signature, data) ])[0]
+
+    def verify_many(self, items, size=None, cache=None):
+        """Verify many detached signatures, each on the shard of the key
+        it names, returning a list of Verifications in the order of items.
+
+        items, size and cache are as for GnuPG.verify_many(); shards
+        are verified in parallel, sharing size processes between them.
+        Signatures naming no key, or a key which is not an imported
+        subkey and is missing from its shard, are then verified against
+        all the keyrings at once.
+        """
+        items = list(items)
+        if size == None: size = _cpu_count()
+        everywhere = tuple(range(len(self.homedirs)))
+
+        verifications = [ None ] * len(items)
+        groups = collections.OrderedDict()
+        # items whose key is routed by its ID alone, so may be elsewhere
+        unknown = []
+        for index, item in enumerate(items):
+            try:
+                signature, data = item
+                keyid = _read_signature_issuer(signature)
+                if keyid == None:
+                    shards = everywhere
+                else:
+                    shards = (self.shard(keyid),)
+                    if self._keyid(keyid) not in self._subkeys:
+                        unknown.append(index)
+            except Exception:
+                # reported for this item alone, as GnuPG.verify_many() does
+                verifications[index] = Verification(error=sys.exc_info()[1])
+                continue
+            groups.setdefault(shards, []).append(index)
+
+        # groups running at once, each with an equal share of size
+        threads = min(size, len(groups))
+        def verify(group):
+            shards, indices = group
+            gnupg = self.get_gnupg(shards)
+            verdicts = gnupg.verify_many([ items[i] for i in indices ],
+                                         max(1, size // threads),
+                                         cache=cache)
+            for index, verdict in zip(indices, verdicts):
+                verifications[index] = verdict
+        _map_threads(verify, list(groups.items()), threads)
+
+        retry = [ i for i in unknown if verifications[i].status == 'ERRSIG' ]
+        if retry and len(self.homedirs) > 1:
+            verdicts = self.get_gnupg(everywhere).verify_many(
+                    [ items[i] for i in retry ], size, cache=cache)
+            for index, verdict in zip(retry, verdicts):
+                verifications[index] = verdict
+        return verifications
+
+
 def _run_doctests():
     import doctest, GnuPGInterface
     return doctest.testmod(GnuPGInterface)
@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+
+"""Benchmarks for GnuPGInterface
+
+Each benchmark runs against a throwaway GnuPG home directory holding
+freshly generated keys without passphrases, so no network access or
+existing keyring is needed.  Run all benchmarks with
+
+    python benchmarks.py
+
+or only some of them by giving their names as arguments.  Options:
+
+    -j, --json        print a JSON document instead of text, holding the
+                      results along with the versions of Python, GnuPG
+                      and GnuPGInterface, for comparing releases
+    -o, --output=FILE write the output to FILE instead of stdout
+    -l, --list        list the benchmarks and exit
+
+Times are in seconds unless their name says otherwise, and throughputs
+in MiB of plaintext per second.
+
+LICENSE:
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+"""
+
+import getopt
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import GnuPGInterface
+
+__revision__ = "$Id$"
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# payload sizes for the throughput benchmarks
+sizes = [ 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024 ]
+
+# plaintext bytes to put through GnuPG per payload size, so small
+# payloads are repeated enough to measure
+budget = 16 * 1024 * 1024
+
+# soft RLIMIT_NOFILE values to spawn GnuPG under, capped by the hard limit
+nofile_limits = [ 256, 1024, 65536, 1048576 ]
+
+MiB = 1024.0 * 1024.0
+
+
+def make_homedir(uids):
+    """Return a new temporary GnuPG home directory with a key for each
+    of uids, without passphrases."""
+    homedir = tempfile.mkdtemp()
+    gnupg = make_gnupg(homedir)
+    gnupg.passphrase = ''
+    for uid in uids:
+        proc = gnupg.run(['--quick-gen-key', uid, 'future-default',
+                          'default', 'never'],
+                         create_fhs=['stdin', 'stdout', 'stderr'])
+        proc.communicate()
+        proc.wait()
+    return homedir
+
+def remove_homedir(homedir):
+    """Stop the gpg-agent of homedir and remove it"""
+    try:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--kill', 'all'])
+    except OSError:
+        pass
+    shutil.rmtree(homedir, ignore_errors=True)
+
+def make_gnupg(homedir):
+    gnupg = GnuPGInterface.GnuPG()
+    gnupg.options.homedir = homedir
+    gnupg.options.meta_interactive = 0
+    gnupg.options.quiet = 1
+    gnupg.options.extra_args.append('--no-secmem-warning')
+    return gnupg
+
+def timed(func, *args):
+    """Return the seconds taken by calling func with args"""
+    start = clock()
+    func(*args)
+    return clock() - start
+
+def sampled(func, count):
+    """Call func count times, returning a dictionary of the minimum,
+    median and mean milliseconds taken per call"""
+    samples = sorted([ timed(func) for i in range(count) ])
+    return { 'min_ms': samples[0] * 1000.0,
+             'median_ms': samples[len(samples) // 2] * 1000.0,
+             'mean_ms': sum(samples) / len(samples) * 1000.0 }
+
+def repeats(size):
+    """Return how many times to process a payload of size bytes"""
+    return max(1, min(20, budget // size))
+
+def run_gnupg(gnupg, commands, input=None, create_fhs=None):
+    """Run GnuPG, feeding it input, and return its stdout"""
+    if create_fhs is None: create_fhs = ['stdin', 'stdout']
+    proc = gnupg.run(commands, create_fhs=create_fhs)
+    outputs = proc.communicate(input=input)
+    proc.wait()
+    return outputs.get('stdout')
+
+def fd_strategies():
+    """Return the descriptor strategies usable on this system"""
+    strategies = ['scan']
+    if GnuPGInterface._fd_dir is not None:
+        strategies.append('listdir')
+    if sys.version_info >= (3, 2):
+        strategies.extend(['pass_fds', 'inheritable'])
+    return strategies
+
+def gnupg_version(gnupg):
+    """Return the first line of gpg --version"""
+    output = run_gnupg(gnupg, ['--version'], create_fhs=['stdout'])
+    return output.decode('utf-8', 'replace').splitlines()[0]
+
+def throughput(gnupg, encrypt_commands, size):
+    """Encrypt and decrypt a random payload of size bytes repeatedly,
+    returning the seconds taken and the plaintext throughputs"""
+    payload = os.urandom(size)
+    count = repeats(size)
+    ciphertexts = []
+
+    def encrypt():
+        for i in range(count):
+            ciphertexts.append(run_gnupg(gnupg, encrypt_commands, payload))
+
+    def decrypt():
+        for ciphertext in ciphertexts:
+            assert run_gnupg(gnupg, ['--decrypt'], ciphertext) == payload
+
+    encrypt_seconds = timed(encrypt)
+    decrypt_seconds = timed(decrypt)
+    total = size * count / MiB
+    return { 'messages': count,
+             'encrypt_seconds': encrypt_seconds,
+             'decrypt_seconds': decrypt_seconds,
+             'encrypt_mib_per_second': total / encrypt_seconds,
+             'decrypt_mib_per_second': total / decrypt_seconds }
+
+########################################################################
+
+def bench_spawn(homedir, count=50):
+    """Time starting GnuPG with each descriptor strategy, with only
+    stdout and with the status, logger and attribute descriptors too"""
+    gnupg = make_gnupg(homedir)
+    cases = { 'stdout_only': ['stdout'],
+              'extra_fds': ['stdout', 'status', 'logger', 'attribute'] }
+    result = {}
+    for strategy in fd_strategies():
+        gnupg.fd_strategy = strategy
+        for case, create_fhs in cases.items():
+            result['%s.%s' % (strategy, case)] = sampled(
+                lambda: run_gnupg(gnupg, ['--version'],
+                                  create_fhs=create_fhs), count)
+    return result
+
+def bench_symmetric(homedir):
+    """Symmetric encryption and decryption throughput by payload size"""
+    gnupg = make_gnupg(homedir)
+    gnupg.passphrase = 'Three blind mice'
+    result = {}
+    for size in sizes:
+        result[str(size)] = throughput(gnupg, ['--symmetric'], size)
+    return result
+
+def bench_public_key(homedir):
+    """Public-key encryption and decryption throughput by payload size"""
+    gnupg = make_gnupg(homedir)
+    gnupg.options.recipients = ['bench0@example.org']
+    result = {}
+    for size in sizes:
+        result[str(size)] = throughput(gnupg, ['--encrypt'], size)
+    return result
+
+def bench_attach(homedir, size=1024 * 1024, count=20):
+    """Compare created pipes with attached files for stdin and stdout"""
+    # public-key encryption, since symmetric key derivation would dominate
+    gnupg = make_gnupg(homedir)
+    gnupg.options.recipients = ['bench0@example.org']
+    payload = os.urandom(size)
+    plainfile = tempfile.TemporaryFile()
+    plainfile.write(payload)
+    plainfile.flush()
+
+    def create():
+        run_gnupg(gnupg, ['--encrypt'], payload)
+
+    def attach():
+        plainfile.seek(0)
+        cipherfile = tempfile.TemporaryFile()
+        proc = gnupg.run(['--encrypt'], attach_fhs={ 'stdin': plainfile,
+                                                       'stdout': cipherfile })
+        proc.wait()
+        cipherfile.close()
+
+    try:
+        return { 'message_bytes': size,
+                 'create_fhs': sampled(create, count),
+                 'attach_fhs': sampled(attach, count) }
+    finally:
+        plainfile.close()
+
+def bench_relay(homedir, size=64 * 1024 * 1024):
+    """Compare stream() with relay() for encrypting a file to a file"""
+    gnupg = make_gnupg(homedir)
+    gnupg.options.recipients = ['bench0@example.org']
+    gnupg.options.compress_algo = 'none'
+    plainfile = tempfile.TemporaryFile()
+    chunk = os.urandom(1024 * 1024)
+    for i in range(size // len(chunk)):
+        plainfile.write(chunk)
+    plainfile.flush()
+
+    def stream():
+        plainfile.seek(0)
+        cipherfile = tempfile.TemporaryFile()
+        for data in gnupg.stream(['--encrypt'], plainfile):
+            cipherfile.write(data)
+        cipherfile.close()
+
+    def relay():
+        plainfile.seek(0)
+        cipherfile = tempfile.TemporaryFile()
+        gnupg.relay(['--encrypt'], plainfile, cipherfile).wait()
+        cipherfile.close()
+
+    try:
+        stream_seconds = timed(stream)
+        relay_seconds = timed(relay)
+    finally:
+        plainfile.close()
+    return { 'message_bytes': size,
+             'stream_seconds': stream_seconds,
+             'relay_seconds': relay_seconds,
+             'stream_mib_per_second': size / MiB / stream_seconds,
+             'relay_mib_per_second': size / MiB / relay_seconds }
+
+def bench_pipes(homedir, size=64 * 1024 * 1024, count=3):
+    """Throughput of large payloads by pipe size and handle buffering,
+    using --store so that GnuPG does little more than copy"""
+    gnupg = make_gnupg(homedir)
+    gnupg.options.compress_algo = 'none'
+    payload = os.urandom(size)
+    plainfile = tempfile.TemporaryFile()
+    plainfile.write(payload)
+    plainfile.flush()
+    buf = bytearray(1024 * 1024)
+
+    def communicate():
+        run_gnupg(gnupg, ['--store'], payload)
+
+    def read():
+        # stdin from a file, so only stdout is driven by this process
+        plainfile.seek(0)
+        proc = gnupg.run(['--store'], create_fhs=['stdout'],
+                         attach_fhs={ 'stdin': plainfile })
+        stdout = proc.handles['stdout']
+        if gnupg.buffering == 0:
+            while stdout.readinto(buf):
+                pass
+        else:
+            while stdout.read(len(buf)):
+                pass
+        stdout.close()
+        proc.wait()
+
+    result = {}
+    try:
+        for pipe_size in (None, 256 * 1024, 1024 * 1024):
+            gnupg.pipe_size = pipe_size
+            for buffering in (-1, 0):
+                gnupg.buffering = buffering
+                seconds = min([ timed(communicate) for i in range(count) ])
+                read_seconds = min([ timed(read) for i in range(count) ])
+                result['%s.%s' % (pipe_size or 'default',
+                                  buffering and 'buffered' or 'raw')] = \
+                    { 'communicate_mib_per_second': size / MiB / seconds,
+                      'read_mib_per_second': size / MiB / read_seconds }
+    finally:
+        plainfile.close()
+    return result
+
+def bench_nofile(homedir, count=10):
+    """Time starting GnuPG with extra descriptors under several soft
+    RLIMIT_NOFILE values; the preexec_fn strategies depend on it"""
+    if resource is None:
+        return {}
+    gnupg = make_gnupg(homedir)
+    create_fhs = ['stdout', 'status', 'logger', 'attribute']
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    result = {}
+    try:
+        for limit in nofile_limits:
+            if hard != resource.RLIM_INFINITY and limit > hard:
+                continue
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+            for strategy in fd_strategies():
+                gnupg.fd_strategy = strategy
+                result['%d.%s' % (limit, strategy)] = sampled(
+                    lambda: run_gnupg(gnupg, ['--version'],
+                                      create_fhs=create_fhs), count)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return result
+
+def bench_encrypt_many(homedir, count=200, size=1024):
+    """Compare one GnuPG process per message with GnuPG.encrypt_many()"""
+    gnupg = make_gnupg(homedir)
+    recipient_sets = [ ['bench0@example.org'],
+                       ['bench0@example.org', 'bench1@example.org'] ]
+    items = [ (os.urandom(size), recipient_sets[i % 2])
+              for i in range(count) ]
+
+    def per_call():
+        for payload, recipients in items:
+            gnupg.options.recipients = recipients
+            proc = gnupg.run(['--encrypt'], create_fhs=['stdin', 'stdout'])
+            proc.communicate(input=payload)
+            proc.wait()
+        gnupg.options.recipients = []
+
+    return { 'messages': count,
+             'message_bytes': size,
+             'per_call_seconds': timed(per_call),
+             'encrypt_many_seconds': timed(gnupg.encrypt_many, items) }
+
+def bench_worker(homedir, count=200, size=1024):
+    """Compare one GnuPG process per encryption with a GnuPGWorker"""
+    gnupg = make_gnupg(homedir)
+    gnupg.options.recipients = ['bench0@example.org']
+    payloads = [ os.urandom(size) for i in range(count) ]
+
+    def per_call():
+        for payload in payloads:
+            proc = gnupg.run(['--encrypt'], create_fhs=['stdin', 'stdout'])
+            proc.communicate(input=payload)
+            proc.wait()
+
+    def worker():
+        worker = GnuPGInterface.GnuPGWorker(gnupg, slots=64)
+        for payload in payloads:
+            worker.encrypt(payload)
+        worker.close()
+
+    return { 'messages': count,
+             'message_bytes': size,
+             'per_call_seconds': timed(per_call),
+             'worker_seconds': timed(worker) }
+
+def bench_verify(homedir, count=200, size=1024):
+    """Compare one GnuPG process per detached signature with
+    GnuPG.verify_many(), uncached and answered from a VerificationCache"""
+    gnupg = make_gnupg(homedir)
+    items = []
+    for i in range(count):
+        data = os.urandom(size)
+        proc = gnupg.run(['--detach-sign'], create_fhs=['stdin', 'stdout'])
+        items.append((proc.communicate(input=data)['stdout'], data))
+        proc.wait()
+
+    def per_call():
+        for signature, data in items:
+            sigfile = tempfile.NamedTemporaryFile()
+            sigfile.write(signature)
+            sigfile.flush()
+            proc = gnupg.run(['--verify'], args=[sigfile.name, '-'],
+                             create_fhs=['stdin', 'status', 'stderr'])
+            proc.communicate(input=data)
+            proc.wait()
+            sigfile.close()
+
+    cache = GnuPGInterface.VerificationCache()
+    return { 'signatures': count,
+             'message_bytes': size,
+             'per_call_seconds': timed(per_call),
+             'verify_many_seconds': timed(gnupg.verify_many, items),
+             'cold_cache_seconds': timed(gnupg.verify_many, items, None,
+                                         None, cache),
+             'warm_cache_seconds': timed(gnupg.verify_many, items, None,
+                                         None, cache) }
+
+def bench_import(homedir, count=300, batch_size=100, shards=4):
+    """Compare importing a key dump with one GnuPG process, with
+    GnuPG.import_keys_bulk() and with a ShardedKeyring"""
+    keys = make_homedir(['Import %d <import%d@example.org>' % (i, i)
+                         for i in range(count)])
+    directory = tempfile.mkdtemp()
+    try:
+        dump = os.path.join(directory, 'dump.pgp')
+        exported = timed(make_gnupg(keys).export_keys_bulk, dump)
+
+        def single():
+            gnupg = make_gnupg(os.path.join(directory, 'single'))
+            os.mkdir(gnupg.options.homedir, 0o700)
+            proc = gnupg.run(['--import'], args=[dump],
+                             create_fhs=['stdin', 'stdout', 'stderr'])
+            proc.communicate()
+            proc.wait()
+
+        def bulk():
+            gnupg = make_gnupg(os.path.join(directory, 'bulk'))
+            os.mkdir(gnupg.options.homedir, 0o700)
+            gnupg.import_keys_bulk(dump, batch_size)
+
+        def sharded():
+            keyring = GnuPGInterface.ShardedKeyring(
+                    [ os.path.join(directory, 'shard%d' % i)
+                      for i in range(shards) ],
+                    make_gnupg(None))
+            keyring.import_keys(dump)
+
+        return { 'keys': count,
+                 'dump_bytes': os.path.getsize(dump),
+                 'export_seconds': exported,
+                 'single_seconds': timed(single),
+                 'bulk_seconds': timed(bulk),
+                 'sharded_seconds': timed(sharded) }
+    finally:
+        for name in os.listdir(directory):
+            if os.path.isdir(os.path.join(directory, name)):
+                remove_homedir(os.path.join(directory, name))
+        shutil.rmtree(directory, ignore_errors=True)
+        remove_homedir(keys)
+
+def bench_segmented(homedir, size=64 * 1024 * 1024,
+                    segment_size=4 * 1024 * 1024):
+    """Compare encrypting and decrypting a large file with one GnuPG
+    process and as a segmented container, and restoring 1 MiB of it"""
+    gnupg = make_gnupg(homedir)
+    gnupg.options.recipients = ['bench0@example.org']
+    directory = tempfile.mkdtemp()
+    try:
+        plainfile = os.path.join(directory, 'plain')
+        f = open(plainfile, 'wb')
+        f.write(os.urandom(size))
+        f.close()
+        single = os.path.join(directory, 'single.gpg')
+        container = os.path.join(directory, 'container')
+
+        def run_attached(commands, source, destination):
+            src = open(source, 'rb')
+            dst = open(destination, 'wb')
+            proc = gnupg.run(commands, attach_fhs={ 'stdin': src,
+                                                    'stdout': dst })
+            proc.wait()
+            src.close()
+            dst.close()
+
+        restored = os.path.join(directory, 'restored')
+        return { 'bytes': size,
+                 'segment_bytes': segment_size,
+                 'cpus': GnuPGInterface._cpu_count(),
+                 'encrypt_single_seconds':
+                     timed(run_attached, ['--encrypt'], plainfile, single),
+                 'encrypt_segmented_seconds':
+                     timed(gnupg.encrypt_segmented, plainfile, container,
+                           segment_size),
+                 'decrypt_single_seconds':
+                     timed(run_attached, ['--decrypt'], single, restored),
+                 'decrypt_segmented_seconds':
+                     timed(gnupg.decrypt_segmented, container, restored),
+                 'restore_1mib_seconds':
+                     timed(gnupg.decrypt_segmented, container, restored,
+                           size // 2, 1024 * 1024) }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# benchmarks by name, in the order they are run
+benchmarks = [ ('spawn', bench_spawn),
+               ('symmetric', bench_symmetric),
+               ('public_key', bench_public_key),
+               ('attach', bench_attach),
+               ('relay', bench_relay),
+               ('pipes', bench_pipes),
+               ('nofile', bench_nofile),
+               ('encrypt_many', bench_encrypt_many),
+               ('worker', bench_worker),
+               ('verify', bench_verify),
+               ('import', bench_import),
+               ('segmented', bench_segmented) ]
+
+########################################################################
+
+def format_result(name, result):
+    """Return the text lines for the result of a benchmark, one per
+    case for benchmarks returning nested dictionaries"""
+    def format_items(d):
+        return ', '.join([ '%s=%s' % (k, format_value(v))
+                           for k, v in sorted(d.items()) ])
+    def format_value(v):
+        if isinstance(v, float):
+            return '%.4g' % v
+        return str(v)
+
+    flat = dict([ item for item in result.items()
+                  if not isinstance(item[1], dict) ])
+    lines = []
+    if flat or not result:
+        lines.append('%s: %s' % (name, format_items(flat)))
+    for case, values in sorted(result.items()):
+        if isinstance(values, dict):
+            lines.append('%s.%s: %s' % (name, case, format_items(values)))
+    return lines
+
+def main(argv):
+    try:
+        opts, names = getopt.getopt(argv, 'jo:l', ['json', 'output=',
+                                                   'list'])
+    except getopt.GetoptError:
+        sys.stderr.write('%s\n' % sys.exc_info()[1])
+        return 2
+
+    as_json = False
+    output = sys.stdout
+    for opt, value in opts:
+        if opt in ('-l', '--list'):
+            for name, func in benchmarks:
+                print('%-14s %s' % (name, ' '.join(func.__doc__.split())))
+            return 0
+        elif opt in ('-j', '--json'):
+            as_json = True
+        elif opt in ('-o', '--output'):
+            output = open(value, 'w')
+
+    unknown = set(names) - set([ name for name, func in benchmarks ])
+    if unknown:
+        sys.stderr.write('unknown benchmarks: %s\n'
+                         % ', '.join(sorted(unknown)))
+        return 2
+
+    homedir = make_homedir(['Bench %d <bench%d@example.org>' % (i, i)
+                            for i in range(2)])
+    results = {}
+    try:
+        for name, func in benchmarks:
+            if names and name not in names:
+                continue
+            results[name] = func(homedir)
+            if not as_json:
+                for line in format_result(name, results[name]):
+                    output.write(line + '\n')
+                output.flush()
+
+        if as_json:
+            document = { 'python': platform.python_version(),
+                         'platform': platform.platform(),
+                         'gnupg': gnupg_version(make_gnupg(homedir)),
+                         'gnupginterface': GnuPGInterface.__version__,
+                         'fd_strategy': GnuPGInterface._fd_strategy,
+                         'time': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                               time.gmtime()),
+                         'results': results }
+            json.dump(document, output, indent=2, sort_keys=True)
+            output.write('\n')
+    finally:
+        remove_homedir(homedir)
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
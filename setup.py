@@ -34,5 +34,5 @@ distutils.core.setup( name = 'GnuPGInterface',
 		      classifiers = classifiers,
 		      keywords = 'GnuPG gpg',
                       url = 'http://py-gnupg.sourceforge.net/',
-                      py_modules = [ 'GnuPGInterface' ]
+                      py_modules = [ 'GnuPGInterface', 'AsyncGnuPGInterface' ]
                       )
@@ -26,11 +26,30 @@ or see http://www.gnu.org/copyleft/lesser.html
 
 import unittest
 
+import atexit
+import gc
+import hashlib
+import io
+import mmap
 import os
+import re
+import select
+import shutil
+import socket
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 
 import GnuPGInterface
 
+try:
+    import asyncio
+    import AsyncGnuPGInterface
+except (ImportError, SyntaxError):
+    AsyncGnuPGInterface = None
+
 __author__   = "Frank J. Tobin, ftobin@neverending.org"
 __revision__ = "$Id$"
 
@@ -143,8 +162,11 @@ class GnuPGTests(BasicTest):
         plainfile.seek(0)
         temp2.seek(0)
 
-        assert fh_cmp(plainfile, temp2), \
-               "GnuPG decrypted output does not match original input"
+        same = fh_cmp(plainfile, temp2)
+        for f in (plainfile, temp1, temp2):
+            f.close()
+
+        assert same, "GnuPG decrypted output does not match original input"
 
 
     def test_attach_fhs_pipe(self):
@@ -157,30 +179,1566 @@ class GnuPGTests(BasicTest):
 
         pipeout, pipein = os.pipe()
         temp1 = tempfile.TemporaryFile()
+        stdin = os.fdopen(pipeout, 'r')
 
         proc = self.gnupg.run( ['--symmetric'],
                                attach_fhs={
-                                   'stdin': os.fdopen(pipeout, 'r'),
+                                   'stdin': stdin,
                                    'stdout': temp1 } )
+        stdin.close()
         os.write(pipein, plaintext.encode())
         os.close(pipein)
         proc.wait()
 
         temp1.seek(0)
         pipeout, pipein = os.pipe()
+        stdout = os.fdopen(pipein, 'w')
 
         proc = self.gnupg.run( ['--decrypt'],
                                attach_fhs={
                                     'stdin': temp1,
-                                    'stdout': os.fdopen(pipein, 'w') } )
+                                    'stdout': stdout } )
+        stdout.close()
         pipeout2 = os.fdopen(pipeout, 'r')
         decrypted = pipeout2.read()
         pipeout2.close()
         proc.wait()
+        temp1.close()
+
+        assert plaintext == decrypted, \
+               "GnuPG decrypted output does not match original input"
+
+
+class CommunicateTests(BasicTest):
+    """Tests for Process.communicate()"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.append('--no-secmem-warning')
+
+    def test_large_roundtrip(self):
+        """Push more than a pipe buffer through every handle at once"""
+        plaintext = os.urandom(1024 * 1024)
+        passphrase = "Three blind mice"
+
+        proc = self.gnupg.run(['--symmetric', '--compress-algo', 'none'],
+                              create_fhs=['stdin', 'stdout', 'stderr',
+                                          'status', 'passphrase'])
+        outputs = proc.communicate(input=plaintext, passphrase=passphrase)
+        proc.wait()
+
+        assert sorted(outputs.keys()) == ['status', 'stderr', 'stdout']
+        assert len(outputs['stdout']) > len(plaintext)
+        assert b'[GNUPG:]' in outputs['status']
+
+        proc = self.gnupg.run(['--decrypt'],
+                              create_fhs=['stdin', 'stdout', 'passphrase'])
+        outputs = proc.communicate(input=outputs['stdout'],
+                                   passphrase=passphrase)
+        proc.wait()
+
+        assert outputs['stdout'] == plaintext, \
+               "GnuPG decrypted output does not match original input"
+
+    def test_uncreated_handle(self):
+        """Data for a handle which wasn't created is an error"""
+        proc = self.gnupg.run(['--version'], create_fhs=['stdin', 'stdout'])
+        self.assertRaises(ValueError, proc.communicate, command=b'x')
+        proc.communicate()
+        proc.wait()
+
+
+class InstrumentationTests(BasicTest):
+    """Tests for GnuPG.hooks and Process.timings"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.passphrase = "Three blind mice"
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.append('--no-secmem-warning')
+
+    def test_events(self):
+        """Hooks see every event once, in order, as recorded in timings"""
+        events = []
+        self.gnupg.hooks.append(
+            lambda process, event, timestamp:
+                events.append((process, event, timestamp)))
+        plaintext = os.urandom(100000)
+
+        proc = self.gnupg.run(['--symmetric', '--compress-algo', 'none'],
+                              create_fhs=['stdin', 'stdout'])
+        outputs = proc.communicate(input=plaintext)
+        proc.wait()
+
+        names = [ event for process, event, timestamp in events ]
+        assert names[:3] == ['pre_spawn', 'spawned', 'passphrase_sent']
+        assert sorted(names[3:5]) == ['first_output', 'stdin_closed']
+        assert names[5:] == ['exit']
+        assert [ timestamp for process, event, timestamp in events ] \
+               == sorted(proc.timings.values())
+        for process, event, timestamp in events:
+            assert process is proc
+            assert proc.timings[event] == timestamp
+
+        assert proc.bytes_in == len(plaintext)
+        assert proc.bytes_out == len(outputs['stdout'])
+
+    def test_hook_error(self):
+        """A hook raising while run() starts GnuPG leaves nothing behind"""
+        for failing in ('spawned', 'passphrase_sent'):
+            pids = []
+            def hook(process, event, timestamp):
+                if event == failing:
+                    pids.append(process.pid)
+                    raise ValueError(event)
+            self.gnupg.hooks = [hook]
+            before = len(os.listdir('/dev/fd'))
+            self.assertRaises(ValueError, self.gnupg.run, ['--symmetric'],
+                              create_fhs=['stdin', 'stdout', 'status'])
+            assert len(os.listdir('/dev/fd')) == before
+            # reaped, so not even a zombie is left
+            self.assertRaises(OSError, os.kill, pids[0], 0)
+        self.gnupg.hooks = []
+
+    def test_stream(self):
+        """stream() records its input and output too"""
+        processes = []
+        self.gnupg.hooks.append(
+            lambda process, event, timestamp: processes.append(process))
+
+        output = b''.join(self.gnupg.stream(['--symmetric'], [b'data']))
+
+        process = processes[0]
+        assert sorted(process.timings.keys()) == \
+               ['exit', 'first_output', 'passphrase_sent', 'pre_spawn',
+                'spawned', 'stdin_closed']
+        assert process.bytes_in == 4
+        assert process.bytes_out == len(output)
+
+
+class PassphraseTests(BasicTest):
+    """Tests for the passphrase providers"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.append('--no-secmem-warning')
+
+    def roundtrip(self, plaintext=b'Three blind mice'):
+        proc = self.gnupg.run(['--symmetric'], create_fhs=['stdin', 'stdout'])
+        ciphertext = proc.communicate(input=plaintext)['stdout']
+        proc.wait()
+
+        proc = self.gnupg.run(['--decrypt'], create_fhs=['stdin', 'stdout'])
+        outputs = proc.communicate(input=ciphertext)
+        proc.wait()
+        assert outputs['stdout'] == plaintext, \
+               "GnuPG decrypted output does not match original input"
+
+    def test_abstract(self):
+        """Providers writing the passphrase must say what it is"""
+        class Incomplete(GnuPGInterface.PassphraseProvider):
+            pass
+        class Elsewhere(GnuPGInterface.PassphraseProvider):
+            uses_fd = 0
+        self.assertRaises(TypeError, GnuPGInterface.PassphraseProvider)
+        self.assertRaises(TypeError, Incomplete)
+        Elsewhere()
+        GnuPGInterface.StaticPassphrase("Three blind mice")
+
+    def test_callable(self):
+        """A callable passphrase is called for every run"""
+        calls = []
+        def passphrase():
+            calls.append(1)
+            return "Three blind mice"
+        self.gnupg.passphrase = passphrase
+        self.roundtrip()
+        assert len(calls) == 2
+
+    def test_callable_error(self):
+        """wait() raises what the passphrase callable raised"""
+        def passphrase():
+            raise ValueError("no passphrase today")
+        self.gnupg.passphrase = passphrase
+        proc = self.gnupg.run(['--symmetric'], create_fhs=['stdin', 'stdout'])
+        proc.communicate(input=b'data')
+        self.assertRaises(ValueError, proc.wait)
+
+    def test_loopback(self):
+        """LoopbackPassphrase passes the passphrase in loopback mode"""
+        self.gnupg.passphrase = \
+            GnuPGInterface.LoopbackPassphrase("Three blind mice")
+        self.roundtrip()
+
+    def test_unread(self):
+        """run() returns even if GnuPG never reads a long passphrase"""
+        self.gnupg.passphrase = 'x' * (1024 * 1024)
+        proc = self.gnupg.run(['--version'], create_fhs=['stdin', 'stdout'])
+        outputs = proc.communicate()
+        proc.wait()
+        assert outputs['stdout']
+
+    def test_high_fd(self):
+        """Long passphrases are written to descriptors past FD_SETSIZE"""
+        if GnuPGInterface.resource == None:
+            return
+        resource = GnuPGInterface.resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < 2048:
+            if hard != resource.RLIM_INFINITY and hard < 2048:
+                return
+            resource.setrlimit(resource.RLIMIT_NOFILE, (2048, hard))
+        # take every descriptor below 1024, so GnuPG's pipes get ones above
+        fds = []
+        try:
+            fd = os.open(os.devnull, os.O_RDONLY)
+            fds.append(fd)
+            while fd < 1024:
+                fd = os.dup(fds[0])
+                fds.append(fd)
+            self.gnupg.passphrase = 'x' * (1024 * 1024)
+            proc = self.gnupg.run(['--version'],
+                                  create_fhs=['stdin', 'stdout'])
+            assert proc.handles['stdout'].fileno() >= 1024
+            outputs = proc.communicate()
+            proc.wait()
+            assert outputs['stdout']
+        finally:
+            for fd in fds:
+                os.close(fd)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    def test_preset(self):
+        """PresetPassphrase unlocks keys without a passphrase filehandle"""
+        homedir = tempfile.mkdtemp()
+        try:
+            f = open(os.path.join(homedir, 'gpg-agent.conf'), 'w')
+            f.write('allow-preset-passphrase\n')
+            f.close()
+            self.gnupg.options.homedir = homedir
+            self.gnupg.passphrase = 'secret'
+            proc = self.gnupg.run(['--quick-gen-key', 'Pat <pat@foo.bar>',
+                                   'future-default', 'default', 'never'],
+                                  create_fhs=['stdin', 'stdout', 'stderr'])
+            proc.communicate()
+            proc.wait()
+
+            key = self.gnupg.list_secret_keys().get('pat@foo.bar')
+            self.gnupg.passphrase = None
+            self.gnupg.options.recipients = ['pat@foo.bar']
+            proc = self.gnupg.run(['--encrypt'], create_fhs=['stdin', 'stdout'])
+            ciphertext = proc.communicate(input=b'data')['stdout']
+            proc.wait()
+
+            # forget the passphrase cached while generating the key
+            subprocess.call(['gpgconf', '--homedir', homedir, '--reload',
+                             'gpg-agent'])
+            self.gnupg.options.extra_args.extend(['--pinentry-mode', 'error'])
+            proc = self.gnupg.run(['--decrypt'],
+                                  create_fhs=['stdin', 'stdout', 'stderr'])
+            proc.communicate(input=ciphertext)
+            self.assertRaises(IOError, proc.wait)
+
+            self.gnupg.passphrase = GnuPGInterface.PresetPassphrase(
+                'secret', [ k.keygrip for k in [key] + key.subkeys ])
+            proc = self.gnupg.run(['--decrypt'],
+                                  create_fhs=['stdin', 'stdout', 'stderr'])
+            outputs = proc.communicate(input=ciphertext)
+            proc.wait()
+            assert outputs['stdout'] == b'data'
+            assert 'passphrase_sent' not in proc.timings
+        finally:
+            remove_homedir(homedir)
+
+
+class StreamTests(BasicTest):
+    """Tests for GnuPG.stream()"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.passphrase = "Three blind mice"
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.append('--no-secmem-warning')
+
+    def test_roundtrip(self):
+        """Stream chunks through encryption and decryption"""
+        chunk = os.urandom(64 * 1024)
+        count = 40
+
+        def chunks():
+            for i in range(count):
+                yield chunk
+
+        ciphertext = tempfile.TemporaryFile()
+        for data in self.gnupg.stream(['--symmetric'], chunks(),
+                                      chunk_size=16384):
+            assert len(data) <= 16384
+            ciphertext.write(data)
+        ciphertext.seek(0)
+
+        digest = hashlib.sha256()
+        for data in self.gnupg.stream(['--decrypt'], ciphertext):
+            digest.update(data)
+        ciphertext.close()
+
+        assert digest.digest() == hashlib.sha256(chunk * count).digest(), \
+               "GnuPG decrypted output does not match original input"
+
+    def test_close_early(self):
+        """Closing the generator early stops GnuPG"""
+        def chunks():
+            while 1:
+                yield b'x' * 65536
+
+        output = self.gnupg.stream(['--symmetric'], chunks())
+        next(output)
+        output.close()
+
+
+class PipeTuningTests(BasicTest):
+    """Tests for GnuPG.pipe_size and GnuPG.buffering"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.compress_algo = 'none'
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.append('--no-secmem-warning')
+
+    def test_pipe_size(self):
+        """Created pipes get the requested capacity"""
+        if GnuPGInterface._F_SETPIPE_SZ == None:
+            return
+        F_GETPIPE_SZ = getattr(GnuPGInterface.fcntl, 'F_GETPIPE_SZ', 1032)
+
+        self.gnupg.pipe_size = 256 * 1024
+        proc = self.gnupg.run(['--store'], create_fhs=['stdin', 'stdout'])
+        for fh in proc.handles.values():
+            assert GnuPGInterface.fcntl.fcntl(fh.fileno(), F_GETPIPE_SZ) \
+                   == 256 * 1024
+        data = os.urandom(1024 * 1024)
+        outputs = proc.communicate(input=data)
+        proc.wait()
+
+        proc = self.gnupg.run(['--decrypt'], create_fhs=['stdin', 'stdout'])
+        outputs = proc.communicate(input=outputs['stdout'])
+        proc.wait()
+        assert outputs['stdout'] == data
+
+    def test_raw_handles(self):
+        """Unbuffered handles can read into a preallocated buffer"""
+        self.gnupg.buffering = 0
+        proc = self.gnupg.run(['--store'], create_fhs=['stdin', 'stdout'])
+        proc.handles['stdin'].write(b'data')
+        proc.handles['stdin'].close()
+
+        buf = bytearray(65536)
+        received = bytearray()
+        n = proc.handles['stdout'].readinto(buf)
+        while n:
+            received += buf[:n]
+            n = proc.handles['stdout'].readinto(buf)
+        proc.handles['stdout'].close()
+        proc.wait()
+        assert b'data' in received
+
+
+class TimeoutTests(BasicTest):
+    """Tests for timeouts, Process.cancel() and GnuPG.rlimits"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.append('--no-secmem-warning')
+
+    def hang(self):
+        """Return a Process of GnuPG waiting for input forever"""
+        return self.gnupg.run(['--store'], create_fhs=['stdin', 'stdout'])
+
+    def stuck_passphrase(self):
+        """Have GnuPG wait for a passphrase until the test ends"""
+        released = threading.Event()
+        self.addCleanup(released.set)
+        def passphrase():
+            released.wait()
+            return 'Three blind mice'
+        self.gnupg.passphrase = passphrase
+
+    def test_deadline(self):
+        """GnuPG is stopped at its deadline"""
+        self.gnupg.timeout = 0.3
+        proc = self.hang()
+        start = time.time()
+        self.assertRaises(GnuPGInterface.ProcessTimeout, proc.wait)
+        assert time.time() - start < 5
+        assert proc.timed_out == 'deadline' and proc.returncode < 0
+        for fh in proc.handles.values():
+            fh.close()
+
+        proc = self.hang()
+        proc.communicate(input=b'data')
+        proc.wait()
+        assert proc.timed_out == None and proc.returncode == 0
+
+    def test_wait_timeout(self):
+        """wait() stops GnuPG if it doesn't exit in time"""
+        proc = self.hang()
+        self.assertRaises(GnuPGInterface.ProcessTimeout, proc.wait, 0.2)
+        assert proc.timed_out == 'wait'
+        assert isinstance(GnuPGInterface.ProcessTimeout(), IOError)
+        for fh in proc.handles.values():
+            fh.close()
+
+    def test_idle_timeout(self):
+        """communicate() gives up on GnuPG doing nothing"""
+        self.stuck_passphrase()
+        self.gnupg.idle_timeout = 0.3
+        proc = self.gnupg.run(['--symmetric'],
+                              create_fhs=['stdin', 'stdout', 'stderr'])
+        self.assertRaises(GnuPGInterface.ProcessTimeout, proc.communicate,
+                          input=b'data')
+        self.assertRaises(GnuPGInterface.ProcessTimeout, proc.wait)
+        assert proc.timed_out == 'idle'
+
+    def test_cancel(self):
+        """cancel() stops GnuPG and closes its handles"""
+        proc = self.hang()
+        assert proc.cancel() < 0
+        assert proc.returncode < 0 and 'exit' in proc.timings
+        for fh in proc.handles.values():
+            assert fh.closed
+
+    def test_pool_timeout(self):
+        """A wedged job frees its process slot"""
+        self.stuck_passphrase()
+        pool = GnuPGInterface.GnuPGPool(self.gnupg, size=1)
+        start = time.time()
+        result = pool.map([ GnuPGInterface.Job(['--symmetric'],
+                                               input=b'data', timeout=0.3) ])[0]
+        assert time.time() - start < 5
+        assert isinstance(result.error, GnuPGInterface.ProcessTimeout)
+
+    def test_rlimits(self):
+        """Resource limits are applied to GnuPG"""
+        if GnuPGInterface.resource == None \
+           or not os.path.exists('/proc/self/limits'):
+            return
+        resource = GnuPGInterface.resource
+        self.gnupg.rlimits = { resource.RLIMIT_CPU: 30,
+                               resource.RLIMIT_NOFILE: (64, 128) }
+        proc = self.hang()
+        with open('/proc/%d/limits' % proc.pid) as f:
+            limits = f.read()
+        proc.cancel()
+        assert re.search(r'Max cpu time\s+30\s+30 ', limits), limits
+        assert re.search(r'Max open files\s+64\s+128 ', limits), limits
+
+
+class PageCacheTests(BasicTest):
+    """Tests for map_chunks() and GnuPG.fadvise"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.compress_algo = 'none'
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.append('--no-secmem-warning')
 
-        assert plaintext == decrypted.decode(), \
+    def setUp(self):
+        # several windows, without a huge file
+        self.window = GnuPGInterface._map_window
+        GnuPGInterface._map_window = 4 * mmap.ALLOCATIONGRANULARITY
+        self.data = os.urandom(GnuPGInterface._map_window * 3 + 12345)
+        self.plainfile = tempfile.NamedTemporaryFile()
+        self.plainfile.write(self.data)
+        self.plainfile.flush()
+
+    def tearDown(self):
+        GnuPGInterface._map_window = self.window
+        self.plainfile.close()
+
+    def decrypt(self, ciphertext):
+        proc = self.gnupg.run(['--decrypt'], create_fhs=['stdin', 'stdout'])
+        plaintext = proc.communicate(input=ciphertext)['stdout']
+        proc.wait()
+        return plaintext
+
+    def test_map_chunks(self):
+        """Mapped chunks feed GnuPG and can be checksummed on the way"""
+        digest = hashlib.sha256()
+        def chunks():
+            for chunk in GnuPGInterface.map_chunks(self.plainfile.name,
+                                                   10000, drop_cache=1):
+                assert isinstance(chunk, memoryview)
+                assert len(chunk) <= 10000
+                digest.update(chunk)
+                yield chunk
+
+        ciphertext = b''.join(self.gnupg.stream(['--store'], chunks()))
+        assert digest.digest() == hashlib.sha256(self.data).digest()
+        assert self.decrypt(ciphertext) == self.data
+
+        empty = tempfile.NamedTemporaryFile()
+        assert list(GnuPGInterface.map_chunks(empty)) == []
+        empty.close()
+
+    def test_fadvise(self):
+        """Attached files are still read and written in full"""
+        self.gnupg.fadvise = 1
+        output = tempfile.TemporaryFile()
+        plainfile = open(self.plainfile.name, 'rb')
+        proc = self.gnupg.run(['--store'], attach_fhs={ 'stdin': plainfile,
+                                                        'stdout': output })
+        proc.wait()
+        plainfile.close()
+
+        output.seek(0)
+        assert self.decrypt(output.read()) == self.data
+        output.close()
+
+
+class RelayTests(BasicTest):
+    """Tests for GnuPG.relay() and the relay helpers"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.passphrase = "Three blind mice"
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.append('--no-secmem-warning')
+
+    def test_methods(self):
+        """Every relay method moves all the data, or exactly count bytes"""
+        data = os.urandom(300000)
+        methods = ['copy']
+        if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+            methods.append('sendfile')
+
+        for method in methods:
+            src = tempfile.TemporaryFile()
+            src.write(data)
+            src.flush()
+            src.seek(0)
+            dst = tempfile.TemporaryFile()
+            assert GnuPGInterface._relay(src.fileno(), dst.fileno(), 1000,
+                                         method=method) == 1000
+            assert GnuPGInterface._relay(src.fileno(), dst.fileno(),
+                                         method=method) == len(data) - 1000
+            dst.seek(0)
+            assert dst.read() == data, "relay by %s lost data" % method
+            src.close()
+            dst.close()
+
+    def test_roundtrip(self):
+        """Relay a file through encryption, and back to a socket"""
+        plaintext = os.urandom(1024 * 1024)
+        plainfile = tempfile.TemporaryFile()
+        plainfile.write(plaintext)
+        plainfile.flush()
+        plainfile.seek(0)
+        cipherfile = tempfile.TemporaryFile()
+
+        proc = self.gnupg.relay(['--symmetric'], plainfile, cipherfile)
+        proc.wait()
+        assert proc.bytes_in == len(plaintext)
+        assert proc.bytes_out == os.fstat(cipherfile.fileno()).st_size
+        assert 'stdin_closed' in proc.timings
+        cipherfile.seek(0)
+
+        sender, receiver = socket.socketpair()
+        received = []
+        def receive():
+            chunks = []
+            data = receiver.recv(65536)
+            while data:
+                chunks.append(data)
+                data = receiver.recv(65536)
+            received.append(b''.join(chunks))
+        t = threading.Thread(target=receive)
+        t.start()
+
+        proc = self.gnupg.relay(['--decrypt'], cipherfile, sender)
+        proc.wait()
+        sender.close()
+        t.join()
+        receiver.close()
+        plainfile.close()
+        cipherfile.close()
+
+        assert received[0] == plaintext, \
                "GnuPG decrypted output does not match original input"
 
+    def test_count(self):
+        """Only count bytes are taken from the source"""
+        sender, receiver = socket.socketpair()
+        sender.sendall(b'first message' + b'rest')
+        cipherfile = tempfile.TemporaryFile()
+
+        proc = self.gnupg.relay(['--symmetric'], receiver, cipherfile,
+                                count=len(b'first message'))
+        proc.wait()
+        assert receiver.recv(100) == b'rest'
+        sender.close()
+        receiver.close()
+
+        cipherfile.seek(0)
+        proc = self.gnupg.run(['--decrypt'], create_fhs=['stdin', 'stdout'])
+        outputs = proc.communicate(input=cipherfile.read())
+        proc.wait()
+        cipherfile.close()
+        assert outputs['stdout'] == b'first message'
+
+
+class StatusTests(BasicTest):
+    """Tests for parsing the status filehandle"""
+
+    verify_output = b"""[GNUPG:] NEWSIG
+[GNUPG:] KEY_CONSIDERED 0123456789ABCDEF0123456789ABCDEF01234567 0
+[GNUPG:] SIG_ID abcdefghijklmnopqrstuvwxyz0 2001-01-01 978307200
+[GNUPG:] GOODSIG 89ABCDEF01234567 Joe Tester <joe@foo.bar>
+[GNUPG:] VALIDSIG 0123456789ABCDEF0123456789ABCDEF01234567 2001-01-01 978307200 0 4 0 1 8 00 0123456789ABCDEF0123456789ABCDEF01234567
+[GNUPG:] TRUST_ULTIMATE 0 pgp
+gpg: not a status line
+"""
+
+    def test_parse(self):
+        """Status lines parse into typed events and a result"""
+        reader = GnuPGInterface.StatusReader(self.verify_output)
+        events = list(reader)
+
+        assert [e.keyword for e in events] == \
+               ['NEWSIG', 'KEY_CONSIDERED', 'SIG_ID', 'GOODSIG',
+                'VALIDSIG', 'TRUST_ULTIMATE']
+        goodsig = events[3]
+        assert isinstance(goodsig, GnuPGInterface.SigEvent)
+        assert goodsig.keyid == '89ABCDEF01234567'
+        assert goodsig.username == 'Joe Tester <joe@foo.bar>'
+        assert events[1].flags == '0'
+        assert events[0].args == []
+
+        result = reader.result
+        assert result.valid()
+        assert result.trust == 'ULTIMATE'
+        assert result.fingerprint == \
+               '0123456789ABCDEF0123456789ABCDEF01234567'
+
+    def test_missing_optional(self):
+        """Missing optional arguments read as None"""
+        event = GnuPGInterface.parse_status_line(
+                b'[GNUPG:] PROGRESS tick ? 1 0\n')
+        assert event.total == '0' and event.units == None
+        assert GnuPGInterface.parse_status_line(b'gpg: hello') == None
+
+    def test_live(self):
+        """Parse the status of a real GnuPG process"""
+        self.gnupg.passphrase = "Three blind mice"
+        self.gnupg.options.meta_interactive = 0
+
+        proc = self.gnupg.run(['--symmetric'], create_fhs=['stdin', 'stdout'])
+        ciphertext = proc.communicate(input=b"data")['stdout']
+        proc.wait()
+
+        proc = self.gnupg.run(['--decrypt'],
+                              create_fhs=['stdin', 'stdout', 'status'])
+        outputs = proc.communicate(input=ciphertext)
+        proc.wait()
+
+        result = GnuPGInterface.StatusReader(outputs['status']).read()
+        assert result.decrypted
+        assert not result.valid()
+
+
+class KeyListingTests(BasicTest):
+    """Tests for listing keys into a KeyTable"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.homedir = keyring_homedir()
+        self.gnupg.options.meta_interactive = 0
+
+    def test_list_keys(self):
+        """Public keys are listed and indexed"""
+        table = self.gnupg.list_keys()
+        assert len(table) == len(keyring_uids)
+
+        key = table.get('joe@foo.bar')
+        assert key != None and not key.secret
+        assert key.uids[0].uid == keyring_uids[0]
+        assert len(key.fingerprint) == 40 and 'c' in key.capabilities
+        assert len(key.keygrip) == 40
+        assert key.subkeys and 'e' in key.subkeys[0].capabilities
+
+        assert table.get(key.fingerprint.lower()) is key
+        assert table.get('0x' + key.keyid) is key
+        assert table.get(key.subkeys[0].keyid) is key
+        assert table.get('<JOE@foo.bar>') is key
+        assert table.get(keyring_uids[0]) is key
+        assert 'nobody@foo.bar' not in table
+
+    def test_list_secret_keys(self):
+        """Secret keys can be listed by pattern"""
+        table = self.gnupg.list_secret_keys(['ann@foo.bar'])
+        assert len(table) == 1
+        assert table.keys[0].secret
+        assert table.keys[0].uids[0].email() == 'ann@foo.bar'
+
+    def test_no_match(self):
+        """Patterns matching no key give an empty table, not an error"""
+        assert len(self.gnupg.list_keys(['nobody@foo.bar'])) == 0
+        assert len(self.gnupg.list_secret_keys(['nobody@foo.bar'])) == 0
+        table = self.gnupg.list_keys(['joe@foo.bar', 'nobody@foo.bar'])
+        assert len(table) == 1
+
+        self.gnupg.options.homedir = os.path.join(tempfile.mkdtemp(),
+                                                  'missing')
+        try:
+            self.assertRaises(IOError, self.gnupg.list_keys, ['joe@foo.bar'])
+        finally:
+            os.rmdir(os.path.dirname(self.gnupg.options.homedir))
+            self.gnupg.options.homedir = keyring_homedir()
+
+    def test_escapes(self):
+        """Escaped colons in user IDs are decoded"""
+        listing = [b'pub:u:255:22:0123456789ABCDEF:0:::u:::scESC:',
+                   b'uid:u::::0::HASH::Colon\\x3a Man <c@foo.bar>:']
+        key = list(GnuPGInterface.parse_colons(listing))[0]
+        assert key.uids[0].uid == 'Colon: Man <c@foo.bar>'
+        assert key.fingerprint == None and key.keyid == '0123456789ABCDEF'
+
+    def test_short_records(self):
+        """Truncated records are skipped"""
+        listing = [b'pub:u:255:22:0123456789ABCDEF',
+                   b'fpr:', b'grp:::',
+                   b'fpr:::::::::0123456789ABCDEF0123456789ABCDEF01234567:',
+                   b'uid:u::', b'fpr:::::::::FEDCBA9876543210:',
+                   b'uid:u::::0::HASH::Joe Tester <joe@foo.bar>:']
+        key = list(GnuPGInterface.parse_colons(listing))[0]
+        assert key.fingerprint == '0123456789ABCDEF0123456789ABCDEF01234567'
+        assert key.keygrip == None and key.capabilities == None
+        assert [ u.uid for u in key.uids ] == ['Joe Tester <joe@foo.bar>']
+
+
+class EncryptManyTests(BasicTest):
+    """Tests for GnuPG.encrypt_many()"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.homedir = keyring_homedir()
+        self.gnupg.options.meta_interactive = 0
+
+    def decrypt(self, ciphertext):
+        proc = self.gnupg.run(['--decrypt'],
+                              create_fhs=['stdin', 'stdout', 'status'])
+        outputs = proc.communicate(input=ciphertext)
+        proc.wait()
+        return outputs
+
+    def test_encrypt_many(self):
+        """Payloads are encrypted to their own recipients, in order"""
+        joe = ['joe@foo.bar']
+        both = ['joe@foo.bar', 'ann@foo.bar']
+        items = [ (("message %d" % i).encode(), [joe, both][i % 2])
+                  for i in range(7) ]
+
+        ciphertexts = self.gnupg.encrypt_many(items)
+        assert len(ciphertexts) == len(items)
+
+        for (payload, recipients), ciphertext in zip(items, ciphertexts):
+            outputs = self.decrypt(ciphertext)
+            assert outputs['stdout'] == payload, \
+                   "GnuPG decrypted output does not match original input"
+            enc_to = outputs['status'].count(b'ENC_TO')
+            assert enc_to == len(recipients)
+
+    def test_armor_in_config(self):
+        """armor set in gpg.conf doesn't get in the way"""
+        self.gnupg.options.homedir = copy_homedir(keyring_homedir())
+        try:
+            f = open(os.path.join(self.gnupg.options.homedir, 'gpg.conf'),
+                     'a')
+            f.write('armor\n')
+            f.close()
+            ciphertext = self.gnupg.encrypt_many(
+                    [ (b"data", ['joe@foo.bar']) ])[0]
+            assert self.decrypt(ciphertext)['stdout'] == b"data"
+        finally:
+            remove_homedir(self.gnupg.options.homedir)
+            os.rmdir(os.path.dirname(self.gnupg.options.homedir))
+            self.gnupg.options.homedir = keyring_homedir()
+
+    def test_unknown_recipient(self):
+        """A recipient without a key makes GnuPG fail"""
+        self.assertRaises(IOError, self.gnupg.encrypt_many,
+                          [(b"data", ['nobody@foo.bar'])])
+
+
+class SegmentedTests(BasicTest):
+    """Tests for GnuPG.encrypt_segmented() and GnuPG.decrypt_segmented()"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.homedir = keyring_homedir()
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.compress_algo = 'none'
+        self.gnupg.options.recipients = ['joe@foo.bar']
+
+    def setUp(self):
+        self.data = os.urandom(250000)
+        self.container = tempfile.NamedTemporaryFile()
+        assert self.gnupg.encrypt_segmented(io.BytesIO(self.data),
+                                            self.container.name,
+                                            segment_size=40000,
+                                            size=3) == len(self.data)
+
+    def tearDown(self):
+        self.container.close()
+
+    def decrypt(self, start=0, length=None):
+        output = io.BytesIO()
+        written = self.gnupg.decrypt_segmented(self.container.name, output,
+                                               start, length, size=3)
+        assert written == len(output.getvalue())
+        return output.getvalue()
+
+    def test_ranges(self):
+        """The whole plaintext or any range of it can be restored"""
+        self.container.seek(0)
+        segments = self.gnupg._read_segment_index(self.container)
+        assert len(segments) == 7
+        assert [ s[2] for s in segments ] == list(range(0, 250000, 40000))
+
+        assert self.decrypt() == self.data
+        for start, length in [ (0, 1), (39999, 2), (12345, 100000),
+                               (240000, 10000), (100, 0), (249000, 5000) ]:
+            assert self.decrypt(start, length) == \
+                   self.data[start:start + length], (start, length)
+
+    def test_tampering(self):
+        """Swapped segments and other files are detected"""
+        self.container.seek(0)
+        segments = self.gnupg._read_segment_index(self.container)
+        # segments are stored in the order they were encrypted in
+        ciphertexts = []
+        for offset, length in [ s[:2] for s in segments[:2] ]:
+            self.container.seek(offset)
+            ciphertexts.append(self.container.read(length))
+        assert len(ciphertexts[0]) == len(ciphertexts[1])
+        for offset, ciphertext in zip([ s[0] for s in segments[:2] ],
+                                      reversed(ciphertexts)):
+            self.container.seek(offset)
+            self.container.write(ciphertext)
+        self.container.flush()
+        self.assertRaises(IOError, self.decrypt)
+        assert self.decrypt(100000) == self.data[100000:]
+
+        self.assertRaises(IOError, self.gnupg.decrypt_segmented,
+                          io.BytesIO(b'not a container'), io.BytesIO())
+
+    def test_read_errors(self):
+        """Errors reading either end fail the call, not truncate"""
+        class FailingFile(io.BytesIO):
+            reads = 0
+            def read(self, *args):
+                self.reads += 1
+                if self.reads == 3:
+                    raise OSError("read failed")
+                return io.BytesIO.read(self, *args)
+
+        output = io.BytesIO()
+        self.assertRaises(OSError, self.gnupg.encrypt_segmented,
+                          FailingFile(self.data), output,
+                          segment_size=1000, size=2)
+
+        # a segment read coming up short
+        self.container.seek(0)
+        segments = self.gnupg._read_segment_index(self.container)
+        last = segments[-1][0]
+        class ShortFile(io.BytesIO):
+            def read(self, *args):
+                short = self.tell() == last
+                data = io.BytesIO.read(self, *args)
+                return short and data[:-10] or data
+
+        self.container.seek(0)
+        self.assertRaises(IOError, self.gnupg.decrypt_segmented,
+                          ShortFile(self.container.read()), io.BytesIO(),
+                          size=2)
+
+
+class VerifyManyTests(BasicTest):
+    """Tests for GnuPG.verify_many()"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.homedir = keyring_homedir()
+        self.gnupg.options.meta_interactive = 0
+
+    def sign(self, data):
+        proc = self.gnupg.run(['--detach-sign'],
+                              create_fhs=['stdin', 'stdout'])
+        signature = proc.communicate(input=data)['stdout']
+        proc.wait()
+        return signature
+
+    def test_verify_many(self):
+        """Paths and bytes are verified in order, with verdicts"""
+        data = [ ('file %d' % i).encode() for i in range(6) ]
+        signatures = [ self.sign(d) for d in data ]
+        datafile = tempfile.NamedTemporaryFile()
+        datafile.write(data[0])
+        datafile.flush()
+        sigfile = tempfile.NamedTemporaryFile()
+        sigfile.write(signatures[0])
+        sigfile.flush()
+
+        items = [ (sigfile.name, datafile.name),
+                  (signatures[0], datafile.name),
+                  (sigfile.name, data[0]) ]
+        items.extend(zip(signatures[1:], data[1:]))
+        items.append((signatures[1], b'tampered'))
+        items.append((b'not a signature', b'data'))
+        items.append(('/nonexistent.sig', b'data'))
+
+        verdicts = self.gnupg.verify_many(items, size=3)
+        sigfile.close()
+        datafile.close()
+
+        assert len(verdicts) == len(items)
+        for v in verdicts[:-3]:
+            assert v.valid and v.status == 'GOODSIG', v
+            assert v.returncode == 0 and len(v.fingerprint) == 40
+        assert not verdicts[-3].valid and verdicts[-3].status == 'BADSIG'
+        for v in verdicts[-2:]:
+            assert not v.valid and v.returncode != 0
+
+    def test_unusable_items(self):
+        """Items which can't be run still get a failed Verification"""
+        signature = self.sign(b"data")
+        items = [ (signature, b"data"), (signature,), (None, b"data"),
+                  (signature, b"data") ]
+        verdicts = self.gnupg.verify_many(items, size=2)
+
+        assert len(verdicts) == len(items)
+        assert verdicts[0].valid and verdicts[-1].valid
+        for v in verdicts[1:3]:
+            assert not v.valid and v.returncode == None
+            assert v.error != None
+
+
+class VerificationCacheTests(BasicTest):
+    """Tests for VerificationCache class"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.meta_interactive = 0
+
+    def setUp(self):
+        self.gnupg.options.homedir = copy_homedir(keyring_homedir())
+        self.directory = tempfile.mkdtemp()
+        proc = self.gnupg.run(['--detach-sign'],
+                              create_fhs=['stdin', 'stdout'])
+        self.signature = proc.communicate(input=b"data")['stdout']
+        proc.wait()
+
+    def tearDown(self):
+        remove_homedir(self.gnupg.options.homedir)
+        os.rmdir(os.path.dirname(self.gnupg.options.homedir))
+        shutil.rmtree(self.directory)
+
+    def test_hits(self):
+        """Repeated verifications are answered from memory and disk"""
+        path = os.path.join(self.directory, 'verdicts')
+        cache = GnuPGInterface.VerificationCache(path=path)
+        items = [ (self.signature, b"data"), (self.signature, b"other") ]
+        first = self.gnupg.verify_many(items, cache=cache)
+        assert cache.misses == 2 and cache.hits == 0 and len(cache) == 2
+        assert [ v.valid for v in first ] == [ True, False ]
+        cache.close()
+
+        cache = GnuPGInterface.VerificationCache(path=path)
+        again = self.gnupg.verify_many(items, cache=cache)
+        assert cache.hits == 2 and cache.misses == 0
+        again.extend(self.gnupg.verify_many(items, cache=cache))
+        assert cache.hits == 4 and len(cache) == 2
+        cache.close()
+        for v in again:
+            assert v.error == None and v.returncode != None
+        assert [ (v.valid, v.status, v.fingerprint) for v in again ] == \
+               [ (v.valid, v.status, v.fingerprint) for v in first * 2 ]
+
+    def test_invalidation(self):
+        """Keyring changes and expiry make verdicts stale"""
+        cache = GnuPGInterface.VerificationCache()
+        items = [ (self.signature, b"data") ]
+        verdict = self.gnupg.verify_many(items, cache=cache)[0]
+        assert verdict.valid
+
+        proc = self.gnupg.run(['--yes', '--delete-secret-and-public-key',
+                               verdict.primary_fingerprint],
+                              create_fhs=['stdin', 'stdout', 'stderr'])
+        proc.communicate()
+        proc.wait()
+
+        verdict = self.gnupg.verify_many(items, cache=cache)[0]
+        assert cache.hits == 0 and cache.misses == 2
+        assert not verdict.valid and verdict.status == 'ERRSIG'
+
+        cache.ttl = -1
+        self.gnupg.verify_many(items, cache=cache)
+        assert cache.hits == 0 and cache.misses == 3
+
+    def test_paths(self):
+        """Verdicts on files are stored under the content verified"""
+        cache = GnuPGInterface.VerificationCache()
+        datafile = os.path.join(self.directory, 'data')
+        sigfile = os.path.join(self.directory, 'data.sig')
+        f = open(sigfile, 'wb')
+        f.write(self.signature)
+        f.close()
+
+        # files are only copied for GnuPG on misses
+        copies = []
+        snapshot = GnuPGInterface._snapshot
+        def counted(obj, path):
+            copies.append(obj)
+            return snapshot(obj, path)
+        GnuPGInterface._snapshot = counted
+        try:
+            for data, hits, valid in [ (b"data", 0, True),
+                                       (b"other", 0, False),
+                                       (b"data", 1, True) ]:
+                f = open(datafile + '.new', 'wb')
+                f.write(data)
+                f.close()
+                os.rename(datafile + '.new', datafile)
+                verdict = self.gnupg.verify_many([ (sigfile, datafile) ],
+                                                 tmpdir=self.directory,
+                                                 cache=cache)[0]
+                assert cache.hits == hits and verdict.valid == valid
+        finally:
+            GnuPGInterface._snapshot = snapshot
+        assert len(copies) == 4
+        assert sorted(os.listdir(self.directory)) == [ 'data', 'data.sig' ]
+
+
+class ShardedKeyringTests(BasicTest):
+    """Tests for ShardedKeyring class and split_keys()"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.extend(['--trust-model', 'always'])
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.keyring = GnuPGInterface.ShardedKeyring(
+                [ os.path.join(self.directory, str(i)) for i in range(4) ],
+                self.gnupg)
+        self.signer = GnuPGInterface.GnuPG()
+        self.signer.options.homedir = copy_homedir(keyring_homedir())
+        self.signer.options.meta_interactive = 0
+        self.signer.passphrase = ''
+
+    def tearDown(self):
+        for homedir in self.keyring.homedirs:
+            remove_homedir(homedir)
+        shutil.rmtree(self.directory)
+        remove_homedir(self.signer.options.homedir)
+        os.rmdir(os.path.dirname(self.signer.options.homedir))
+
+    def export(self, armor=0):
+        self.signer.options.armor = armor
+        proc = self.signer.run(['--export'], create_fhs=['stdin', 'stdout'])
+        keys = proc.communicate()['stdout']
+        proc.wait()
+        self.signer.options.armor = 0
+        return keys
+
+    def sign(self, data, default_key=None):
+        self.signer.options.default_key = default_key
+        proc = self.signer.run(['--detach-sign'],
+                               create_fhs=['stdin', 'stdout'])
+        signature = proc.communicate(input=data)['stdout']
+        proc.wait()
+        return signature
+
+    def test_split_keys(self):
+        """Keys are split with GnuPG's fingerprints, armored or not"""
+        fingerprints = [ k.fingerprint for k in self.signer.list_keys() ]
+        for armor in (0, 1):
+            keys = list(GnuPGInterface.split_keys(self.export(armor)))
+            assert [ k[0] for k in keys ] == fingerprints
+        assert b''.join([ k[1] for k in keys ]) == self.export()
+        self.assertRaises(ValueError, list,
+                          GnuPGInterface.split_keys(b'not keys'))
+
+    def test_routing(self):
+        """Keys land in, and are found through, their shard"""
+        imported = self.keyring.import_keys(self.export(armor=1), size=1,
+                                            batch_size=1)
+        assert len(imported) == len(keyring_uids)
+        for fingerprint in imported:
+            index = self.keyring.shard(fingerprint)
+            assert self.keyring.shard('0x' + fingerprint[-16:]) == index
+            for i in range(len(self.keyring)):
+                table = self.keyring.get_gnupg([i]).list_keys()
+                assert (fingerprint in table) == (i == index)
+        assert len(self.keyring.list_keys()) == len(keyring_uids)
+
+        ciphertext = self.keyring.encrypt(b"data", [ imported[0],
+                                                     'ann@foo.bar' ])
+        proc = self.signer.run(['--decrypt'],
+                               create_fhs=['stdin', 'stdout', 'stderr'])
+        assert proc.communicate(input=ciphertext)['stdout'] == b"data"
+        proc.wait()
+        self.assertRaises(IOError, self.keyring.encrypt, b"data",
+                          ['nobody@foo.bar'])
+        self.assertRaises(ValueError, self.keyring.encrypt, b"data", [])
+        self.assertRaises(ValueError, self.keyring.get_gnupg, [])
+
+    def test_verify(self):
+        """Signatures are verified on their shard, or all of them"""
+        fingerprint = self.signer.list_keys(['ann@foo.bar']).keys[0] \
+                      .fingerprint
+        proc = self.signer.run(['--quick-add-key', fingerprint, 'ed25519',
+                                'sign'],
+                               create_fhs=['stdin', 'stdout', 'stderr'])
+        proc.communicate()
+        proc.wait()
+        self.keyring.import_keys(self.export())
+
+        items = [ (self.sign(b"joe", 'joe@foo.bar'), b"joe"),
+                  (self.sign(b"ann", fingerprint), b"ann"),
+                  (self.sign(b"joe", 'joe@foo.bar'), b"tampered") ]
+        verdicts = self.keyring.verify_many(items)
+        assert [ v.status for v in verdicts ] == \
+               [ 'GOODSIG', 'GOODSIG', 'BADSIG' ]
+        assert verdicts[1].primary_fingerprint == fingerprint
+        assert verdicts[1].fingerprint != fingerprint
+        assert self.keyring.verify(*items[0]).valid
+
+        # the subkey is routed to its primary key's shard, in one run,
+        # also by keyrings opened later
+        spawns = []
+        self.gnupg.hooks.append(lambda process, event, timestamp:
+                                    event == 'spawned' and spawns.append(1))
+        assert self.keyring.verify(*items[1]).valid
+        assert len(spawns) == 1
+        reopened = GnuPGInterface.ShardedKeyring(self.keyring.homedirs)
+        assert reopened.shard(verdicts[1].fingerprint) == \
+               self.keyring.shard(fingerprint)
+
+        verdicts = self.keyring.verify_many([ b"not a pair", items[0] ])
+        assert verdicts[0].error != None and not verdicts[0].valid
+        assert verdicts[1].valid
+
+    def test_cache_state(self):
+        """Changes to any shard's keyring invalidate cached verdicts"""
+        # whichever shards the keys are routed to, give the last one a
+        # keyring of its own
+        gnupg = self.keyring.get_gnupg([ len(self.keyring) - 1 ])
+        proc = gnupg.run(['--import'], create_fhs=['stdin', 'stderr'])
+        proc.communicate(input=self.export())
+        proc.wait()
+        path = GnuPGInterface._keyring_path(gnupg.options.homedir)
+
+        gnupg = self.keyring.get_gnupg([ 0, len(self.keyring) - 1 ])
+        state = GnuPGInterface._verification_state(gnupg)
+
+        f = open(path, 'ab')
+        f.write(b'\0')
+        f.close()
+        assert GnuPGInterface._verification_state(gnupg) != state
+
+
+class BulkKeyTests(BasicTest):
+    """Tests for GnuPG.import_keys_bulk() and GnuPG.export_keys_bulk()"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.meta_interactive = 0
+
+    def setUp(self):
+        self.gnupg.options.homedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        remove_homedir(self.gnupg.options.homedir)
+
+    def test_roundtrip(self):
+        """Exported keys import in batches, reporting progress"""
+        exporter = GnuPGInterface.GnuPG()
+        exporter.options.homedir = keyring_homedir()
+        exporter.options.armor = 1
+        proc = exporter.run(['--export'], create_fhs=['stdin', 'stdout'])
+        armored = proc.communicate()['stdout']
+        proc.wait()
+
+        reports = []
+        progress = exporter.export_keys_bulk(
+                os.path.join(self.gnupg.options.homedir, 'keys.pgp'),
+                progress=lambda keys, written: reports.append(keys))
+        assert progress == len(keyring_uids) and reports == [ 1, 2 ]
+
+        fingerprints = []
+        totals = self.gnupg.import_keys_bulk(
+                armored, batch_size=1,
+                progress=lambda p: fingerprints.append(p.fingerprint))
+        assert totals.keys == totals.imported == len(keyring_uids)
+        assert totals.bytes > 0 and totals.problems == 0
+        assert fingerprints == [ k.fingerprint
+                                 for k in exporter.list_keys() ]
+
+        totals = self.gnupg.import_keys_bulk(
+                os.path.join(self.gnupg.options.homedir, 'keys.pgp'))
+        assert totals.unchanged == len(keyring_uids)
+        assert totals.imported == 0
+
+        exported = io.BytesIO()
+        assert self.gnupg.export_keys_bulk(exported, ['ann@foo.bar']) == 1
+        assert [ k[0] for k in GnuPGInterface.split_keys(
+                                    exported.getvalue()) ] == fingerprints[1:]
+
+
+class GnuPGWorkerTests(BasicTest):
+    """Tests for GnuPGWorker class"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.homedir = keyring_homedir()
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.extend(['--auto-key-locate', 'local'])
+
+    def setUp(self):
+        self.worker = GnuPGInterface.GnuPGWorker(self.gnupg, slots=4)
+
+    def tearDown(self):
+        self.worker.close()
+
+    def test_roundtrips(self):
+        """Encryptions share a server, which is replaced when needed"""
+        plaintexts = [ ("message %d" % i).encode() for i in range(6) ]
+        ciphertexts = [ self.worker.encrypt(p, ['joe@foo.bar'])
+                        for p in plaintexts ]
+        assert self.worker.spawns == 2, \
+               "4 slots should serve 6 encryptions with 2 servers"
+
+        for plaintext, ciphertext in zip(plaintexts, ciphertexts):
+            assert self.worker.decrypt(ciphertext) == plaintext, \
+                   "GnuPG decrypted output does not match original input"
+
+    def test_respawn(self):
+        """A dead server is replaced"""
+        assert self.worker.check()
+        self.worker._subproc.kill()
+        self.worker._subproc.wait()
+
+        ciphertext = self.worker.encrypt(b"data", ['ann@foo.bar'])
+        assert self.worker.decrypt(ciphertext) == b"data"
+        assert self.worker.check()
+
+    def test_errors(self):
+        """Server errors are raised as IOError"""
+        self.assertRaises(IOError, self.worker.encrypt, b"data",
+                          ['nobody@foo.bar'])
+        self.assertRaises(IOError, self.worker.decrypt, b"garbage")
+        assert self.worker.encrypt(b"data", ['joe@foo.bar'])
+
+    def test_recipient_injection(self):
+        """Recipients can't add commands to the server session"""
+        for recipient in ['joe@foo.bar\nRECIPIENT ann@foo.bar',
+                          'joe@foo.bar\r', 'joe%40foo.bar']:
+            self.assertRaises(ValueError, self.worker.encrypt, b"data",
+                              [recipient])
+        assert self.worker.spawns == 0
+        ciphertext = self.worker.encrypt(b"data", ['joe@foo.bar'])
+        assert self.worker.decrypt(ciphertext) == b"data"
+
+    def test_timeouts(self):
+        """A wedged server is killed and replaced"""
+        # answers every command, but never encrypts
+        script = tempfile.NamedTemporaryFile('w', suffix='.sh', delete=False)
+        script.write('#!/bin/sh\necho OK\nwhile read line; do\n'
+                     '  case "$line" in ENCRYPT*) exec sleep 60;; esac\n'
+                     '  echo OK\ndone\n')
+        script.close()
+        os.chmod(script.name, 0o755)
+        call = self.gnupg.call
+        try:
+            self.gnupg.call = script.name
+            for name in ('timeout', 'idle_timeout'):
+                setattr(self.gnupg, name, 1)
+                start = time.time()
+                self.assertRaises(GnuPGInterface.ProcessTimeout,
+                                  self.worker.encrypt, b"data",
+                                  ['joe@foo.bar'])
+                assert time.time() - start < 5
+                setattr(self.gnupg, name, None)
+            assert self.worker.spawns == 2
+        finally:
+            self.gnupg.call = call
+            os.remove(script.name)
+
+        ciphertext = self.worker.encrypt(b"data", ['joe@foo.bar'])
+        assert self.worker.decrypt(ciphertext) == b"data"
+
+    def test_sign_verify(self):
+        """Signing and verification run separate processes"""
+        self.gnupg.options.default_key = 'joe@foo.bar'
+        signature = self.worker.sign(b"data", ['--detach-sign'])
+
+        result = self.worker.verify(b"data", signature)
+        assert result.valid() and result.username == keyring_uids[0]
+        assert not self.worker.verify(b"other data", signature).valid()
+
+
+class KeyringCacheTests(BasicTest):
+    """Tests for KeyringCache class"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.options.meta_interactive = 0
+
+    def setUp(self):
+        self.gnupg.options.homedir = copy_homedir(keyring_homedir())
+
+    def tearDown(self):
+        remove_homedir(self.gnupg.options.homedir)
+        os.rmdir(os.path.dirname(self.gnupg.options.homedir))
+
+    def test_invalidation(self):
+        """Listings are reused until the keyring changes"""
+        cache = GnuPGInterface.KeyringCache()
+        table = cache.list_keys(self.gnupg)
+        assert len(table) == len(keyring_uids)
+        assert cache.list_keys(self.gnupg) is table
+
+        fingerprint = table.get(keyring_uids[1]).fingerprint
+        proc = self.gnupg.run(['--yes', '--delete-secret-and-public-key',
+                               fingerprint],
+                              create_fhs=['stdin', 'stdout', 'stderr'])
+        proc.communicate()
+        proc.wait()
+
+        table = cache.list_keys(self.gnupg)
+        assert len(table) == len(keyring_uids) - 1
+        assert fingerprint not in table
+
+    def test_lru(self):
+        """Only maxsize listings are kept"""
+        cache = GnuPGInterface.KeyringCache(maxsize=1)
+        other = GnuPGInterface.GnuPG()
+        other.options.homedir = keyring_homedir()
+        other.options.meta_interactive = 0
+
+        table = cache.list_keys(self.gnupg)
+        cache.list_secret_keys(other)
+        assert len(cache) == 1
+        assert cache.list_keys(self.gnupg) is not table
+
+    def test_options(self):
+        """Listings made with different options are kept apart"""
+        cache = GnuPGInterface.KeyringCache()
+        other = GnuPGInterface.GnuPG()
+        other.options = self.gnupg.options.copy()
+        other.options.extra_args.extend(['--trust-model', 'always'])
+
+        table = cache.list_keys(self.gnupg)
+        assert cache.list_keys(other) is not table
+        assert cache.list_keys(self.gnupg) is table
+        assert len(cache) == 2
+
+
+@unittest.skipIf(AsyncGnuPGInterface == None, "asyncio is unavailable")
+class AsyncGnuPGTests(unittest.TestCase):
+    """Tests for AsyncGnuPG class"""
+
+    def setUp(self):
+        self.gnupg = AsyncGnuPGInterface.AsyncGnuPG()
+        self.gnupg.passphrase = "Three blind mice"
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.append('--no-secmem-warning')
+
+    async def roundtrip(self, plaintext):
+        proc = await self.gnupg.run(['--symmetric'],
+                                    create_fhs=['stdin', 'stdout', 'status'])
+        proc.handles['stdin'].write(plaintext)
+        proc.handles['stdin'].close()
+        ciphertext, status = await asyncio.gather(
+                proc.handles['stdout'].read(), proc.handles['status'].read())
+        await proc.wait()
+        assert b'[GNUPG:]' in status
+
+        proc = await self.gnupg.run(['--decrypt'],
+                                    create_fhs=['stdin', 'stdout'])
+        proc.handles['stdin'].write(ciphertext)
+        proc.handles['stdin'].close()
+        decrypted = await proc.handles['stdout'].read()
+        await proc.wait()
+        return decrypted
+
+    def test_roundtrip(self):
+        """Encrypt and decrypt concurrently from one event loop"""
+        plaintexts = [ ("message %d" % i).encode() for i in range(8) ]
+
+        async def main():
+            return await asyncio.gather(*map(self.roundtrip, plaintexts))
+
+        assert asyncio.run(main()) == plaintexts, \
+               "GnuPG decrypted output does not match original input"
+
+    def test_failure(self):
+        """wait() raises IOError when GnuPG fails"""
+        async def main():
+            proc = await self.gnupg.run(['--no-such-command'],
+                                        create_fhs=['stderr'])
+            await proc.handles['stderr'].read()
+            await proc.wait()
+
+        self.assertRaises(IOError, asyncio.run, main())
+
+    def test_prepare_off_loop(self):
+        """passphrase providers are prepared outside the event loop"""
+        threads = []
+        class Provider(GnuPGInterface.StaticPassphrase):
+            def prepare(self, gnupg):
+                threads.append(threading.current_thread())
+        self.gnupg.passphrase = Provider("Three blind mice")
+
+        assert asyncio.run(self.roundtrip(b"message")) == b"message"
+        assert threads and threading.current_thread() not in threads
+
+    def test_connect_failure(self):
+        """GnuPG is reaped and pipes closed if connecting a pipe fails"""
+        before = len(os.listdir('/dev/fd'))
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            async def fail(*args):
+                raise OSError("cannot connect")
+            # asyncio only connects stdin, a write pipe, itself
+            loop.connect_read_pipe = fail
+            await self.gnupg.run(['--symmetric'],
+                                 create_fhs=['stdin', 'status'])
+
+        self.assertRaises(OSError, asyncio.run, main())
+        assert len(os.listdir('/dev/fd')) == before
+
+    def test_passphrase_failure(self):
+        """GnuPG is reaped and pipes closed if the passphrase fails"""
+        def passphrase():
+            raise ValueError("no passphrase today")
+        self.gnupg.passphrase = passphrase
+        before = len(os.listdir('/dev/fd'))
+
+        async def main():
+            await self.gnupg.run(['--symmetric'],
+                                 create_fhs=['stdin', 'stdout', 'status'])
+
+        self.assertRaises(ValueError, asyncio.run, main())
+        assert len(os.listdir('/dev/fd')) == before
+
+    def test_passphrase_unread(self):
+        """run() returns even if GnuPG exits without the passphrase"""
+        self.gnupg.passphrase = 'x' * (1024 * 1024)
+
+        async def main():
+            proc = await self.gnupg.run(['--version'],
+                                        create_fhs=['stdout'])
+            output = await proc.handles['stdout'].read()
+            await proc.wait()
+            return output
+
+        assert asyncio.run(main())
+
+
+class GnuPGPoolTests(BasicTest):
+    """Tests for GnuPGPool class"""
+
+    def __init__(self, methodName=None):
+        BasicTest.__init__(self, methodName)
+        self.gnupg.passphrase = "Three blind mice"
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.options.extra_args.append('--no-secmem-warning')
+        self.pool = GnuPGInterface.GnuPGPool(self.gnupg, size=3)
+
+    def test_map(self):
+        """Encrypt and decrypt many inputs, results in job order"""
+        plaintexts = [ ("message %d" % i).encode() for i in range(10) ]
+
+        jobs = [ GnuPGInterface.Job(['--symmetric'], input=p,
+                                    options={'armor': 1})
+                 for p in plaintexts ]
+        encrypted = self.pool.map(jobs)
+        for result in encrypted:
+            assert result.ok(), result.outputs['stderr']
+            assert result.outputs['stdout'].startswith(b'-----BEGIN PGP')
+        assert not self.gnupg.options.armor, \
+               "job options leaked into the pool's GnuPG"
+
+        jobs = [ GnuPGInterface.Job(['--decrypt'],
+                                    input=r.outputs['stdout'],
+                                    create_fhs=['stdout'])
+                 for r in encrypted ]
+        decrypted = [ r.outputs['stdout'] for r in self.pool.map(jobs) ]
+        assert decrypted == plaintexts, \
+               "GnuPG decrypted output does not match original input"
+
+    def test_input_file_and_failure(self):
+        """Jobs read input files, and report failures per job"""
+        plainfile = tempfile.NamedTemporaryFile()
+        plainfile.write(b"Three blind mice")
+        plainfile.flush()
+
+        jobs = [ GnuPGInterface.Job(['--symmetric'],
+                                    input_file=plainfile.name),
+                 GnuPGInterface.Job(['--decrypt'], input=b"garbage") ]
+        results = {}
+        for result in self.pool.imap_unordered(jobs):
+            results[result.index] = result
+        plainfile.close()
+
+        assert results[0].ok() and results[0].outputs['stdout']
+        assert not results[1].ok() and results[1].returncode != 0
+        assert results[1].error == None
+
+    def test_jobs_error(self):
+        """An exception from the job iterable reaches the caller"""
+        def jobs():
+            yield GnuPGInterface.Job(['--version'])
+            raise OSError("cannot read jobs")
+
+        results = []
+        try:
+            for result in self.pool.imap_unordered(jobs()):
+                results.append(result)
+        except OSError as e:
+            assert str(e) == "cannot read jobs"
+        else:
+            self.fail("job iterable error was swallowed")
+        assert len(results) == 1 and results[0].ok()
+
+        self.assertRaises(OSError, self.pool.map, jobs())
+
+    def test_prepare(self):
+        """Jobs are prepared by the pool's threads, in parallel"""
+        # every job waits for the others to be preparing
+        barrier = threading.Barrier(3, timeout=30)
+
+        def prepare(job):
+            barrier.wait()
+            if job.args == ['skip']:
+                return None
+            if job.args == ['fail']:
+                raise OSError("cannot prepare")
+            return GnuPGInterface.Job(['--version'])
+
+        jobs = [ GnuPGInterface.Job([], [arg], prepare=prepare)
+                 for arg in ('run', 'skip', 'fail') ]
+        results = self.pool.map(jobs)
+        assert results[0].ok() and results[0].job.commands == ['--version']
+        assert results[1].returncode == None and results[1].error == None
+        assert not results[1].outputs and results[1].job is jobs[1]
+        assert isinstance(results[2].error, OSError)
+
 
 class OptionsTests(BasicTest):
     """Tests for Options class"""
@@ -262,6 +1820,61 @@ class OptionsTests(BasicTest):
                    "failure to set option '%s'; should be %s, but result is %s" \
                    % (option, should_be, result)
 
+    def test_cached_args(self):
+        """cached arguments follow attribute and list changes"""
+        options = self.gnupg.options
+        options.armor = 1
+        args = options.get_args_tuple()
+        assert options.get_args_tuple() is args
+        assert options.get_args() == ['--armor']
+
+        options.recipients = ['test1']
+        options.recipients.append('test2')
+        options.extra_args += ['--no-secmem-warning']
+        assert options.get_args() == ['--armor', '--recipient', 'test1',
+                                      '--recipient', 'test2',
+                                      '--no-secmem-warning']
+
+        options.recipients[1:] = []
+        del options.extra_args[0]
+        options.armor = 0
+        assert options.get_args() == ['--recipient', 'test1']
+
+        # get_args() gives a list of the caller's own
+        options.get_args().append('--armor')
+        assert options.get_args() == ['--recipient', 'test1']
+
+    def test_overridden_args(self):
+        """run() uses the arguments of an overridden get_args()"""
+        class ArmorOptions(GnuPGInterface.Options):
+            def get_args(self):
+                return GnuPGInterface.Options.get_args(self) + ['--armor']
+        self.gnupg.options = ArmorOptions()
+        self.gnupg.options.meta_interactive = 0
+        self.gnupg.passphrase = "Three blind mice"
+
+        proc = self.gnupg.run(['--symmetric'], create_fhs=['stdin', 'stdout'])
+        ciphertext = proc.communicate(input=b"Three blind mice")['stdout']
+        proc.wait()
+        assert ciphertext.startswith(b'-----BEGIN PGP MESSAGE-----')
+
+    def test_frozen(self):
+        """FrozenOptions keep their arguments and refuse changes"""
+        options = self.gnupg.options
+        options.armor = 1
+        options.recipients = ['test1']
+        frozen = options.freeze()
+        options.recipients.append('test2')
+
+        assert frozen.get_args() == ['--armor', '--recipient', 'test1']
+        self.assertRaises(AttributeError, setattr, frozen, 'armor', 0)
+        assert frozen.recipients == ('test1',)
+
+        copied = frozen.copy()
+        copied.armor = 0
+        assert copied.get_args() == ['--recipient', 'test1']
+        assert frozen.get_args() == ['--armor', '--recipient', 'test1']
+
 
 class PipesTests(unittest.TestCase):
     """Tests for Pipes class"""
@@ -272,6 +1885,194 @@ class PipesTests(unittest.TestCase):
         assert self.pipe.child  == 2
         assert not self.pipe.direct
     
+
+class FdStrategyTests(BasicTest):
+    """Tests for keeping unrelated file descriptors out of GnuPG"""
+
+    def setUp(self):
+        self.gnupg.passphrase = "Three blind mice"
+        self.gnupg.options.meta_interactive = 0
+
+    def strategies(self):
+        """Return the strategies which close unrelated descriptors"""
+        strategies = ['scan']
+        if GnuPGInterface._fd_dir is not None:
+            strategies.append('listdir')
+        if sys.version_info >= (3, 2):
+            strategies.append('pass_fds')
+        return strategies
+
+    def test_listers(self):
+        """fd listers include open and exclude closed descriptors"""
+        listers = [GnuPGInterface._list_fds_scan]
+        if GnuPGInterface._fd_dir is not None:
+            listers.append(GnuPGInterface._list_fds_dir)
+
+        # use a high number for the closed fd, so that it isn't reused by
+        # the listing itself
+        r, w = os.pipe()
+        closed = os.dup2(w, 200) or 200
+        os.close(closed)
+        try:
+            for lister in listers:
+                fds = lister()
+                assert r in fds, "%s misses open fd %d" % (lister, r)
+                assert closed not in fds, \
+                       "%s lists closed fd %d" % (lister, closed)
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_no_leak(self):
+        """an inheritable pipe end is not passed to GnuPG"""
+        for strategy in self.strategies():
+            self.gnupg.fd_strategy = strategy
+
+            r, w = os.pipe()
+            if hasattr(os, 'set_inheritable'):
+                os.set_inheritable(w, True)
+            proc = self.gnupg.run(['--symmetric'],
+                                  create_fhs=['stdin', 'stdout'])
+            os.close(w)
+            # gpg is blocked reading stdin, so r only sees EOF if gpg
+            # didn't inherit w
+            readable = select.select([r], [], [], 5)[0]
+            os.close(r)
+
+            proc.handles['stdin'].write(b'data')
+            proc.handles['stdin'].close()
+            proc.handles['stdout'].read()
+            proc.handles['stdout'].close()
+            proc.wait()
+
+            assert readable, \
+                   "fd leaked into GnuPG with strategy '%s'" % strategy
+
+    def test_strategies(self):
+        """GnuPG gets its filehandles with every strategy"""
+        strategies = self.strategies()
+        if sys.version_info >= (3, 4):
+            strategies.append('inheritable')
+
+        for strategy in strategies:
+            self.gnupg.fd_strategy = strategy
+
+            proc = self.gnupg.run(['--symmetric'],
+                                  create_fhs=['stdin', 'stdout', 'status'])
+            outputs = proc.communicate(input=b'data')
+            proc.wait()
+            assert outputs['stdout'] and b'[GNUPG:]' in outputs['status'], \
+                   "no output with strategy '%s'" % strategy
+
+    def test_inheritable_restored(self):
+        """Attached descriptors are not left inheritable"""
+        if sys.version_info < (3, 4):
+            return
+        self.gnupg.fd_strategy = 'inheritable'
+
+        status = tempfile.TemporaryFile()
+        proc = self.gnupg.run(['--symmetric'], create_fhs=['stdin', 'stdout'],
+                              attach_fhs={ 'status': status })
+        proc.communicate(input=b'data')
+        proc.wait()
+
+        assert not os.get_inheritable(status.fileno())
+        status.seek(0)
+        assert b'[GNUPG:]' in status.read()
+        status.close()
+
+
+class ConcurrencyTests(BasicTest):
+    """Tests for sharing one GnuPG object between threads"""
+
+    def setUp(self):
+        # --store needs neither keys, whose locks 64 GnuPG processes
+        # would contend for, nor slow passphrase key derivation
+        self.gnupg.options.compress_algo = 'none'
+        self.gnupg.options.meta_interactive = 0
+
+    def test_arguments_untouched(self):
+        """run() leaves the caller's create_fhs and attach_fhs alone"""
+        self.gnupg.passphrase = "unused"
+        create_fhs = ['stdin', 'stdout']
+        attach_fhs = {}
+        proc = self.gnupg.run(['--store'], create_fhs=create_fhs,
+                              attach_fhs=attach_fhs)
+        proc.communicate(input=b'data')
+        proc.wait()
+        assert create_fhs == ['stdin', 'stdout'] and attach_fhs == {}
+
+    def test_stress(self):
+        """64 threads share a GnuPG without cross-talk or fd leaks"""
+        if sys.version_info < (3, 4):
+            return      # needs threading.Barrier and os.set_inheritable
+        strategies = ['scan']
+        if GnuPGInterface._fd_dir is not None:
+            strategies.append('listdir')
+        strategies.append('pass_fds')
+        # the status handle makes GnuPG take an extra descriptor, which
+        # is what the strategies differ in handling
+        create_fhs = ['stdin', 'stdout', 'status']
+        lister = GnuPGInterface._fd_listers['scan']
+
+        for strategy in strategies:
+            self.gnupg.fd_strategy = strategy
+            # descriptors leaked by earlier tests may be collected
+            # while this one runs, so compare descriptor numbers
+            gc.collect()
+            before = set(lister())
+            errors = []
+
+            # every thread starts GnuPG before any checks its pipe, and
+            # none feeds GnuPG before all have checked, so a pipe end
+            # leaked into another thread's GnuPG is still held open
+            barrier = threading.Barrier(64, timeout=60)
+
+            def work(n):
+                try:
+                    plaintext = ('%s %d' % (strategy, n)).encode()
+
+                    # an inheritable pipe made while other threads start
+                    # GnuPG must not leak into their children, where
+                    # descriptors aren't listed in the parent beforehand
+                    r, w = os.pipe()
+                    os.set_inheritable(w, True)
+                    proc = self.gnupg.run(['--store'],
+                                          create_fhs=create_fhs)
+                    barrier.wait()
+                    os.close(w)
+                    leaked = not select.select([r], [], [], 2)[0] \
+                             and strategy == 'pass_fds'
+                    os.close(r)
+                    barrier.wait()
+
+                    stored = proc.communicate(input=plaintext)['stdout']
+                    proc.wait()
+                    proc = self.gnupg.run(['--decrypt'],
+                                          create_fhs=create_fhs)
+                    decrypted = proc.communicate(input=stored)['stdout']
+                    proc.wait()
+                    if leaked or decrypted != plaintext:
+                        errors.append((n, leaked, decrypted))
+                except Exception:
+                    barrier.abort()
+                    errors.append((n, sys.exc_info()[1]))
+
+            threads = [ threading.Thread(target=work, args=(n,))
+                        for n in range(64) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            assert not errors, "strategy '%s': %s" % (strategy, errors[:3])
+            assert create_fhs == ['stdin', 'stdout', 'status']
+            gc.collect()
+            leaked = set(lister()) - before
+            assert not leaked, \
+                   "descriptors %s leaked with strategy '%s'" \
+                   % (sorted(leaked), strategy)
+
 ########################################################################
 
 def fh_cmp(f1, f2, bufsize=8192):
@@ -281,6 +2082,54 @@ def fh_cmp(f1, f2, bufsize=8192):
         if b1 != b2: return 0
         if not b1:   return 1
 
+# user IDs of the keys in keyring_homedir()
+keyring_uids = ['Joe Tester <joe@foo.bar>', 'Ann Tester <ann@foo.bar>']
+
+_keyring_homedir = None
+
+def keyring_homedir():
+    """Return a throwaway GnuPG home directory holding a key for each of
+    keyring_uids, without passphrases.  It is created on first use."""
+    global _keyring_homedir
+    if _keyring_homedir != None:
+        return _keyring_homedir
+
+    homedir = tempfile.mkdtemp()
+    atexit.register(remove_homedir, homedir)
+
+    gnupg = GnuPGInterface.GnuPG()
+    gnupg.options.homedir = homedir
+    gnupg.options.meta_interactive = 0
+    gnupg.passphrase = ''
+    for uid in keyring_uids:
+        proc = gnupg.run(['--quick-gen-key', uid, 'future-default',
+                          'default', 'never'],
+                         create_fhs=['stdin', 'stdout', 'stderr'])
+        proc.communicate()
+        proc.wait()
+    # settled now, so verifying in copies doesn't update the trustdb
+    proc = gnupg.run(['--check-trustdb'],
+                     create_fhs=['stdin', 'stdout', 'stderr'])
+    proc.communicate()
+    proc.wait()
+
+    _keyring_homedir = homedir
+    return homedir
+
+def copy_homedir(homedir):
+    """Return a temporary copy of homedir, without agent sockets"""
+    copy = os.path.join(tempfile.mkdtemp(), 'gnupg')
+    shutil.copytree(homedir, copy, ignore=shutil.ignore_patterns('S.*'))
+    return copy
+
+def remove_homedir(homedir):
+    """Stop the gpg-agent of homedir and remove it"""
+    try:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--kill', 'all'])
+    except OSError:
+        pass
+    shutil.rmtree(homedir, ignore_errors=True)
+
 ########################################################################
 
 if __name__ == "__main__":